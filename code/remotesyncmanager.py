@@ -4,16 +4,34 @@ import os
 import sys
 import time
 import struct
+import zlib
+import marshal
+import mmap
 import random
 import datetime
 import netifaces
 import socket
+import select
+import selectors
 import queue
+import array
 import threading
 import multiprocessing as mp
 import multiprocessing.managers as mpm
+import multiprocessing.connection as mpc
+import multiprocessing.shared_memory as mpshm
+import multiprocessing.resource_tracker as mprt
 import pickle
+import stat
+import traceback
 import contextlib
+import collections
+import asyncio
+import functools
+import itertools
+import heapq
+import weakref
+import uuid
 from contextlib import contextmanager
 
 
@@ -49,6 +67,4263 @@ def get_ip():
         return s.getsockname()[0]
 
 
+def read_serverdata(serverdatafilename):
+    '''
+    Return the contents of the server data file written by the server side of
+    a `RemoteSyncManager`.
+    '''
+    with open(serverdatafilename, 'rb') as serverdata_file:
+        return pickle.load(serverdata_file)
+
+
+# Shared memory segments are not left to the resource tracker (which would
+# unlink a segment when any process attached to it exits, before python 3.13),
+# the `RemoteSyncManager` which creates them unlinks them explicitly.
+
+def create_shared_memory(size):
+    try:
+        return mpshm.SharedMemory(create=True, size=size, track=False)
+    except TypeError:
+        shm = mpshm.SharedMemory(create=True, size=size)
+        mprt.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def attach_shared_memory(segmentname):
+    try:
+        return mpshm.SharedMemory(name=segmentname, track=False)
+    except TypeError:
+        shm = mpshm.SharedMemory(name=segmentname)
+        mprt.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def unlink_shared_memory(shm):
+    if getattr(shm, '_track', True):
+        # `unlink` unregisters the segment, which must then be registered.
+        mprt.register(shm._name, 'shared_memory')
+    shm.unlink()
+
+
+def preferred_address(serverinfo, shard=0):
+    '''
+    Return the address a client should connect to for shard `shard` of the
+    server: its AF_UNIX socket if there is one and the client is on the
+    server's host, its TCP address otherwise.
+    '''
+    return local_address(serverinfo, *serverinfo['addresses'][shard])
+
+
+def local_address(serverinfo, tcpaddress, unixaddress):
+    '''
+    Return `unixaddress` if there is one and this process is on the server's
+    host, `tcpaddress` otherwise.
+    '''
+    if unixaddress and serverinfo.get('host') == (socket.gethostname(), get_ip()) and os.path.exists(unixaddress):
+        return unixaddress
+    return tcpaddress
+
+
+def shard_of(name, shards):
+    '''
+    Return the shard a named object is placed on by default. `hash` would
+    not do: it is salted differently in every process.
+    '''
+    return zlib.crc32(name.encode()) % shards
+
+
+# Connections.
+#
+# The managers of `RemoteSyncManager` use the serializer 'pickle5' rather than
+# 'pickle': their connections (`BufferConnection`) pickle with protocol 5, and
+# move the contents of large buffers between the objects and the socket
+# without copying them into, or out of, the pickle.
+#
+# How a message is encoded is up to the `Codec` of the sender, and recorded in
+# the flags of its header, so that any message can be decoded whatever the
+# codecs of the receiver.
+
+def reduce_memoryview(m):
+    if m.contiguous:
+        return rebuild_memoryview, (pickle.PickleBuffer(m), m.format, m.shape)
+    return rebuild_memoryview, (m.tobytes(), m.format, m.shape)
+
+def rebuild_memoryview(buffer, fmt, shape):
+    return memoryview(buffer).cast('B').cast(fmt, shape)
+
+
+class Codec:
+    '''
+        How the messages to a named object, or all those of a manager, are
+        encoded, e.g. `Codec('plain', compress=4096)`:
+
+        `format` is 'pickle', or 'plain' for plain data (None, bool, int,
+        float, complex, str, bytes, tuple, list, dict, set and frozenset, but
+        not their subclasses), encoded with marshal, faster than pickle. A
+        message which holds anything else is pickled anyway. Note that
+        bytes-like objects, e.g. bytearrays, come back as bytes.
+
+        `compress` is the size in bytes above which the encoded message is
+        compressed with zlib at `level`, None not to compress. A message
+        which does not get smaller is sent as is.
+
+        The codec counts the messages it encodes and the bytes saved by the
+        compression, see `info`.
+    '''
+
+    formats = ('pickle', 'plain')
+
+    def __init__(self, format='pickle', compress=None, level=1):
+        if format not in self.formats:
+            raise ValueError(f'unknown codec format {format!r}')
+        self.format = format
+        self.compress = compress
+        self.level = level
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        # Messages encoded, plain ones, compressed ones, bytes encoded, and
+        # bytes sent once compressed (out-of-band buffers excepted).
+        self.counters = [0, 0, 0, 0, 0]
+
+    def record(self, flags, encoded, sent):
+        with self.lock:
+            counters = self.counters
+            counters[0] += 1
+            counters[1] += flags & MARSHAL
+            counters[2] += (flags & ZLIB) >> 1
+            counters[3] += encoded
+            counters[4] += sent
+
+    def merge(self, other):
+        with self.lock:
+            self.counters = [a + b for a, b in zip(self.counters, other.counters)]
+
+    # Codecs are written to the server data file, and their counters sent
+    # from the server to the clients, without the lock.
+
+    def __getstate__(self):
+        with self.lock:
+            return (self.format, self.compress, self.level, self.counters[:])
+
+    def __setstate__(self, state):
+        self.__init__(*state[:3])
+        self.counters = state[3]
+
+    def info(self):
+        with self.lock:
+            messages, plain, compressed, encoded, sent = self.counters
+        return {
+            'format': self.format,
+            'compress': self.compress,
+            'messages': messages,
+            'plain': plain,
+            'compressed': compressed,
+            'bytes_encoded': encoded,
+            'bytes_sent': sent,
+            'bytes_saved': encoded - sent,
+        }
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.format!r}, compress={self.compress!r}, level={self.level!r})'
+
+
+# The flags of a message header.
+MARSHAL = 1
+ZLIB = 2
+
+# `Client` gives the connections to `address` the codecs of
+# `addresscodecs[address]`: `(codec, {ident: codec})`, see `BufferConnection`.
+addresscodecs = {}
+
+
+class ChunkWriter:
+    '''
+        File-like object collecting what a pickler writes. Large bytes and
+        bytearray objects are written as is, so they are not copied.
+    '''
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, chunk):
+        self.chunks.append(chunk)
+        size = chunk.nbytes if isinstance(chunk, memoryview) else len(chunk)
+        self.size += size
+        return size
+
+
+messageheader = struct.Struct('!QIB')
+
+def encode_message(obj, codec=None):
+    '''
+    Encode `obj` for a `BufferConnection` with `codec` (pickle, uncounted, if
+    None), and return the list of chunks to send (the header, the out-of-band
+    buffers, then the body) and their total size in bytes. The header holds
+    the size of the body, the number of buffers, the flags (MARSHAL, ZLIB)
+    and the sizes of the buffers. Buffers of `BufferConnection.outofband`
+    bytes or more (memoryviews, PickleBuffers and the objects which reduce to
+    them, e.g. NumPy arrays) are sent out-of-band, straight from their
+    memory.
+    '''
+    buffers = []
+    flags = 0
+    chunks = None
+
+    if codec is not None and codec.format == 'plain':
+        try:
+            chunks = [marshal.dumps(obj)]
+            size = len(chunks[0])
+            flags = MARSHAL
+        except ValueError:
+            pass
+
+    def collect(buffer):
+        try:
+            view = buffer.raw()
+        except BufferError:
+            return True
+        if view.nbytes < BufferConnection.outofband:
+            return True
+        buffers.append(view)
+        return False
+
+    if chunks is None:
+        writer = ChunkWriter()
+        pickler = mp.reduction.ForkingPickler(writer, 5, True, collect)
+        pickler.dispatch_table[memoryview] = reduce_memoryview
+        pickler.dump(obj)
+        chunks, size = writer.chunks, writer.size
+
+    if codec is not None:
+        encoded = size
+        if codec.compress is not None and size > codec.compress:
+            compressed = zlib.compress(b''.join(chunks), codec.level)
+            if len(compressed) < size:
+                chunks, size = [compressed], len(compressed)
+                flags |= ZLIB
+        codec.record(flags, encoded, size)
+
+    if not buffers:
+        return [messageheader.pack(size, 0, flags)] + chunks, 13 + size
+    sizes = [view.nbytes for view in buffers]
+    header = messageheader.pack(size, len(buffers), flags) + struct.pack(f'!{len(sizes)}Q', *sizes)
+    return [header] + buffers + chunks, len(header) + sum(sizes) + size
+
+
+def decode_message(body, flags, buffers=()):
+    '''
+    Return the object of a message, from its body, flags and buffers.
+    '''
+    if flags & ZLIB:
+        body = zlib.decompress(body)
+    if flags & MARSHAL:
+        return marshal.loads(body)
+    return pickle.loads(body, buffers=buffers)
+
+
+class MessageReader:
+    '''
+        File-like object reading the `size` bytes of a pickle from a
+        `BufferConnection`, for an unpickler: large bytes and bytearray
+        objects are read straight into their memory with `readinto`.
+    '''
+
+    def __init__(self, conn, size):
+        self.conn = conn
+        self.remaining = size
+
+    def read(self, n=-1):
+        n = self.remaining if n < 0 else min(n, self.remaining)
+        self.remaining -= n
+        return self.conn._recv(n).getvalue() if n else b''
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')[:self.remaining]
+        self.conn._recv_into(view)
+        self.remaining -= len(view)
+        return len(view)
+
+    def readline(self):
+        # Not used by protocol 5 pickles, but required of an unpickler file.
+        line = b''
+        while self.remaining and not line.endswith(b'\n'):
+            line += self.read(1)
+        return line
+
+    def skip(self):
+        while self.remaining:
+            self.read(min(self.remaining, 1 << 16))
+
+
+class BufferConnection(mpc.Connection):
+    '''
+        A multiprocessing connection whose messages are pickled with protocol
+        5 (see `encode_message`). Sending a message never copies the contents
+        of large bytes, bytearray or out-of-band buffers. On receipt, each of
+        them is read from the socket straight into the object which holds it
+        in the end: one copy in all.
+
+        `send_bytes` and `recv_bytes` are those of multiprocessing, used as
+        usual for the authentication.
+
+        A message is encoded with the `codec` given to `send`, otherwise with
+        the codec of the object it is a request to, in `codecs` by object
+        id, otherwise with the `codec` of the connection.
+    '''
+
+    codec = None
+    codecs = {}
+
+    # Buffers this large or larger are sent out-of-band, and pickles this
+    # large or larger are unpickled as they are read.
+    outofband = 1 << 14
+    streamed = 1 << 16
+
+    def send(self, obj, codec=None):
+        '''
+        Send `obj`, and return the size of the message in bytes.
+        '''
+        self._check_closed()
+        self._check_writable()
+        if codec is None:
+            codec = self.codec
+            if self.codecs and type(obj) is tuple:
+                codec = self.codecs.get(obj[0], codec)
+        chunks, size = encode_message(obj, codec)
+        if size < 16384:
+            self._send(b''.join(chunks))
+        else:
+            for chunk in chunks:
+                self._send(memoryview(chunk).cast('B'))
+        return size
+
+    def recv(self):
+        return self.recv_sized()[0]
+
+    def recv_sized(self):
+        '''
+        Receive an object, and return it with the size of its message.
+        '''
+        self._check_closed()
+        self._check_readable()
+        bodysize, count, flags = messageheader.unpack(self._recv(13).getvalue())
+        sizes = struct.unpack(f'!{count}Q', self._recv(8 * count).getvalue()) if count else ()
+
+        buffers = []
+        for size in sizes:
+            buffer = bytearray(size)
+            self._recv_into(memoryview(buffer))
+            buffers.append(buffer)
+
+        if flags or bodysize < self.streamed:
+            obj = decode_message(self._recv(bodysize).getbuffer(), flags, buffers)
+        else:
+            reader = MessageReader(self, bodysize)
+            try:
+                obj = pickle.Unpickler(reader, buffers=buffers).load()
+            finally:
+                # Whatever happens, the next message must start where it should.
+                reader.skip()
+        return obj, 13 + 8 * count + sum(sizes) + bodysize
+
+    def _recv_into(self, view):
+        while view:
+            n = os.readv(self._handle, [view])
+            if n == 0:
+                raise EOFError
+            view = view[n:]
+
+
+def set_nodelay(conn):
+    # Small messages, e.g. the last of the authentication followed by the
+    # first request, would otherwise wait for the delayed ACK of the peer.
+    sock = socket.socket(fileno=conn.fileno())
+    try:
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    finally:
+        sock.detach()
+
+
+class Listener(mpc.Listener):
+    '''
+        multiprocessing.connection.Listener handing out `BufferConnection`s,
+        whose codec is `codec`.
+    '''
+
+    codec = None
+
+    def __init__(self, address=None, family=None, backlog=1, authkey=None):
+        # multiprocessing listens with a backlog of 16: when many clients
+        # connect at once, the others wait for the SYN-ACK to be resent,
+        # seconds later.
+        super().__init__(address, family, max(backlog, socket.SOMAXCONN), authkey)
+
+    def accept(self):
+        conn = super().accept()
+        try:
+            bufferconn = BufferConnection(os.dup(conn.fileno()))
+        finally:
+            conn.close()
+        set_nodelay(bufferconn)
+        bufferconn.codec = self.codec
+        return bufferconn
+
+
+def Client(address, family=None, authkey=None):
+    '''
+    multiprocessing.connection.Client, returning a `BufferConnection` with
+    the codecs of `addresscodecs[address]`, if any.
+    '''
+    family = family or mpc.address_type(address)
+    with socket.socket(getattr(socket, family)) as sock:
+        sock.setblocking(True)
+        if family == 'AF_INET':
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.connect(address)
+        conn = BufferConnection(sock.detach())
+    if address in addresscodecs:
+        conn.codec, conn.codecs = addresscodecs[address]
+    if authkey is not None:
+        mpc.answer_challenge(conn, authkey)
+        mpc.deliver_challenge(conn, authkey)
+    return conn
+
+
+mpm.listener_client['pickle5'] = (Listener, Client)
+
+
+def server_call(address, authkey, funcname, *args):
+    '''
+    Call the public method `funcname` of the manager server at `address`,
+    through a connection of its own, as multiprocessing.managers does for e.g.
+    `create` or `decref`.
+    '''
+    conn = Client(address, authkey=authkey)
+    try:
+        return mpm.dispatch(conn, None, funcname, args)
+    finally:
+        conn.close()
+
+
+# Server side operations.
+#
+# These functions run inside the server process, on the shared object itself,
+# when a proxy calls a method of the same name (see `RemoteSyncServer`).
+# They allow a single request to do the work of many.
+
+def queue_put_many(q, items, block=True, timeout=None):
+    '''
+    Put `items` in the queue `q` in order, honouring its maxsize, and return
+    the number of items actually put, which is less than len(items) if the
+    queue remained full until `timeout` (a deadline for the whole batch).
+    '''
+    deadline = None if timeout is None else time.monotonic() + timeout
+    count = 0
+    try:
+        for item in items:
+            if deadline is None:
+                q.put(item, block)
+            else:
+                q.put(item, block, max(0, deadline - time.monotonic()))
+            count += 1
+    except queue.Full:
+        pass
+    return count
+
+
+def queue_get_many(q, max_items, block=True, timeout=None):
+    '''
+    Wait (as `q.get` would) for a first item, then return a list of up to
+    `max_items` items that are immediately available. The list is empty if no
+    item arrived before `timeout`.
+    '''
+    items = []
+    if max_items < 1:
+        return items
+    try:
+        items.append(q.get(block, timeout))
+        while len(items) < max_items:
+            items.append(q.get_nowait())
+    except queue.Empty:
+        pass
+    return items
+
+
+class Missing:
+    '''
+    The type of `MISSING`, which stands for an absent key or attribute in the
+    atomic operations. It survives pickling, so `value is MISSING` can be
+    tested on either side of a connection.
+    '''
+    def __repr__(self):
+        return 'MISSING'
+
+    def __reduce__(self):
+        return 'MISSING'
+
+
+MISSING = Missing()
+
+
+# The atomic operations below are serialized per object by the server (see
+# `RemoteSyncServer.serialized`), they are therefore free to read and write
+# the object in several steps.
+
+def value_incr(v, delta=1):
+    v.value = v.value + delta
+    return v.value
+
+
+def value_compare_and_swap(v, expected, new):
+    '''
+    Set the value to `new` if it equals `expected`. Return a pair
+    (swapped, previous value).
+    '''
+    previous = v.value
+    if previous == expected:
+        v.value = new
+        return True, previous
+    return False, previous
+
+
+def dict_incr(d, key, delta=1):
+    d[key] = d[key] + delta
+    return d[key]
+
+
+def dict_setdefault_incr(d, key, delta=1, default=0):
+    d[key] = d.get(key, default) + delta
+    return d[key]
+
+
+def dict_incr_many(d, deltas, default=0):
+    '''
+    Add each of `deltas`, `{key: delta}`, to its item, starting from
+    `default` if absent. Return the new values, `{key: value}`.
+    '''
+    for key, delta in deltas.items():
+        d[key] = d.get(key, default) + delta
+    return {key: d[key] for key in deltas}
+
+
+def dict_compare_and_swap(d, key, expected, new):
+    '''
+    Set `d[key]` to `new` if its current value, or MISSING, equals
+    `expected`. Return a pair (swapped, previous value or MISSING).
+    '''
+    previous = d.get(key, MISSING)
+    if previous is expected or previous == expected:
+        d[key] = new
+        return True, previous
+    return False, previous
+
+
+def dict_update_if(d, expected, updates):
+    '''
+    Update `d` with `updates` only if every key of `expected` currently maps
+    to the expected value (MISSING for an absent key). Return True if the
+    update was applied.
+    '''
+    for key, value in expected.items():
+        current = d.get(key, MISSING)
+        if not (current is value or current == value):
+            return False
+    d.update(updates)
+    return True
+
+
+def dict_pop_many(d, keys):
+    '''
+    Remove `keys` from `d` and return a dict of the removed items, absent
+    keys are ignored.
+    '''
+    return {key: d.pop(key) for key in keys if key in d}
+
+
+def on_namespace(function):
+    '''
+    Turn a dict operation into the same operation on a Namespace's attributes.
+    '''
+    return lambda ns, *args, **kwds: function(vars(ns), *args, **kwds)
+
+
+# Changes to dicts and Namespaces.
+#
+# `mutations` maps the methods (and operations) which modify a dict or a
+# Namespace to a function returning the keys (attribute names) they modify,
+# given the arguments and the result of the call, or None if any key may have
+# changed. The server uses it to version these objects and to notify the
+# caches of the clients (see `ProxyCache`), which also use it to drop their own
+# changes.
+
+def first_argument_key(args, kwds, result):
+    return (args[0],)
+
+
+def update_keys(args, kwds, result):
+    keys = list(kwds)
+    if args:
+        other = args[0]
+        keys.extend(other.keys() if hasattr(other, 'keys') else (k for k, v in other))
+    return keys
+
+
+mutations = {
+    '__setitem__': first_argument_key,
+    '__delitem__': first_argument_key,
+    '__setattr__': first_argument_key,
+    '__delattr__': first_argument_key,
+    'pop': first_argument_key,
+    'setdefault': first_argument_key,
+    'incr': first_argument_key,
+    'add': first_argument_key,
+    'setdefault_incr': first_argument_key,
+    'incr_many': lambda args, kwds, result: list(args[0]),
+    'compare_and_swap': first_argument_key,
+    'popitem': lambda args, kwds, result: None if result is None else (result[0],),
+    'update': update_keys,
+    'update_if': lambda args, kwds, result: args[1].keys(),
+    'pop_many': lambda args, kwds, result: args[0],
+    'clear': lambda args, kwds, result: None,
+}
+
+
+def apply_changes(obj, changes, reset):
+    '''
+    Apply to the dict or Namespace `obj` the `changes` of another copy of it:
+    `{key: value}`, MISSING for deleted keys, or all its entries if `reset`.
+    '''
+    mapping = obj if isinstance(obj, dict) else vars(obj)
+    if reset:
+        mapping.clear()
+        mapping.update(changes)
+    else:
+        for key, value in changes.items():
+            if value is MISSING:
+                mapping.pop(key, None)
+            else:
+                mapping[key] = value
+
+
+# Object states.
+#
+# These functions describe a shared object, inside the server process, for
+# `RemoteSyncServer.snapshot`.
+
+def queue_state(q):
+    return {'qsize': q.qsize(), 'maxsize': q.maxsize, 'empty': q.empty(), 'full': q.full()}
+
+def event_state(e):
+    return {'is_set': e.is_set()}
+
+def lock_state(lock):
+    return {'locked': lock.locked()}
+
+def semaphore_state(semaphore):
+    return {'value': semaphore._value}
+
+def barrier_state(barrier):
+    return {'parties': barrier.parties, 'n_waiting': barrier.n_waiting, 'broken': barrier.broken}
+
+def sized_state(obj):
+    return {'len': len(obj)}
+
+def value_state(v):
+    return {'value': v.get()}
+
+def namespace_state(ns):
+    return {'attributes': sorted(vars(ns))}
+
+
+# Object persistence.
+#
+# These functions save the contents of a shared object as plain data, and load
+# them back into an object of the same type, inside the server process, for
+# the `Journal`.
+
+def mapping_save(d):
+    return dict(d)
+
+def mapping_load(d, state):
+    apply_changes(d, state, True)
+
+def namespace_save(ns):
+    return dict(vars(ns))
+
+def value_save(v):
+    return v.get()
+
+def value_load(v, state):
+    v.set(state)
+
+def queue_save(q):
+    with q.mutex:
+        return list(q.queue)
+
+def queue_load(q, state):
+    with q.mutex:
+        q.queue.clear()
+        q.queue.extend(state)
+        q.not_empty.notify_all()
+
+def sequence_save(sequence):
+    return sequence[:]
+
+def sequence_load(sequence, state):
+    sequence[:] = state
+
+def event_save(e):
+    return e.is_set()
+
+def event_load(e, state):
+    if state:
+        e.set()
+    else:
+        e.clear()
+
+
+class WorkerPool:
+    '''
+        A pool of threads executing `submit`ted calls. It grows whenever all its
+        threads are busy, so that a call which blocks (e.g. a `get` on an empty
+        queue) never delays the others, and threads left idle for `idle`
+        seconds exit, down to `minimum` threads.
+    '''
+
+    def __init__(self, minimum=0, idle=10.0):
+        self.minimum = minimum
+        self.idle = idle
+        self.calls = queue.SimpleQueue()
+        self.mutex = threading.Lock()
+        self.threads = 0
+        self.waiting = 0
+
+    def submit(self, function, *args):
+        with self.mutex:
+            if self.waiting:
+                self.waiting -= 1
+                spawn = False
+            else:
+                self.threads += 1
+                spawn = True
+        self.calls.put((function, args))
+        if spawn:
+            thread = threading.Thread(target=self.worker, daemon=True)
+            thread.start()
+
+    def worker(self):
+        while True:
+            try:
+                function, args = self.calls.get(timeout=self.idle)
+            except queue.Empty:
+                # `waiting` counts the idle threads not yet promised a call by
+                # `submit`, if none is left, a call is on its way to us.
+                with self.mutex:
+                    if self.waiting and self.threads > self.minimum:
+                        self.waiting -= 1
+                        self.threads -= 1
+                        return
+                continue
+            try:
+                function(*args)
+            except Exception:
+                mpm.util.info('exception in worker thread: %s',
+                              traceback.format_exc())
+            with self.mutex:
+                self.waiting += 1
+
+
+class ConnectionSelector:
+    '''
+        Serves the connections of proxies of a `RemoteSyncServer` with the
+        engine 'selector': a single thread waits for requests on all the
+        connections at once, and hands each request to the server's
+        `WorkerPool`. A connection only has a thread of its own while one of
+        its requests is being served, instead of for its whole life.
+
+        Having sent a reply, the thread waits `linger` seconds for the next
+        request on the same connection before giving it back to the
+        selecting thread: a client making one call after another is then
+        served without going through the selecting thread each time. A
+        connection whose requests acquired an RLock or a Condition keeps its
+        thread until it releases them, these belong to the thread which
+        acquired them (see `RemoteSyncServer.owns`), or until it closes:
+        they are then released.
+    '''
+
+    linger = 0.001
+
+    def __init__(self, server):
+        self.server = server
+        self.selector = selectors.DefaultSelector()
+        self.added = collections.deque()
+        # `add` wakes the selecting thread up with a byte on this pair.
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.waker.setblocking(False)
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def add(self, conn):
+        '''
+        Wait for the next request on `conn`.
+        '''
+        self.added.append(conn)
+        with contextlib.suppress(BlockingIOError):
+            self.waker.send(b'\0')
+
+    def run(self):
+        while not self.server.stop_event.is_set():
+            for key, events in self.selector.select(timeout=1):
+                if key.fileobj is self.wakeup:
+                    with contextlib.suppress(BlockingIOError):
+                        self.wakeup.recv(4096)
+                    while self.added:
+                        conn = self.added.popleft()
+                        self.selector.register(conn, selectors.EVENT_READ)
+                else:
+                    # Not selected again until its request is served.
+                    self.selector.unregister(key.fileobj)
+                    self.server.workers.submit(self.serve, key.fileobj)
+
+    def serve(self, conn):
+        # Lighter than conn.poll, which creates a selector each time.
+        poll = select.poll()
+        poll.register(conn.fileno(), select.POLLIN)
+        while self.server.serve_request(conn):
+            if self.server.owns():
+                continue
+            if not poll.poll(self.linger * 1000):
+                self.add(conn)
+                return
+        self.server.connected(-1)
+        conn.close()
+        # This thread serves other connections next, which must not find
+        # them acquired already.
+        self.server.disown()
+
+
+class Histogram:
+    '''
+        A latency histogram in the manner of HdrHistogram: values (in
+        nanoseconds) are counted in buckets whose width is a fixed fraction
+        (1/2**precision) of their value, so that percentiles are accurate to
+        about 3% over any range, with a few hundred counters at most.
+        Histograms of several threads or processes add up with `merge`.
+    '''
+
+    precision = 5
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        # The bucket of a value is the value with all but its `precision`
+        # most significant bits cleared.
+        shift = value.bit_length() - self.precision
+        if shift > 0:
+            value = value >> shift << shift
+        self.counts[value] = self.counts.get(value, 0) + 1
+
+    def merge(self, other):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def copy(self):
+        histogram = Histogram()
+        histogram.merge(self)
+        return histogram
+
+    def percentile(self, fraction):
+        rank = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                # The middle of the bucket.
+                shift = bucket.bit_length() - self.precision
+                if shift > 0:
+                    bucket += 1 << shift >> 1
+                return min(bucket, self.max)
+        return self.max
+
+    def summary(self):
+        '''
+        Return the count, and the mean, percentiles and max in microseconds.
+        '''
+        summary = {'count': self.count}
+        if self.count:
+            summary['mean'] = self.total / self.count / 1000
+            for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999)):
+                summary[name] = self.percentile(fraction) / 1000
+            summary['max'] = self.max / 1000
+        return summary
+
+
+class Metrics:
+    '''
+        Call metrics, per named object and method: the number of calls and
+        errors, the bytes received and sent, and a `Histogram` of the time
+        taken. The server records the execution time of each request, a
+        client the round trip time of each call (see
+        `RemoteSyncManager.stats`).
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def record(self, name, methodname, elapsed, error=False, received=0, sent=0):
+        with self.lock:
+            entry = self.entries.get((name, methodname))
+            if entry is None:
+                entry = self.entries[(name, methodname)] = [0, 0, 0, 0, Histogram()]
+            entry[0] += 1
+            entry[1] += error
+            entry[2] += received
+            entry[3] += sent
+            entry[4].record(elapsed)
+
+    def merge(self, other):
+        with self.lock:
+            for key, (calls, errors, received, sent, histogram) in other.entries.items():
+                entry = self.entries.get(key)
+                if entry is None:
+                    entry = self.entries[key] = [0, 0, 0, 0, Histogram()]
+                entry[0] += calls
+                entry[1] += errors
+                entry[2] += received
+                entry[3] += sent
+                entry[4].merge(histogram)
+
+    # Metrics are sent from the server to the clients, without the lock.
+
+    def __getstate__(self):
+        with self.lock:
+            return {key: entry[:4] + [entry[4].copy()] for key, entry in self.entries.items()}
+
+    def __setstate__(self, entries):
+        self.reset()
+        self.entries = entries
+
+    def stats(self):
+        '''
+        Return the metrics as `{name: {methodname: {...}}}`.
+        '''
+        stats = {}
+        for (name, methodname), (calls, errors, received, sent, histogram) in sorted(self.__getstate__().items()):
+            stats.setdefault(name, {})[methodname] = {
+                'calls': calls,
+                'errors': errors,
+                'bytes_received': received,
+                'bytes_sent': sent,
+                'latency_us': histogram.summary(),
+            }
+        return stats
+
+    def dump(self, prefix):
+        '''
+        Return the metrics in the Prometheus text format, as summaries named
+        `<prefix>_seconds`, plus counters for the errors and bytes.
+        '''
+        lines = [
+            f'# TYPE {prefix}_seconds summary',
+            f'# TYPE {prefix}_errors_total counter',
+            f'# TYPE {prefix}_received_bytes_total counter',
+            f'# TYPE {prefix}_sent_bytes_total counter',
+        ]
+        for (name, methodname), (calls, errors, received, sent, histogram) in sorted(self.__getstate__().items()):
+            labels = f'object="{name}",method="{methodname}"'
+            for fraction in (0.5, 0.9, 0.99, 0.999):
+                lines.append(f'{prefix}_seconds{{{labels},quantile="{fraction}"}} {histogram.percentile(fraction) / 1e9:.9f}')
+            lines.append(f'{prefix}_seconds_sum{{{labels}}} {histogram.total / 1e9:.9f}')
+            lines.append(f'{prefix}_seconds_count{{{labels}}} {calls}')
+            lines.append(f'{prefix}_errors_total{{{labels}}} {errors}')
+            lines.append(f'{prefix}_received_bytes_total{{{labels}}} {received}')
+            lines.append(f'{prefix}_sent_bytes_total{{{labels}}} {sent}')
+        return '\n'.join(lines) + '\n'
+
+
+def timed(callmethod, name, metrics):
+    '''
+    Wrap the `_callmethod` of the proxy of the named object `name`, so that
+    the round trip time of each call is recorded in `metrics`.
+    '''
+    def _callmethod(methodname, args=(), kwds={}):
+        start = time.perf_counter_ns()
+        error = True
+        try:
+            result = callmethod(methodname, args, kwds)
+            error = False
+            return result
+        finally:
+            metrics.record(name, methodname, time.perf_counter_ns() - start, error)
+    return _callmethod
+
+
+class RemoteSyncServer(mpm.Server):
+    '''
+        `class RemoteSyncServer:` is the server used by the `syncmanager` of
+        `RemoteSyncManager`. It serves clients exactly like
+        multiprocessing.managers.Server, except that a method called by a
+        proxy is first looked up in `operations`, which maps a method name
+        and a shared object type to a function executed in the server with
+        the shared object as first argument.
+
+        Besides the usual connections, where the server waits for the reply
+        to a request to be sent before reading the next request, it also
+        accepts pipelined connections (see `accept_pipelined`).
+    '''
+
+    public = mpm.Server.public + ['accept_pipelined', 'accept_invalidations', 'get_metrics', 'create_many', 'snapshot', 'get_codecs', 'accept_changes', 'get_load', 'write_stream', 'read_stream', 'delete_stream', 'get_locks']
+
+    operations = {
+        'put_many': {queue.Queue: queue_put_many},
+        'get_many': {queue.Queue: queue_get_many},
+        'incr': {
+            mpm.Value: value_incr,
+            dict: dict_incr,
+            mpm.Namespace: on_namespace(dict_incr),
+        },
+        'compare_and_swap': {
+            mpm.Value: value_compare_and_swap,
+            dict: dict_compare_and_swap,
+            mpm.Namespace: on_namespace(dict_compare_and_swap),
+        },
+        'setdefault_incr': {
+            dict: dict_setdefault_incr,
+            mpm.Namespace: on_namespace(dict_setdefault_incr),
+        },
+        'incr_many': {
+            dict: dict_incr_many,
+            mpm.Namespace: on_namespace(dict_incr_many),
+        },
+        'update_if': {
+            dict: dict_update_if,
+            mpm.Namespace: on_namespace(dict_update_if),
+        },
+        'pop_many': {
+            dict: dict_pop_many,
+            mpm.Namespace: on_namespace(dict_pop_many),
+        },
+        # A string names a method of the server, called with the object.
+        'versioned_get': {
+            dict: 'versioned_get',
+            mpm.Namespace: 'versioned_get',
+        },
+        'watch': {
+            dict: 'watch',
+            mpm.Namespace: 'watch',
+        },
+        # Any named object can start a transaction, see `transact`, or take
+        # a snapshot, see `object_snapshot`.
+        'transact': {object: 'transact'},
+        'snapshot': {object: 'object_snapshot'},
+        # Locks acquired on behalf of a holder, see `lock_acquire`.
+        'acquire_as': {type(threading.Lock()): 'lock_acquire'},
+        'release_as': {type(threading.Lock()): 'lock_release'},
+    }
+
+    # The state of an object, besides its type and repr, in a `snapshot`.
+    states = {
+        queue.Queue: queue_state,
+        threading.Event: event_state,
+        type(threading.Lock()): lock_state,
+        threading.Semaphore: semaphore_state,
+        threading.Barrier: barrier_state,
+        dict: sized_state,
+        list: sized_state,
+        array.array: sized_state,
+        mpm.Value: value_state,
+        mpm.Namespace: namespace_state,
+    }
+
+    # Atomic operations, and the plain methods which modify a Value, dict or
+    # Namespace, are executed while holding a lock specific to the shared
+    # object, so that e.g. a `set` cannot slip between the read and the write
+    # of a `compare_and_swap`. None of these may block.
+    serialized = {
+        'incr', 'compare_and_swap', 'setdefault_incr', 'incr_many', 'update_if', 'pop_many',
+        'set', '__setitem__', '__delitem__', '__setattr__', '__delattr__',
+        'pop', 'popitem', 'setdefault', 'update', 'clear', 'versioned_get',
+    }
+
+    # The types whose changes are versioned and notified, see `mutations`.
+    versioned = (dict, mpm.Namespace)
+
+    # The types of the objects which belong to the thread which acquired
+    # them, and which must be released, waited or notified by the same
+    # thread (see `owns`).
+    threadowned = (type(threading.RLock()), threading.Condition)
+
+    # How the `Journal` saves and loads the objects of each type.
+    persisted = {
+        dict: (mapping_save, mapping_load),
+        mpm.Namespace: (namespace_save, mapping_load),
+        mpm.Value: (value_save, value_load),
+        queue.Queue: (queue_save, queue_load),
+        list: (sequence_save, sequence_load),
+        array.array: (sequence_save, sequence_load),
+        threading.Event: (event_save, event_load),
+    }
+
+    # `options` is set in the server process by `configure`, before the
+    # server is created, from the options given by `RemoteSyncManager`:
+    #   'names':       the names of the named objects of this server, see
+    #                  `namedobjects`.
+    #   'unixaddress': path of an AF_UNIX socket to listen on, in addition to
+    #                  the main (TCP) address.
+    #   'metrics':     True to record the `Metrics` of the requests served.
+    #   'transactions': the functions `transact` may call, by name.
+    #   'codec':       the `Codec` of the replies, None for plain pickle.
+    #   'codecs':      the `Codec` of the replies to given named objects, by
+    #                  name.
+    #   'engine':      'threads' for a thread per connection, as
+    #                  multiprocessing does, or 'selector' (see
+    #                  `ConnectionSelector`).
+    #   'replicaof':   for a read replica, the primary's shard 'addresses'
+    #                  and the shard of each replicated object, by name in
+    #                  'names' (see `ReplicaFeed`).
+    #   'staleness':   for a read replica, how many seconds it may lag
+    #                  behind the primary and still serve reads.
+    #   'persist':     the 'directory', file 'name' and snapshot 'interval'
+    #                  of the `Journal` of the named objects.
+    options = {}
+
+    @classmethod
+    def configure(cls, options):
+        cls.options = options
+
+    def __init__(self, registry, address, authkey, serializer):
+        super().__init__(registry, address, authkey, serializer)
+        self.objectlocks = {}
+        self.objectconditions = {}
+        self.lockdiagnostics = {}
+        self.workers = WorkerPool()
+        # The thread owned objects each thread served requests to.
+        self.local = threading.local()
+        self.versions = {}
+        self.keyversions = {}
+        self.resetversions = {}
+        self.subscribers = {}
+        self.feeds = {}
+        self.streams = {}
+        self.connections = 0
+        self.objectnames = {}
+        self.metrics = Metrics() if self.options.get('metrics') else None
+        self.codec = self.options.get('codec')
+        self.codecs = {}
+
+        Listener = mpm.listener_client[serializer][0]
+        self.extralisteners = []
+        unixaddress = self.options.get('unixaddress')
+        if unixaddress:
+            # A socket file left behind by a previous server would prevent
+            # the bind.
+            with contextlib.suppress(OSError):
+                if stat.S_ISSOCK(os.stat(unixaddress).st_mode):
+                    os.unlink(unixaddress)
+            self.extralisteners.append(Listener(address=unixaddress, family='AF_UNIX', backlog=16))
+        for listener in [self.listener] + self.extralisteners:
+            listener.codec = self.codec
+
+        self.engine = self.options.get('engine', 'threads')
+        if self.engine not in ('threads', 'selector'):
+            raise ValueError(f'unknown server engine {self.engine!r}')
+        self.selector = None
+        self.replica = None
+        self.journal = None
+
+    def accepter(self, listener=None):
+        '''
+        Accept connections on `listener`, and start a thread for each of
+        them (with the engine 'selector', hand them to the `WorkerPool`).
+        Called without `listener`, also start a thread accepting connections
+        for each of the `extralisteners`, and for a read replica its
+        `ReplicaFeed`. Persisted objects are restored first.
+        '''
+        if listener is None:
+            persist = self.options.get('persist')
+            if persist:
+                self.journal = Journal(self, **persist)
+                self.journal.start()
+            if self.engine == 'selector':
+                self.selector = ConnectionSelector(self)
+            replicaof = self.options.get('replicaof')
+            if replicaof:
+                self.replica = ReplicaFeed(self, replicaof['addresses'], replicaof['names'], self.options['staleness'])
+            for extralistener in self.extralisteners:
+                threading.Thread(target=self.accepter, args=(extralistener,), daemon=True).start()
+            listener = self.listener
+
+        while True:
+            try:
+                c = listener.accept()
+            except OSError:
+                continue
+            if self.selector:
+                self.workers.submit(self.handle_request, c)
+                continue
+            t = threading.Thread(target=self.handle_request, args=(c,))
+            t.daemon = True
+            t.start()
+
+    def accept_connection(self, c, name):
+        '''
+        Serve this connection, in a thread of its own, or with the engine
+        'selector' through the `ConnectionSelector`.
+        '''
+        if not self.selector:
+            self.connected(1)
+            try:
+                return super().accept_connection(c, name)
+            finally:
+                self.connected(-1)
+        self.connected(1)
+        c.send(('#RETURN', None))
+        # `handle_request` closes `c` once this returns, through SystemExit
+        # as after `serve_client`: the selector is given a copy of it.
+        conn = BufferConnection(os.dup(c.fileno()))
+        conn.codec = c.codec
+        self.selector.add(conn)
+        sys.exit(0)
+
+    def connected(self, delta):
+        with self.mutex:
+            self.connections += delta
+
+    def shutdown(self, c):
+        '''
+        Take a last snapshot of the persisted objects, then shut down.
+        '''
+        if self.journal:
+            try:
+                self.journal.snapshot()
+            except Exception:
+                mpm.util.info('snapshot failed: %s', traceback.format_exc())
+        super().shutdown(c)
+
+    def get_load(self, c):
+        '''
+        Return the number of proxy connections this server is serving.
+        '''
+        return self.connections
+
+    def create(self, c, typeid, /, *args, **kwds):
+        # Remember what each object is called, for the metrics: the name of
+        # a named object (registered as 'get_<name>'), the typeid otherwise.
+        # And the codec of the named objects which have one of their own.
+        ident, exposed = super().create(c, typeid, *args, **kwds)
+        name = self.objectnames[ident] = typeid[4:] if typeid.startswith('get_') else typeid
+        codec = self.options.get('codecs', {}).get(name)
+        if codec is not None:
+            self.codecs[ident] = codec
+        return ident, exposed
+
+    def create_many(self, c, typeids):
+        '''
+        Do what `create` does for each of `typeids` (without arguments), in a
+        single call, and return the list of `(ident, exposed)`.
+        '''
+        return [self.create(c, typeid) for typeid in typeids]
+
+    def namedobjects(self):
+        '''
+        Return the named objects of this server, by name. The 'get_' entries
+        of its registry are not all its own: the registry of the manager
+        class is that of all the `RemoteSyncManager`s of the process.
+        '''
+        return {name: self.registry['get_' + name][0]() for name in self.options.get('names', ())}
+
+    def snapshot(self, c, names=None):
+        '''
+        Return the state of the named objects `names` (all those of this
+        server by default) as `{name: {'type': ..., 'repr': ..., ...}}`, with
+        the fields of `states` for their type, and the version of versioned
+        objects.
+        '''
+        snapshot = {}
+        for name, obj in self.namedobjects().items():
+            if names is not None and name not in names:
+                continue
+
+            state = snapshot[name] = {'type': type(obj).__name__}
+            try:
+                state['repr'] = repr(obj)
+                for objtype in type(obj).__mro__:
+                    if objtype in self.states:
+                        state.update(self.states[objtype](obj))
+                        break
+                if isinstance(obj, self.versioned):
+                    state['version'] = self.versions.get('%x' % id(obj), 0)
+            except Exception as e:
+                state['error'] = repr(e)
+        return snapshot
+
+    def object_snapshot(self, obj, names=None):
+        '''
+        `snapshot`, requested through the proxy of any named object `obj`:
+        on a connection of the client, instead of one of its own.
+        '''
+        return self.snapshot(None, names)
+
+    def get_metrics(self, c):
+        '''
+        Return the `Metrics` of this server, None if it does not record them.
+        '''
+        return self.metrics
+
+    def get_codecs(self, c):
+        '''
+        Return the codecs of this server, with their counters, as
+        `{name: codec}`, None being the name of the server's own codec.
+        '''
+        codecs = dict(self.options.get('codecs', {}))
+        if self.codec is not None:
+            codecs[None] = self.codec
+        return codecs
+
+    def objectlock(self, obj):
+        '''
+        Return the lock which serializes the atomic operations on `obj`.
+        '''
+        try:
+            return self.objectlocks[id(obj)]
+        except KeyError:
+            with self.mutex:
+                return self.objectlocks.setdefault(id(obj), threading.Lock())
+
+    def objectcondition(self, obj):
+        '''
+        Return the condition, on the lock of `objectlock`, notified of the
+        changes of `obj` (see `changed`).
+        '''
+        try:
+            return self.objectconditions[id(obj)]
+        except KeyError:
+            lock = self.objectlock(obj)
+            with self.mutex:
+                return self.objectconditions.setdefault(id(obj), threading.Condition(lock))
+
+    def operation(self, obj, methodname):
+        '''
+        Return the server side operation `methodname` for `obj`, or None.
+        '''
+        ops = self.operations.get(methodname)
+        if ops:
+            for objtype in type(obj).__mro__:
+                if objtype in ops:
+                    if isinstance(ops[objtype], str):
+                        return getattr(self, ops[objtype])
+                    return ops[objtype]
+        return None
+
+    def lock_acquire(self, lock, holder, blocking=True, timeout=None, mode='write'):
+        '''
+        Acquire `lock`, a Lock, an RLock or an `RWLock` (for reading if
+        `mode` is 'read'), on behalf of `holder`, recording it in the
+        `LockDiagnostics` of the lock.
+        '''
+        diagnostics = self.lockdiagnostics.get(id(lock))
+        if diagnostics is None:
+            with self.mutex:
+                diagnostics = self.lockdiagnostics.setdefault(id(lock), LockDiagnostics())
+        start = diagnostics.waiting(holder, mode)
+        acquired = False
+        try:
+            if isinstance(lock, RWLock):
+                acquired = lock.acquire(mode, blocking, timeout)
+            else:
+                acquired = lock.acquire(blocking, -1 if timeout is None else timeout)
+        finally:
+            diagnostics.acquired(holder, mode, start, acquired)
+        return acquired
+
+    def lock_release(self, lock, holder, mode='write'):
+        if isinstance(lock, RWLock):
+            lock.release(mode)
+        else:
+            lock.release()
+        diagnostics = self.lockdiagnostics.get(id(lock))
+        if diagnostics is not None:
+            diagnostics.released(holder)
+
+    def get_locks(self, c):
+        '''
+        Return the `LockDiagnostics` info of the locks acquired so far, by
+        name for the named ones.
+        '''
+        # Not by `objectnames`: a named lock may have no proxy left.
+        names = {id(obj): name for name, obj in self.namedobjects().items()}
+        return {
+            names.get(key, '%x' % key): diagnostics.info()
+            for key, diagnostics in list(self.lockdiagnostics.items())
+        }
+
+    def transact(self, obj, funcname, names, kwds, holder=None):
+        '''
+        Call the transaction function `funcname` with the named objects
+        `names` themselves as arguments, followed by the keyword arguments
+        `kwds`, and return its result. `obj` is the object whose proxy made
+        the request, one of `names`.
+
+        For the duration of the call, the named Locks, RLocks and `RWLock`s
+        (for writing) among `names` are held on behalf of `holder` (see
+        `lock_acquire`), as are the object locks of the others, so that no
+        atomic operation nor any change of a Value, dict or Namespace (see
+        `serialized`) can interleave with the transaction. Changes made by
+        the function are not undone if it raises.
+        '''
+        try:
+            function = self.options.get('transactions', {})[funcname]
+        except KeyError:
+            raise ValueError(f'unknown transaction {funcname!r}') from None
+        objects = [self.registry['get_' + name][0]() for name in names]
+
+        namedlocks = {}
+        objectlocks = {}
+        for o in objects:
+            if isinstance(o, (type(threading.Lock()), type(threading.RLock()), RWLock)):
+                namedlocks[id(o)] = o
+            else:
+                lock = self.objectlock(o)
+                objectlocks[id(lock)] = lock
+
+        # Always in the same order, so that transactions cannot deadlock: the
+        # named locks first, which clients may hold across calls, then the
+        # object locks, which are only ever held for the duration of a call.
+        # Taking an object lock first would stall, for as long as a client
+        # holds a named lock, every write to that object, including the one
+        # which the client makes before releasing it.
+        holder = holder or f'transact/{funcname}'
+        with contextlib.ExitStack() as stack:
+            for ident in sorted(namedlocks):
+                self.lock_acquire(namedlocks[ident], holder)
+                stack.callback(self.lock_release, namedlocks[ident], holder)
+            for ident in sorted(objectlocks):
+                stack.enter_context(objectlocks[ident])
+            try:
+                return function(*objects, **kwds)
+            finally:
+                for o in objects:
+                    if isinstance(o, self.versioned):
+                        self.changed(o, None)
+                    elif self.journal and isinstance(o, mpm.Value):
+                        self.journal.record(o, o.get(), True)
+
+    def versioned_get(self, obj, key):
+        '''
+        Return the version of the dict or Namespace `obj`, together with the
+        value of `key` (or MISSING).
+        '''
+        mapping = obj if isinstance(obj, dict) else vars(obj)
+        return self.versions.get('%x' % id(obj), 0), mapping.get(key, MISSING)
+
+    def watch(self, obj, keys=None, since_version=None, timeout=None):
+        '''
+        Wait until one of `keys` (any key if None) of the dict or Namespace
+        `obj` changes after `since_version` (the current version if None), or
+        until `timeout` seconds have passed, and return the version of `obj`
+        with the changed entries, `{key: value}`, MISSING for deleted keys.
+
+        On timeout, the entries are empty and the version is that of the
+        last change. After a change of unknown keys (e.g. `clear`, or a
+        transaction), all the `keys` are returned, or all the entries.
+        '''
+        ident = '%x' % id(obj)
+        mapping = obj if isinstance(obj, dict) else vars(obj)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        condition = self.objectcondition(obj)
+        with condition:
+            version = self.versions.get(ident, 0)
+            if since_version is None:
+                since_version = version
+            while True:
+                if version > since_version:
+                    if self.resetversions.get(ident, 0) > since_version:
+                        changed = list(mapping) if keys is None else keys
+                    else:
+                        keyversions = self.keyversions.get(ident, {})
+                        if keys is None:
+                            changed = [key for key, v in keyversions.items() if v > since_version]
+                        else:
+                            changed = [key for key in keys if keyversions.get(key, 0) > since_version]
+                    if changed or keys is None:
+                        return version, {key: mapping.get(key, MISSING) for key in changed}
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return version, {}
+                condition.wait(remaining)
+                version = self.versions.get(ident, 0)
+
+    def changed(self, obj, keys):
+        '''
+        Record a change of `keys` (None for any key) in the dict or Namespace
+        `obj`, and notify the subscribers and watchers. Called with the
+        object's lock held.
+        '''
+        ident = '%x' % id(obj)
+        version = self.versions[ident] = self.versions.get(ident, 0) + 1
+        if keys is not None:
+            keys = list(keys)
+            keyversions = self.keyversions.setdefault(ident, {})
+            for key in keys:
+                keyversions[key] = version
+        else:
+            self.resetversions[ident] = version
+        for subscriber in self.subscribers.get(ident, ()):
+            subscriber.put((ident, keys, version))
+        feeds = self.feeds.get(ident)
+        if feeds or self.journal:
+            mapping = obj if isinstance(obj, dict) else vars(obj)
+            if keys is None:
+                changes = dict(mapping)
+            else:
+                changes = {key: mapping.get(key, MISSING) for key in keys}
+            for feed in feeds or ():
+                feed.put((ident, version, changes, keys is None, time.monotonic()))
+            if self.journal:
+                self.journal.record(obj, changes, keys is None)
+        condition = self.objectconditions.get(id(obj))
+        if condition is not None:
+            condition.notify_all()
+
+    def accept_invalidations(self, c, idents):
+        '''
+        Send the changes of the objects `idents` on this connection, as they
+        happen, as `(ident, keys, version)` messages.
+        '''
+        subscriber = queue.SimpleQueue()
+        with self.mutex:
+            for ident in idents:
+                self.subscribers[ident] = self.subscribers.get(ident, ()) + (subscriber,)
+        c.send(('#RETURN', None))
+
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    c.send(subscriber.get(timeout=1))
+                except queue.Empty:
+                    # The client only ever closes this connection.
+                    if c.poll():
+                        c.recv()
+        except (OSError, EOFError):
+            pass
+        finally:
+            with self.mutex:
+                for ident in idents:
+                    self.subscribers[ident] = tuple(s for s in self.subscribers[ident] if s is not subscriber)
+        sys.exit(0)
+
+    def accept_changes(self, c, idents, interval):
+        '''
+        Send the changes of the dicts and Namespaces `idents` on this
+        connection, in order, as `(ident, version, changes, reset, time)`
+        messages: `changes` maps the changed keys to their new value (or
+        MISSING), or is all the entries if `reset`. The first message of each
+        object is a reset. When there are no changes for `interval` seconds,
+        a `(None, None, None, None, time)` heartbeat is sent: `time` is
+        always one up to which all the changes were sent.
+        '''
+        feed = queue.SimpleQueue()
+        for ident in idents:
+            obj = self.id_to_obj[ident][0]
+            with self.objectlock(obj):
+                mapping = obj if isinstance(obj, dict) else vars(obj)
+                feed.put((ident, self.versions.get(ident, 0), dict(mapping), True, time.monotonic()))
+                with self.mutex:
+                    self.feeds[ident] = self.feeds.get(ident, ()) + (feed,)
+        c.send(('#RETURN', None))
+
+        try:
+            while not self.stop_event.is_set():
+                now = time.monotonic()
+                try:
+                    c.send(feed.get(timeout=interval))
+                except queue.Empty:
+                    # The replica only ever closes this connection.
+                    if c.poll():
+                        c.recv()
+                    c.send((None, None, None, None, now))
+        except (OSError, EOFError):
+            pass
+        finally:
+            with self.mutex:
+                for ident in idents:
+                    self.feeds[ident] = tuple(f for f in self.feeds[ident] if f is not feed)
+        sys.exit(0)
+
+    def stream(self, sid, once, window):
+        with self.mutex:
+            if sid not in self.streams:
+                self.streams[sid] = Stream(once, window)
+            return self.streams[sid]
+
+    def write_stream(self, c, sid, once, window):
+        '''
+        Receive the chunks of the stream `sid` on this connection, one per
+        message, until None, and return their number and total size. The
+        stream can be read meanwhile.
+        '''
+        stream = self.stream(sid, once, window)
+        try:
+            while True:
+                chunk = c.recv()
+                if chunk is None:
+                    break
+                stream.write(chunk)
+        except (OSError, EOFError) as e:
+            stream.close(repr(e))
+            raise
+        stream.close()
+        return stream.count, stream.size
+
+    def read_stream(self, c, sid, once, window):
+        '''
+        Send the chunks of the stream `sid` on this connection, one per
+        message, as they arrive, and return their number once it is closed.
+        A stream read `once` is then forgotten.
+        '''
+        stream = self.stream(sid, once, window)
+        count = 0
+        try:
+            for chunk in stream.read():
+                c.send(chunk)
+                count += 1
+        except BaseException as e:
+            # The writer of a stream read once would wait for ever for this
+            # reader to make room.
+            if once:
+                stream.close(f'reader failed: {e!r}')
+            raise
+        finally:
+            if once:
+                self.delete_stream(c, sid)
+        return count
+
+    def delete_stream(self, c, sid):
+        '''
+        Forget the stream `sid`, its writer and readers, if any, failing.
+        '''
+        with self.mutex:
+            stream = self.streams.pop(sid, None)
+        if stream is not None:
+            stream.close('deleted')
+
+    def receive(self, conn):
+        '''
+        Return the next message on `conn`, and its size in bytes.
+        '''
+        return conn.recv_sized()
+
+    def send(self, conn, msg, request=None):
+        '''
+        Send `msg`, the reply to `request`, on `conn` with the codec of the
+        object the request was made to, and return its size in bytes.
+        '''
+        codec = None
+        if self.codecs:
+            try:
+                codec = self.codecs.get(request[0])
+            except Exception:
+                pass
+        return conn.send(msg, codec)
+
+    def record(self, request, elapsed, msg, received, sent):
+        if self.metrics is not None:
+            try:
+                ident, methodname = request[0], request[1]
+            except Exception:
+                return
+            name = self.objectnames.get(ident, ident)
+            self.metrics.record(name, methodname, elapsed, msg[0] not in ('#RETURN', '#PROXY'), received, sent)
+
+    def serve_client(self, conn):
+        '''
+        Handle requests from the proxies in a particular process/thread
+        '''
+        mpm.util.debug('starting server thread to service %r',
+                       threading.current_thread().name)
+
+        while not self.stop_event.is_set():
+            if not self.serve_request(conn):
+                sys.exit(0)
+
+    def owns(self):
+        '''
+        Return True if the current thread holds one of the RLocks or
+        Conditions it served requests to: the next requests of the same
+        connection must then be served by this thread.
+        '''
+        owned = self.local.__dict__.get('owned')
+        if owned:
+            for obj in list(owned):
+                if not obj._is_owned():
+                    owned.discard(obj)
+        return bool(owned)
+
+    def disown(self):
+        '''
+        Release the RLocks and Conditions the current thread still holds,
+        those of a connection which closed without releasing them.
+        '''
+        for obj in self.local.__dict__.pop('owned', ()):
+            if obj._is_owned():
+                obj._release_save()
+
+    def serve_request(self, conn):
+        '''
+        Serve the next request on `conn`, return False if the connection is
+        done with, i.e. closed by the client or broken.
+        '''
+        try:
+            request, received = self.receive(conn)
+        except EOFError:
+            mpm.util.debug('got EOF -- exiting thread serving %r',
+                           threading.current_thread().name)
+            return False
+        except Exception:
+            request, received, elapsed = None, 0, 0
+            msg = ('#TRACEBACK', traceback.format_exc())
+        else:
+            start = time.perf_counter_ns()
+            msg = self.dispatch(conn, request)
+            elapsed = time.perf_counter_ns() - start
+
+        try:
+            try:
+                sent = self.send(conn, msg, request)
+            except Exception:
+                msg = ('#UNSERIALIZABLE', traceback.format_exc())
+                sent = self.send(conn, msg)
+        except Exception as e:
+            mpm.util.info('exception in thread serving %r',
+                          threading.current_thread().name)
+            mpm.util.info(' ... message was %r', msg)
+            mpm.util.info(' ... exception was %r', e)
+            conn.close()
+            return False
+
+        self.record(request, elapsed, msg, received, sent)
+        return True
+
+    def accept_pipelined(self, c, name):
+        '''
+        Serve this connection in pipelined mode: requests are tagged with a
+        request id `(reqid, (ident, methodname, args, kwds))`, executed
+        concurrently, and each reply `(reqid, msg)` is sent as soon as it is
+        ready, whatever the order of the requests.
+        '''
+        threading.current_thread().name = name
+        c.send(('#RETURN', None))
+        self.serve_pipelined(c)
+
+    def serve_pipelined(self, conn):
+        sendlock = threading.Lock()
+
+        def reply(reqid, request, received):
+            start = time.perf_counter_ns()
+            msg = self.dispatch(conn, request)
+            elapsed = time.perf_counter_ns() - start
+            sent = 0
+            with sendlock:
+                try:
+                    sent = self.send(conn, (reqid, msg), request)
+                except OSError as e:
+                    mpm.util.info('failure to send pipelined reply: %r', e)
+                except Exception:
+                    # The reply could not be pickled, nothing was sent yet.
+                    msg = ('#UNSERIALIZABLE', traceback.format_exc())
+                    sent = self.send(conn, (reqid, msg))
+            self.record(request, elapsed, msg, received, sent)
+
+        # The requests to RLocks and Conditions, which belong to the thread
+        # which acquired them, are served in order by a thread of this
+        # connection, started on the first of them.
+        owned = None
+
+        def serve_owned():
+            for args in iter(owned.get, None):
+                reply(*args)
+            self.disown()
+
+        while not self.stop_event.is_set():
+            try:
+                (reqid, request), received = self.receive(conn)
+            except EOFError:
+                mpm.util.debug('got EOF -- exiting thread serving %r',
+                               threading.current_thread().name)
+                if owned is not None:
+                    owned.put(None)
+                sys.exit(0)
+            if isinstance(self.id_to_obj.get(request[0], (None,))[0], self.threadowned):
+                if owned is None:
+                    owned = queue.SimpleQueue()
+                    threading.Thread(target=serve_owned, daemon=True).start()
+                owned.put((reqid, request, received))
+            else:
+                self.workers.submit(reply, reqid, request, received)
+
+    def dispatch(self, conn, request):
+        '''
+        Execute a single proxy request and return the reply message.
+        This follows multiprocessing.managers.Server.serve_client closely.
+        '''
+        methodname = obj = None
+        try:
+            ident, methodname, args, kwds = request
+            try:
+                obj, exposed, gettypeid = self.id_to_obj[ident]
+            except KeyError as ke:
+                try:
+                    obj, exposed, gettypeid = self.id_to_local_proxy_obj[ident]
+                except KeyError:
+                    raise ke
+
+            # A replica only serves reads, and only while it is up to date.
+            if self.replica and isinstance(obj, self.versioned):
+                if methodname not in self.replica.reads:
+                    return ('#ERROR', PermissionError(f'{methodname!r} refused by a read replica'))
+                if self.replica.stale():
+                    return ('#ERROR', StaleReplica(f'replica more than {self.replica.staleness}s behind'))
+
+            if isinstance(obj, self.threadowned):
+                self.local.__dict__.setdefault('owned', set()).add(obj)
+
+            function = self.operation(obj, methodname)
+            if function:
+                callargs = (obj,) + tuple(args)
+            else:
+                if methodname not in exposed:
+                    raise AttributeError(
+                        'method %r of %r object is not in exposed=%r' %
+                        (methodname, type(obj), exposed)
+                    )
+                function = getattr(obj, methodname)
+                callargs = args
+
+            try:
+                if methodname in self.serialized:
+                    with self.objectlock(obj):
+                        res = function(*callargs, **kwds)
+                        if methodname in mutations and isinstance(obj, self.versioned):
+                            self.changed(obj, mutations[methodname](args, kwds, res))
+                        elif self.journal and isinstance(obj, mpm.Value):
+                            self.journal.record(obj, obj.get(), True)
+                else:
+                    res = function(*callargs, **kwds)
+            except Exception as e:
+                return ('#ERROR', e)
+
+            typeid = gettypeid and gettypeid.get(methodname, None)
+            if typeid:
+                rident, rexposed = self.create(conn, typeid, res)
+                token = mpm.Token(typeid, self.address, rident)
+                return ('#PROXY', (rexposed, token))
+            return ('#RETURN', res)
+
+        except AttributeError:
+            if methodname is None:
+                return ('#TRACEBACK', traceback.format_exc())
+            try:
+                fallback_func = self.fallback_mapping[methodname]
+                result = fallback_func(self, conn, ident, obj, *args, **kwds)
+                return ('#RETURN', result)
+            except Exception:
+                return ('#TRACEBACK', traceback.format_exc())
+
+        except Exception:
+            return ('#TRACEBACK', traceback.format_exc())
+
+
+class QueueProxy(mpm.BaseProxy):
+    '''
+        Proxy for queue.Queue named objects. On top of the usual queue
+        methods, `put_many` and `get_many` move a whole batch of items in a
+        single round trip to the server.
+    '''
+    _exposed_ = ('empty', 'full', 'get', 'get_nowait', 'join', 'put',
+                 'put_nowait', 'qsize', 'task_done')
+
+    def empty(self):
+        return self._callmethod('empty')
+
+    def full(self):
+        return self._callmethod('full')
+
+    def qsize(self):
+        return self._callmethod('qsize')
+
+    def put(self, item, block=True, timeout=None):
+        return self._callmethod('put', (item, block, timeout))
+
+    def put_nowait(self, item):
+        return self._callmethod('put_nowait', (item,))
+
+    def get(self, block=True, timeout=None):
+        return self._callmethod('get', (block, timeout))
+
+    def get_nowait(self):
+        return self._callmethod('get_nowait')
+
+    def task_done(self):
+        return self._callmethod('task_done')
+
+    def join(self):
+        return self._callmethod('join')
+
+    def put_many(self, items, block=True, timeout=None):
+        '''
+        Put all `items` in one call. Returns the number of items put, which
+        is less than len(items) if the queue stayed full past `timeout`.
+        '''
+        return self._callmethod('put_many', (list(items), block, timeout))
+
+    def get_many(self, max_items, block=True, timeout=None):
+        '''
+        Get up to `max_items` items in one call. Blocks like `get` for the
+        first item only; returns an empty list instead of raising queue.Empty.
+        '''
+        return self._callmethod('get_many', (max_items, block, timeout))
+
+
+# Shared memory backed objects.
+#
+# With `sharedmemory=True`, the server replaces Value objects of a fixed size
+# type and array.array objects by the two classes below, which keep their
+# contents in a multiprocessing.shared_memory segment. Clients on the same host
+# as the server read and write the segment directly, bypassing the server;
+# other clients use the usual proxies, served from the same memory.
+
+# The struct format used for Values created with a python type as typecode.
+sharedvalueformats = {
+    int: 'q',
+    float: 'd',
+    bool: '?',
+}
+
+
+class SharedValue(mpm.Value):
+    '''
+        A multiprocessing.managers.Value stored in shared memory. Its `get`,
+        `set` and `value` are plain loads and stores into the segment. The
+        atomic `incr` and `compare_and_swap` are delegated to `proxy` (they
+        are atomic with respect to each other, not to direct stores).
+    '''
+
+    def __init__(self, typecode, fmt, shm, proxy=None):
+        self._typecode = typecode
+        self._struct = struct.Struct(fmt)
+        self._shm = shm
+        self._proxy = proxy
+
+    def get(self):
+        return self._struct.unpack_from(self._shm.buf)[0]
+
+    def set(self, value):
+        self._struct.pack_into(self._shm.buf, 0, value)
+
+    value = property(get, set)
+
+    def incr(self, delta=1):
+        return self._proxy.incr(delta)
+
+    add = incr
+
+    def compare_and_swap(self, expected, new):
+        return self._proxy.compare_and_swap(expected, new)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self._typecode!r}, {self.get()!r})'
+
+
+class SharedArray:
+    '''
+        A fixed size array.array stored in shared memory, supporting `len`,
+        indexing and slicing.
+    '''
+
+    def __init__(self, typecode, length, shm):
+        self.typecode = typecode
+        self._length = length
+        self._nbytes = length * array.array(typecode).itemsize
+        self._shm = shm
+
+    # The typed view of the segment is not kept, as the segment cannot be
+    # closed while a view of it exists.
+    def _view(self):
+        return self._shm.buf[:self._nbytes].cast(self.typecode)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        with self._view() as view:
+            if isinstance(index, slice):
+                return view[index].tolist()
+            return view[index]
+
+    def __setitem__(self, index, value):
+        with self._view() as view:
+            if isinstance(index, slice):
+                view[index] = array.array(self.typecode, value)
+            else:
+                view[index] = value
+
+    def tolist(self):
+        with self._view() as view:
+            return view.tolist()
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.typecode!r}, {self.tolist()!r})'
+
+
+RemoteSyncServer.states[SharedArray] = sized_state
+RemoteSyncServer.persisted[SharedArray] = (sequence_save, sequence_load)
+
+
+# The three proxies below add atomic read-modify-write operations, executed by
+# the server in a single round trip and without the need for a Lock.
+
+class ValueProxy(mpm.ValueProxy):
+    '''
+        Proxy for multiprocessing.managers.Value named objects, with atomic
+        `incr` (alias `add`) and `compare_and_swap`.
+    '''
+
+    def incr(self, delta=1):
+        '''Add `delta` to the value, return the new value.'''
+        return self._callmethod('incr', (delta,))
+
+    add = incr
+
+    def compare_and_swap(self, expected, new):
+        '''
+        Set the value to `new` if it equals `expected`, return a pair
+        (swapped, previous value).
+        '''
+        return self._callmethod('compare_and_swap', (expected, new))
+
+
+class DictProxy(mpm.DictProxy):
+    '''
+        Proxy for dict named objects, with atomic `incr` (alias `add`),
+        `setdefault_incr`, `incr_many`, `compare_and_swap`, `update_if` and
+        `pop_many`.
+        MISSING stands for an absent key in expected and previous values.
+        `watch` waits for changes, rather than polling.
+    '''
+
+    def incr(self, key, delta=1):
+        '''Add `delta` to an existing item, return its new value.'''
+        return self._callmethod('incr', (key, delta))
+
+    add = incr
+
+    def setdefault_incr(self, key, delta=1, default=0):
+        '''Add `delta` to an item, starting from `default` if absent.'''
+        return self._callmethod('setdefault_incr', (key, delta, default))
+
+    def incr_many(self, deltas, default=0):
+        '''
+        Add each of `deltas`, `{key: delta}`, to its item, starting from
+        `default` if absent, return the new values.
+        '''
+        return self._callmethod('incr_many', (dict(deltas), default))
+
+    def compare_and_swap(self, key, expected, new):
+        '''
+        Set the item to `new` if it equals `expected`, return a pair
+        (swapped, previous value).
+        '''
+        return self._callmethod('compare_and_swap', (key, expected, new))
+
+    def update_if(self, expected, updates):
+        '''
+        Apply `updates` if all the items in `expected` match, return True if
+        applied.
+        '''
+        return self._callmethod('update_if', (dict(expected), dict(updates)))
+
+    def pop_many(self, keys):
+        '''Remove `keys`, return a dict of the items actually removed.'''
+        return self._callmethod('pop_many', (list(keys),))
+
+    def watch(self, keys=None, since_version=None, timeout=None):
+        '''
+        Wait on the server until one of `keys` (any key if None) changes
+        after `since_version`, return a pair (version, changed items), MISSING
+        standing for deleted keys. See `RemoteSyncServer.watch`.
+        '''
+        return self._callmethod('watch', (None if keys is None else list(keys), since_version, timeout))
+
+
+class NamespaceProxy(mpm.NamespaceProxy):
+    '''
+        Proxy for Namespace named objects, with the same atomic operations as
+        `DictProxy`, applied to attributes. Note that attributes bearing the
+        name of one of these methods cannot be read through this proxy.
+    '''
+
+    def incr(self, name, delta=1):
+        '''Add `delta` to an existing attribute, return its new value.'''
+        return self._callmethod('incr', (name, delta))
+
+    add = incr
+
+    def setdefault_incr(self, name, delta=1, default=0):
+        '''Add `delta` to an attribute, starting from `default` if absent.'''
+        return self._callmethod('setdefault_incr', (name, delta, default))
+
+    def incr_many(self, deltas, default=0):
+        '''
+        Add each of `deltas`, `{name: delta}`, to its attribute, starting
+        from `default` if absent, return the new values.
+        '''
+        return self._callmethod('incr_many', (dict(deltas), default))
+
+    def compare_and_swap(self, name, expected, new):
+        '''
+        Set the attribute to `new` if it equals `expected`, return a pair
+        (swapped, previous value).
+        '''
+        return self._callmethod('compare_and_swap', (name, expected, new))
+
+    def update_if(self, expected, updates):
+        '''
+        Set the attributes in `updates` if all the attributes in `expected`
+        match, return True if applied.
+        '''
+        return self._callmethod('update_if', (dict(expected), dict(updates)))
+
+    def pop_many(self, names):
+        '''Delete attributes, return a dict of those actually deleted.'''
+        return self._callmethod('pop_many', (list(names),))
+
+    def watch(self, names=None, since_version=None, timeout=None):
+        '''
+        Wait on the server until one of the attributes `names` (any if None)
+        changes after `since_version`, return a pair (version, changed
+        attributes). See `RemoteSyncServer.watch`.
+        '''
+        return self._callmethod('watch', (None if names is None else list(names), since_version, timeout))
+
+
+# Publish/subscribe.
+#
+# A `Channel` is a named object of its own kind: a message published once is
+# delivered, inside the server, to the buffer of each of its subscribers, who
+# receive their messages in batches.
+
+class Channel:
+    '''
+        A publish/subscribe channel. Each message published is appended to
+        the buffer of every subscriber, of at most `maxsize` messages. When a
+        buffer is full, with the `policy` 'drop' its oldest message is
+        dropped; with 'block', publishing waits for room in all the buffers,
+        i.e. for the slowest subscriber.
+
+        With 'block', a subscriber which stops receiving without unsubscribing
+        (e.g. its process died) blocks all the publishers as soon as its
+        buffer is full, for ever unless `idle` is given: a subscriber whose
+        buffer is full, and which has not received for `idle` seconds, is
+        then evicted, i.e. unsubscribed, and counted in `stats`.
+
+        Each subscriber is known by its id, returned by `subscribe`. Its lag
+        is the number of messages waiting in its buffer and the age of the
+        oldest of them, see `stats`.
+    '''
+
+    policies = ('drop', 'block')
+
+    class Subscriber:
+        def __init__(self):
+            self.buffer = collections.deque()
+            self.received = self.dropped = 0
+            # The time from publication to reception, in nanoseconds.
+            self.latency = Histogram()
+            # The last time it subscribed or received, for `idle`.
+            self.seen = time.monotonic()
+
+    def __init__(self, maxsize=1000, policy='drop', idle=None):
+        if policy not in self.policies:
+            raise ValueError(f'unknown channel policy {policy!r}')
+        self.maxsize = maxsize
+        self.policy = policy
+        self.idle = idle
+        self.evicted = 0
+        self.lock = threading.Lock()
+        self.published = threading.Condition(self.lock)
+        self.consumed = threading.Condition(self.lock)
+        self.subscribers = {}
+        self.sids = itertools.count()
+        self.count = 0
+
+    def subscribe(self, name=None):
+        '''
+        Add a subscriber, named `name` or numbered, and return its id. It
+        receives the messages published from now on.
+        '''
+        with self.lock:
+            sid = str(next(self.sids)) if name is None else name
+            if sid in self.subscribers:
+                raise ValueError(f'subscriber {sid!r} already exists')
+            self.subscribers[sid] = self.Subscriber()
+            return sid
+
+    def unsubscribe(self, sid):
+        with self.lock:
+            self.subscribers.pop(sid, None)
+            self.published.notify_all()
+            self.consumed.notify_all()
+
+    def publish(self, item, block=True, timeout=None):
+        '''
+        Deliver `item` to all the subscribers, and return their number. With
+        the 'block' policy, raise queue.Full if some buffer stayed full until
+        `timeout`.
+        '''
+        delivered, subscribers = self._deliver([item], block, timeout)
+        if not delivered:
+            raise queue.Full
+        return subscribers
+
+    def publish_many(self, items, block=True, timeout=None):
+        '''
+        Deliver `items` in order, and return the number of items delivered,
+        which is less than len(items) if, with the 'block' policy, some
+        buffer stayed full until `timeout` (a deadline for the whole batch).
+        '''
+        return self._deliver(items, block, timeout)[0]
+
+    def _deliver(self, items, block, timeout):
+        '''
+        `publish_many`, returning the number of items delivered and that of
+        the subscribers they were delivered to, counted with the lock held.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        count = 0
+        with self.lock:
+            for item in items:
+                if self.policy == 'block':
+                    while True:
+                        full = [sid for sid, s in self.subscribers.items() if len(s.buffer) >= self.maxsize]
+                        if full and self.idle is not None:
+                            full = self._evict(full)
+                        if not full:
+                            break
+                        remaining = None if deadline is None else deadline - time.monotonic()
+                        if not block or (remaining is not None and remaining <= 0):
+                            return count, len(self.subscribers)
+                        if self.idle is not None:
+                            # Until the first of them may be evicted.
+                            wake = min(self.subscribers[sid].seen for sid in full) + self.idle - time.monotonic()
+                            remaining = wake if remaining is None else min(remaining, wake)
+                        self.consumed.wait(remaining)
+                now = time.monotonic_ns()
+                for subscriber in self.subscribers.values():
+                    if len(subscriber.buffer) >= self.maxsize:
+                        subscriber.buffer.popleft()
+                        subscriber.dropped += 1
+                    subscriber.buffer.append((now, item))
+                self.count += 1
+                count += 1
+                self.published.notify_all()
+            return count, len(self.subscribers)
+
+    def _evict(self, full):
+        '''
+        Unsubscribe those of the subscribers `full` idle for too long, and
+        return the others.
+        '''
+        now = time.monotonic()
+        kept = []
+        for sid in full:
+            if now - self.subscribers[sid].seen >= self.idle:
+                del self.subscribers[sid]
+                self.evicted += 1
+                self.published.notify_all()
+            else:
+                kept.append(sid)
+        return kept
+
+    def receive(self, sid, max_items=100, block=True, timeout=None):
+        '''
+        Wait for a first message of the subscriber `sid`, then return a list
+        of up to `max_items` of its messages, oldest first. The list is empty
+        if no message arrived before `timeout`.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while True:
+                subscriber = self.subscribers.get(sid)
+                if subscriber is None:
+                    raise ValueError(f'unknown subscriber {sid!r}, unsubscribed or evicted')
+                subscriber.seen = time.monotonic()
+                if subscriber.buffer:
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not block or (remaining is not None and remaining <= 0):
+                    return []
+                self.published.wait(remaining)
+
+            now = time.monotonic_ns()
+            items = []
+            for n in range(min(max_items, len(subscriber.buffer))):
+                published, item = subscriber.buffer.popleft()
+                subscriber.latency.record(now - published)
+                items.append(item)
+            subscriber.received += len(items)
+            if self.policy == 'block':
+                self.consumed.notify_all()
+            return items
+
+    def stats(self):
+        '''
+        Return the number of messages published and of subscribers evicted,
+        and for each subscriber the number of messages received, dropped and
+        `pending` (its lag), the age of the oldest pending message in
+        seconds, and the time from publication to reception.
+        '''
+        now = time.monotonic_ns()
+        with self.lock:
+            return {
+                'published': self.count,
+                'evicted': self.evicted,
+                'subscribers': {
+                    sid: {
+                        'received': s.received,
+                        'dropped': s.dropped,
+                        'pending': len(s.buffer),
+                        'oldest_s': (now - s.buffer[0][0]) / 1e9 if s.buffer else 0.0,
+                        'latency_us': s.latency.summary(),
+                    }
+                    for sid, s in self.subscribers.items()
+                },
+            }
+
+    def __repr__(self):
+        return f'<{type(self).__name__} subscribers={len(self.subscribers)} published={self.count} policy={self.policy!r}>'
+
+
+def channel_state(channel):
+    stats = channel.stats()
+    return {
+        'published': stats['published'],
+        'subscribers': len(stats['subscribers']),
+        'pending': max((s['pending'] for s in stats['subscribers'].values()), default=0),
+    }
+
+RemoteSyncServer.states[Channel] = channel_state
+
+
+class ChannelProxy(mpm.BaseProxy):
+    '''
+        Proxy for `Channel` named objects. `subscribe` returns a
+        `Subscription`, which receives the messages of that subscriber.
+    '''
+    _exposed_ = ('subscribe', 'unsubscribe', 'publish', 'publish_many',
+                 'receive', 'stats')
+
+    def subscribe(self, name=None):
+        return Subscription(self, self._callmethod('subscribe', (name,)))
+
+    def unsubscribe(self, sid):
+        return self._callmethod('unsubscribe', (sid,))
+
+    def publish(self, item, block=True, timeout=None):
+        return self._callmethod('publish', (item, block, timeout))
+
+    def publish_many(self, items, block=True, timeout=None):
+        '''
+        Publish all `items` in one call. Returns the number of items
+        published, see `Channel.publish_many`.
+        '''
+        return self._callmethod('publish_many', (list(items), block, timeout))
+
+    def receive(self, sid, max_items=100, block=True, timeout=None):
+        return self._callmethod('receive', (sid, max_items, block, timeout))
+
+    def stats(self):
+        return self._callmethod('stats')
+
+
+class Subscription:
+    '''
+        A subscriber of a `Channel`, e.g.:
+
+            with RS.ch.subscribe() as subscription:
+                while True:
+                    for message in subscription.receive(timeout=1):
+                        ...
+    '''
+
+    def __init__(self, channel, sid):
+        self.channel = channel
+        self.sid = sid
+
+    def receive(self, max_items=100, block=True, timeout=None):
+        return self.channel.receive(self.sid, max_items, block, timeout)
+
+    def close(self):
+        self.channel.unsubscribe(self.sid)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, val, tb):
+        self.close()
+
+    def __repr__(self):
+        return f'<{type(self).__name__} {self.sid!r} of {self.channel._token.typeid[4:]}>'
+
+
+# Task queues.
+#
+# A `TaskQueue` is a named object of its own kind, which hands out tasks to
+# workers in batches: a worker leases several tasks per round trip, and
+# acknowledges them once done, with its next request. Tasks whose lease
+# expires go back to the queue, and an idle worker takes over part of the
+# tasks leased by the busiest one.
+
+class TaskQueue:
+    '''
+        A queue of tasks leased to registered workers. A task leased to a
+        worker is its own for `lease` seconds: unless acknowledged by then,
+        it is put back at the head of the queue.
+
+        When the queue is empty, a worker asking for tasks steals the most
+        recently leased half of the tasks of the worker which holds the most,
+        those it is the least likely to have started. Either worker may end
+        up running a stolen task: the first to acknowledge it completes it,
+        and the other is told to drop it (see `lease`). Tasks are executed at
+        least once.
+    '''
+
+    class Worker:
+        def __init__(self, name):
+            self.name = name
+            # The ids of the tasks leased to this worker, oldest first.
+            self.leased = {}
+            # The ids of the tasks it should no longer run.
+            self.revoked = []
+            self.completed = self.stolen = 0
+            self.registered = time.monotonic()
+            # (time, count) of its acknowledgements over the last `window`.
+            self.acks = collections.deque()
+
+    # The period over which the throughput of the workers is measured.
+    window = 60.0
+
+    def __init__(self, lease=30.0):
+        self.lease_time = lease
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        self.tasks = {}
+        self.pending = collections.deque()
+        self.leases = {}
+        self.deadlines = []
+        self.workers = {}
+        self.ids = itertools.count(1)
+        self.wids = itertools.count()
+        self.counts = {'put': 0, 'completed': 0, 'expired': 0, 'stolen': 0}
+
+    def put(self, task):
+        '''
+        Queue `task`, and return its id.
+        '''
+        with self.lock:
+            return self._put(task)
+
+    def put_many(self, tasks):
+        '''
+        Queue `tasks` in order, and return the list of their ids.
+        '''
+        with self.lock:
+            return [self._put(task) for task in tasks]
+
+    def _put(self, task):
+        tid = next(self.ids)
+        self.tasks[tid] = task
+        self.pending.append(tid)
+        self.counts['put'] += 1
+        self.available.notify()
+        return tid
+
+    def qsize(self):
+        '''
+        Return the number of tasks not completed yet, leased or not.
+        '''
+        return len(self.tasks)
+
+    def register(self, name=None):
+        '''
+        Add a worker, named `name` or numbered, and return its id.
+        '''
+        with self.lock:
+            wid = str(next(self.wids)) if name is None else name
+            if wid in self.workers:
+                raise ValueError(f'worker {wid!r} already exists')
+            self.workers[wid] = self.Worker(wid)
+            return wid
+
+    def unregister(self, wid):
+        '''
+        Remove the worker `wid`, putting the tasks leased to it back.
+        '''
+        with self.lock:
+            worker = self.workers.pop(wid, None)
+            if worker:
+                self._requeue(list(worker.leased))
+
+    def _worker(self, wid):
+        try:
+            return self.workers[wid]
+        except KeyError:
+            raise ValueError(f'unknown worker {wid!r}') from None
+
+    def _requeue(self, tids):
+        for tid in reversed(tids):
+            wid, deadline = self.leases.pop(tid)
+            if wid in self.workers:
+                self.workers[wid].leased.pop(tid, None)
+            self.pending.appendleft(tid)
+        if tids:
+            self.available.notify(len(tids))
+
+    def _expire(self, now):
+        # `deadlines` is a heap of (deadline, tid), some of them outdated.
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, tid = heapq.heappop(self.deadlines)
+            lease = self.leases.get(tid)
+            if lease and lease[1] == deadline:
+                expired.append(tid)
+                if lease[0] in self.workers:
+                    self.workers[lease[0]].revoked.append(tid)
+        self.counts['expired'] += len(expired)
+        self._requeue(expired)
+
+    def _ack(self, worker, tids, now):
+        count = 0
+        for tid in tids:
+            if self.tasks.pop(tid, MISSING) is MISSING:
+                continue
+            lease = self.leases.pop(tid, None)
+            if lease and lease[0] != worker.name and lease[0] in self.workers:
+                # Completed by the worker it was stolen from, or the reverse.
+                holder = self.workers[lease[0]]
+                holder.leased.pop(tid, None)
+                holder.revoked.append(tid)
+            worker.leased.pop(tid, None)
+            count += 1
+        if count:
+            worker.completed += count
+            worker.acks.append((now, count))
+            self.counts['completed'] += count
+        while worker.acks and worker.acks[0][0] < now - self.window:
+            worker.acks.popleft()
+        return count
+
+    def _steal(self, worker, max_items):
+        victims = [w for w in self.workers.values() if w is not worker and len(w.leased) > 1]
+        if not victims:
+            return []
+        victim = max(victims, key=lambda w: len(w.leased))
+        count = min(max_items, len(victim.leased) // 2)
+        tids = list(victim.leased)[-count:]
+        for tid in tids:
+            del victim.leased[tid]
+        victim.revoked.extend(tids)
+        victim.stolen += count
+        self.counts['stolen'] += count
+        return tids
+
+    def lease(self, wid, max_items=1, acks=(), block=True, timeout=None):
+        '''
+        Acknowledge the tasks `acks`, done by the worker `wid`, then wait for
+        tasks, and lease up to `max_items` of them to `wid`. Return the list
+        of `(tid, task)` leased, empty if none came before `timeout`, and
+        the ids of the tasks leased to `wid` it should no longer run: stolen
+        by, or completed by, another worker, or whose lease expired.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            worker = self._worker(wid)
+            now = time.monotonic()
+            self._ack(worker, acks, now)
+            while True:
+                self._expire(now)
+                tids = []
+                while self.pending and len(tids) < max_items:
+                    tid = self.pending.popleft()
+                    if tid in self.tasks:
+                        tids.append(tid)
+                if not tids:
+                    tids = self._steal(worker, max_items)
+                if tids:
+                    break
+                remaining = None if deadline is None else deadline - now
+                if not block or (remaining is not None and remaining <= 0):
+                    break
+                if self.deadlines:
+                    expiry = self.deadlines[0][0] - now
+                    remaining = expiry if remaining is None else min(remaining, expiry)
+                self.available.wait(remaining)
+                now = time.monotonic()
+                worker = self._worker(wid)
+
+            expiry = now + self.lease_time
+            for tid in tids:
+                self.leases[tid] = (wid, expiry)
+                worker.leased[tid] = None
+                heapq.heappush(self.deadlines, (expiry, tid))
+            revoked, worker.revoked = worker.revoked, []
+            return [(tid, self.tasks[tid]) for tid in tids], revoked
+
+    def ack(self, wid, tids):
+        '''
+        Acknowledge the tasks `tids`, done by the worker `wid`. Return the
+        number of tasks completed, and the ids of those it should no longer
+        run, as `lease` does.
+        '''
+        with self.lock:
+            worker = self._worker(wid)
+            count = self._ack(worker, tids, time.monotonic())
+            revoked, worker.revoked = worker.revoked, []
+            return count, revoked
+
+    def release(self, wid, tids):
+        '''
+        Put the tasks `tids` leased to the worker `wid`, and not done, back at
+        the head of the queue.
+        '''
+        with self.lock:
+            self._requeue([tid for tid in tids if self.leases.get(tid, (None,))[0] == wid])
+
+    def stats(self):
+        '''
+        Return the counts of tasks put, completed, expired and stolen, the
+        number of tasks `pending` and `leased`, and for each worker the number
+        of tasks it holds, has completed, and had stolen, and its throughput
+        in tasks per second over the last `window` seconds.
+        '''
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            workers = {}
+            for wid, w in self.workers.items():
+                while w.acks and w.acks[0][0] < now - self.window:
+                    w.acks.popleft()
+                period = min(self.window, now - w.registered) or 1.0
+                workers[wid] = {
+                    'leased': len(w.leased),
+                    'completed': w.completed,
+                    'stolen': w.stolen,
+                    'throughput': sum(count for t, count in w.acks) / period,
+                }
+            return dict(self.counts,
+                pending=len(self.tasks) - len(self.leases),
+                leased=len(self.leases),
+                workers=workers,
+            )
+
+    def __repr__(self):
+        return f'<{type(self).__name__} tasks={len(self.tasks)} leased={len(self.leases)} workers={len(self.workers)}>'
+
+
+def taskqueue_state(tq):
+    stats = tq.stats()
+    return {
+        'pending': stats['pending'],
+        'leased': stats['leased'],
+        'completed': stats['completed'],
+        'workers': len(stats['workers']),
+    }
+
+def taskqueue_save(tq):
+    # The tasks not completed, leased ones included, the oldest first.
+    with tq.lock:
+        return [tq.tasks[tid] for tid in sorted(tq.tasks)]
+
+def taskqueue_load(tq, state):
+    tq.put_many(state)
+
+RemoteSyncServer.states[TaskQueue] = taskqueue_state
+RemoteSyncServer.persisted[TaskQueue] = (taskqueue_save, taskqueue_load)
+
+
+class TaskQueueProxy(mpm.BaseProxy):
+    '''
+        Proxy for `TaskQueue` named objects. `worker` registers a worker and
+        returns a `TaskWorker`, which leases tasks in batches.
+    '''
+    _exposed_ = ('put', 'put_many', 'qsize', 'register', 'unregister',
+                 'lease', 'ack', 'release', 'stats')
+
+    def put(self, task):
+        return self._callmethod('put', (task,))
+
+    def put_many(self, tasks):
+        return self._callmethod('put_many', (list(tasks),))
+
+    def qsize(self):
+        return self._callmethod('qsize')
+
+    def worker(self, name=None, prefetch=10):
+        return TaskWorker(self, self._callmethod('register', (name,)), prefetch)
+
+    def register(self, name=None):
+        return self._callmethod('register', (name,))
+
+    def unregister(self, wid):
+        return self._callmethod('unregister', (wid,))
+
+    def lease(self, wid, max_items=1, acks=(), block=True, timeout=None):
+        return self._callmethod('lease', (wid, max_items, list(acks), block, timeout))
+
+    def ack(self, wid, tids):
+        return self._callmethod('ack', (wid, list(tids)))
+
+    def release(self, wid, tids):
+        return self._callmethod('release', (wid, list(tids)))
+
+    def stats(self):
+        return self._callmethod('stats')
+
+
+class TaskWorker:
+    '''
+        A worker of a `TaskQueue`, which leases up to `prefetch` tasks at a
+        time and acknowledges them in batches, e.g.:
+
+            with RS.tasks.worker(prefetch=20) as worker:
+                for task in worker:
+                    run(task)
+
+        Iterating acknowledges each task once the next one is asked for, or
+        on `close` for the last one, e.g. after a `break` (but not if the
+        `with` block raised); with `get`, tasks are acknowledged by `ack`.
+        Acknowledgements are sent with the next lease, or as soon as half
+        the prefetched tasks are done, and tasks revoked by the queue
+        meanwhile (see `TaskQueue`) are dropped without being run.
+    '''
+
+    def __init__(self, queue, wid, prefetch):
+        self.queue = queue
+        self.wid = wid
+        self.prefetch = prefetch
+        self.buffer = collections.OrderedDict()
+        self.done = []
+        # The task handed out by the iteration, not acknowledged yet.
+        self.current = None
+
+    def get(self, block=True, timeout=None):
+        '''
+        Return the next task as `(tid, task)`, or None if no task came
+        before `timeout`.
+        '''
+        if len(self.done) >= max(1, self.prefetch // 2):
+            self.flush()
+        if not self.buffer:
+            tasks, revoked = self.queue.lease(self.wid, self.prefetch, self.done, block, timeout)
+            self.done = []
+            self.revoke(revoked)
+            self.buffer.update(tasks)
+            if not self.buffer:
+                return None
+        return self.buffer.popitem(last=False)
+
+    def ack(self, tid):
+        self.done.append(tid)
+
+    def revoke(self, tids):
+        for tid in tids:
+            self.buffer.pop(tid, None)
+
+    def flush(self):
+        '''
+        Send the acknowledgements not sent yet.
+        '''
+        if self.done:
+            count, revoked = self.queue.ack(self.wid, self.done)
+            self.done = []
+            self.revoke(revoked)
+
+    def __iter__(self):
+        while True:
+            tid, task = self.get()
+            self.current = tid
+            yield task
+            self.current = None
+            self.ack(tid)
+
+    def close(self, done=True):
+        '''
+        Acknowledge the tasks done, give back those not started, and
+        unregister. The task last handed out by the iteration is done, unless
+        `done` is False.
+        '''
+        tids = list(self.buffer)
+        if self.current is not None:
+            if done:
+                self.ack(self.current)
+            else:
+                tids.insert(0, self.current)
+            self.current = None
+        self.flush()
+        if tids:
+            self.queue.release(self.wid, tids)
+            self.buffer.clear()
+        self.queue.unregister(self.wid)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, val, tb):
+        self.close(done = typ is None)
+
+    def __repr__(self):
+        return f'<{type(self).__name__} {self.wid!r} of {self.queue._token.typeid[4:]}>'
+
+
+# Bounded caches.
+#
+# A `CacheDict` is a named object of its own kind: a dict which the server
+# keeps within bounds, evicting the least recently used entries and those
+# whose time to live is over.
+
+class CacheDict:
+    '''
+        A dict of at most `maxsize` entries and `maxbytes` bytes (the size of
+        a value being that of its pickle), either None for no bound. When an
+        entry is added beyond a bound, the least recently used entries are
+        evicted. An entry set with a `ttl` (by default the CacheDict's own)
+        expires that many seconds later.
+
+        Entries are counted as used when read (`in` included) or set. `stats`
+        counts the hits, misses, evictions and expirations.
+    '''
+
+    def __init__(self, maxsize=None, maxbytes=None, ttl=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key: (value, expiry or None, size), least recently used first.
+        self.entries = collections.OrderedDict()
+        # (expiry, key) of the entries with a ttl, some of them outdated.
+        self.expiries = []
+        self.bytes = 0
+        self.counts = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    def _entry(self, key, now):
+        # The entry of `key`, None if absent or expired.
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            self._remove(key)
+            self.counts['expirations'] += 1
+            entry = None
+        return entry
+
+    def _lookup(self, key, now):
+        entry = self._entry(key, now)
+        if entry is None:
+            self.counts['misses'] += 1
+            return MISSING
+        self.entries.move_to_end(key)
+        self.counts['hits'] += 1
+        return entry[0]
+
+    def _remove(self, key):
+        value, expiry, size = self.entries.pop(key)
+        self.bytes -= size
+        return value
+
+    def _set(self, key, value, ttl, now):
+        if key in self.entries:
+            self._remove(key)
+        ttl = self.ttl if ttl is None else ttl
+        expiry = None if ttl is None else now + ttl
+        size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)) if self.maxbytes is not None else 0
+        self.entries[key] = (value, expiry, size)
+        self.bytes += size
+        if expiry is not None:
+            heapq.heappush(self.expiries, (expiry, key))
+
+    def _evict(self, now):
+        while self.expiries and self.expiries[0][0] <= now:
+            expiry, key = heapq.heappop(self.expiries)
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] == expiry:
+                self._remove(key)
+                self.counts['expirations'] += 1
+        while self.entries and (
+            (self.maxsize is not None and len(self.entries) > self.maxsize) or
+            (self.maxbytes is not None and self.bytes > self.maxbytes)
+        ):
+            self._remove(next(iter(self.entries)))
+            self.counts['evictions'] += 1
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self._lookup(key, time.monotonic())
+        return default if value is MISSING else value
+
+    def __getitem__(self, key):
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        with self.lock:
+            return self._lookup(key, time.monotonic()) is not MISSING
+
+    def get_many(self, keys):
+        '''
+        Return `{key: value}` for those of `keys` present.
+        '''
+        now = time.monotonic()
+        found = {}
+        with self.lock:
+            for key in keys:
+                value = self._lookup(key, now)
+                if value is not MISSING:
+                    found[key] = value
+        return found
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl)
+
+    def __setitem__(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, items, ttl=None):
+        '''
+        Set the entries of `items`, a dict or pairs, all with the same `ttl`.
+        '''
+        items = items.items() if hasattr(items, 'items') else items
+        now = time.monotonic()
+        with self.lock:
+            for key, value in items:
+                self._set(key, value, ttl, now)
+            self._evict(now)
+
+    def pop(self, key, default=MISSING):
+        with self.lock:
+            if self._entry(key, time.monotonic()) is not None:
+                return self._remove(key)
+        if default is MISSING:
+            raise KeyError(key)
+        return default
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def keys(self):
+        with self.lock:
+            self._evict(time.monotonic())
+            return list(self.entries)
+
+    def __len__(self):
+        with self.lock:
+            self._evict(time.monotonic())
+            return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.expiries = []
+            self.bytes = 0
+
+    def stats(self):
+        '''
+        Return the counts of hits, misses, evictions and expirations, the
+        number of entries and their size, and the bounds.
+        '''
+        with self.lock:
+            self._evict(time.monotonic())
+            return dict(self.counts,
+                len=len(self.entries),
+                bytes=self.bytes,
+                maxsize=self.maxsize,
+                maxbytes=self.maxbytes,
+            )
+
+    def __repr__(self):
+        return f'<{type(self).__name__} len={len(self.entries)} maxsize={self.maxsize} maxbytes={self.maxbytes}>'
+
+
+def cachedict_state(cache):
+    stats = cache.stats()
+    return {key: stats[key] for key in ('len', 'bytes', 'hits', 'misses', 'evictions')}
+
+def cachedict_save(cache):
+    # The entries, least recently used first, with the time they have left.
+    now = time.monotonic()
+    with cache.lock:
+        return [
+            (key, value, None if expiry is None else expiry - now)
+            for key, (value, expiry, size) in cache.entries.items()
+        ]
+
+def cachedict_load(cache, state):
+    now = time.monotonic()
+    with cache.lock:
+        for key, value, ttl in state:
+            cache._set(key, value, ttl, now)
+        cache._evict(now)
+
+RemoteSyncServer.states[CacheDict] = cachedict_state
+RemoteSyncServer.persisted[CacheDict] = (cachedict_save, cachedict_load)
+
+
+class CacheDictProxy(mpm.BaseProxy):
+    '''
+        Proxy for `CacheDict` named objects.
+    '''
+    _exposed_ = ('get', '__getitem__', '__contains__', 'get_many', 'set',
+                 '__setitem__', 'set_many', 'pop', '__delitem__', 'keys',
+                 '__len__', 'clear', 'stats')
+
+    def get(self, key, default=None):
+        return self._callmethod('get', (key, default))
+
+    def __getitem__(self, key):
+        return self._callmethod('__getitem__', (key,))
+
+    def __contains__(self, key):
+        return self._callmethod('__contains__', (key,))
+
+    def get_many(self, keys):
+        return self._callmethod('get_many', (list(keys),))
+
+    def set(self, key, value, ttl=None):
+        return self._callmethod('set', (key, value, ttl))
+
+    def __setitem__(self, key, value):
+        return self._callmethod('__setitem__', (key, value))
+
+    def set_many(self, items, ttl=None):
+        items = dict(items) if hasattr(items, 'items') else list(items)
+        return self._callmethod('set_many', (items, ttl))
+
+    def pop(self, key, *default):
+        return self._callmethod('pop', (key,) + default)
+
+    def __delitem__(self, key):
+        return self._callmethod('__delitem__', (key,))
+
+    def keys(self):
+        return self._callmethod('keys')
+
+    def __len__(self):
+        return self._callmethod('__len__')
+
+    def clear(self):
+        return self._callmethod('clear')
+
+    def stats(self):
+        return self._callmethod('stats')
+
+
+# Locks.
+#
+# The named Locks get a `LockProxy`, and the named `RWLock`s, reader-writer
+# locks, an `RWLockProxy`: both acquire the lock on behalf of a holder, the
+# `UID` of the process and the name of the thread, which the
+# server keeps track of in the `LockDiagnostics` of the lock, to tell who
+# holds a lock, for how long, and who waits for it.
+
+def holder_id(ip=None):
+    '''
+    Return the holder id of the current thread: the `UID` of the process,
+    made of `ip` (by default `get_ip()`) and of the pid, and the name of the
+    thread. The pid is that of the caller, a child process forked with a
+    `RemoteSyncManager` does not hold locks on behalf of its parent.
+    '''
+    return f'{ip or get_ip()}-P{os.getpid()}/{threading.current_thread().name}'
+
+
+class LockDiagnostics:
+    '''
+        Who holds a lock of a `RemoteSyncServer` and since when, who waits
+        for it, and `Histogram`s of the time waited and held, in nanoseconds.
+    '''
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        # holder: [(mode, since)], a holder may hold an RWLock several times.
+        self.holders = {}
+        self.waiters = {}
+        self.wait = Histogram()
+        self.hold = Histogram()
+        self.acquisitions = self.failures = 0
+
+    def waiting(self, holder, mode):
+        now = time.perf_counter_ns()
+        with self.mutex:
+            self.waiters[holder] = (mode, now)
+        return now
+
+    def acquired(self, holder, mode, start, acquired):
+        now = time.perf_counter_ns()
+        with self.mutex:
+            self.waiters.pop(holder, None)
+            self.wait.record(now - start)
+            if acquired:
+                self.acquisitions += 1
+                self.holders.setdefault(holder, []).append((mode, now))
+            else:
+                self.failures += 1
+
+    def released(self, holder):
+        now = time.perf_counter_ns()
+        with self.mutex:
+            held = self.holders.get(holder)
+            if held:
+                mode, since = held.pop()
+                if not held:
+                    del self.holders[holder]
+                self.hold.record(now - since)
+
+    def info(self):
+        now = time.perf_counter_ns()
+        with self.mutex:
+            return {
+                'holders': {
+                    holder: [{'mode': mode, 'held_s': (now - since) / 1e9} for mode, since in held]
+                    for holder, held in self.holders.items()
+                },
+                'waiters': {
+                    holder: {'mode': mode, 'waited_s': (now - since) / 1e9}
+                    for holder, (mode, since) in self.waiters.items()
+                },
+                'acquisitions': self.acquisitions,
+                'failures': self.failures,
+                'wait_us': self.wait.summary(),
+                'hold_us': self.hold.summary(),
+            }
+
+
+class RWLock:
+    '''
+        A reader-writer lock: held by any number of readers at once, or by a
+        single writer. Who gets it first depends on the `policy`:
+          'writers': a waiting writer keeps new readers out (the default).
+          'readers': readers get in whenever no writer holds the lock, which
+                     may starve the writers.
+          'fair':    readers and writers get the lock in the order they asked
+                     for it, consecutive readers together.
+
+        It is not reentrant: a reader asking again for the lock while a
+        writer waits would wait for ever, but with the 'readers' policy.
+    '''
+
+    policies = ('writers', 'readers', 'fair')
+
+    def __init__(self, policy='writers'):
+        if policy not in self.policies:
+            raise ValueError(f'unknown lock policy {policy!r}')
+        self.policy = policy
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        # The (ticket, mode) of the waiting requests, oldest first.
+        self.queue = collections.deque()
+        self.tickets = itertools.count()
+        self.writers = 0
+
+    def _can(self, ticket, mode):
+        if self.writer:
+            return False
+        if mode == 'read':
+            if self.policy == 'writers':
+                return not self.writers
+            if self.policy == 'fair':
+                for t, m in self.queue:
+                    if t == ticket:
+                        return True
+                    if m == 'write':
+                        return False
+            return True
+        if self.readers:
+            return False
+        return self.policy != 'fair' or self.queue[0][0] == ticket
+
+    def acquire(self, mode='write', blocking=True, timeout=None):
+        '''
+        Acquire the lock for reading (`mode` 'read') or writing, and return
+        True, or False if it could not be before `timeout`.
+        '''
+        if mode not in ('read', 'write'):
+            raise ValueError(f'unknown lock mode {mode!r}')
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            request = (next(self.tickets), mode)
+            self.queue.append(request)
+            if mode == 'write':
+                self.writers += 1
+            try:
+                while not self._can(request[0], mode):
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if not blocking or (remaining is not None and remaining <= 0):
+                        return False
+                    self.condition.wait(remaining)
+                if mode == 'read':
+                    self.readers += 1
+                else:
+                    self.writer = True
+                return True
+            finally:
+                self.queue.remove(request)
+                if mode == 'write':
+                    self.writers -= 1
+                # Whoever waited behind this request may go.
+                self.condition.notify_all()
+
+    def release(self, mode='write'):
+        with self.condition:
+            if mode == 'read':
+                if not self.readers:
+                    raise RuntimeError('release of an RWLock not held for reading')
+                self.readers -= 1
+            else:
+                if not self.writer:
+                    raise RuntimeError('release of an RWLock not held for writing')
+                self.writer = False
+            self.condition.notify_all()
+
+    def __repr__(self):
+        return f'<{type(self).__name__} readers={self.readers} writer={self.writer} waiting={len(self.queue)} policy={self.policy!r}>'
+
+
+def rwlock_state(lock):
+    return {'readers': lock.readers, 'writer': lock.writer, 'waiting': len(lock.queue)}
+
+RemoteSyncServer.states[RWLock] = rwlock_state
+RemoteSyncServer.operations['acquire_as'][RWLock] = 'lock_acquire'
+RemoteSyncServer.operations['release_as'][RWLock] = 'lock_release'
+
+
+class LockProxy(mpm.AcquirerProxy):
+    '''
+        Proxy for Lock named objects, which acquires the lock on behalf of
+        `holder_id(self.ip)`.
+    '''
+    _exposed_ = ('acquire', 'release')
+    ip = None
+
+    def acquire(self, blocking=True, timeout=None):
+        return self._callmethod('acquire_as', (holder_id(self.ip), blocking, timeout))
+
+    def release(self):
+        return self._callmethod('release_as', (holder_id(self.ip),))
+
+
+class RWLockProxy(mpm.BaseProxy):
+    '''
+        Proxy for `RWLock` named objects. Used as a context manager, the lock
+        is held for writing; `read` and `write` return context managers for
+        either mode, e.g.:
+
+            with RS.rw.read():
+                ...
+    '''
+    _exposed_ = ('acquire', 'release')
+    ip = None
+
+    def acquire(self, mode='write', blocking=True, timeout=None):
+        return self._callmethod('acquire_as', (holder_id(self.ip), blocking, timeout, mode))
+
+    def release(self, mode='write'):
+        return self._callmethod('release_as', (holder_id(self.ip), mode))
+
+    @contextlib.contextmanager
+    def read(self):
+        self.acquire('read')
+        try:
+            yield self
+        finally:
+            self.release('read')
+
+    @contextlib.contextmanager
+    def write(self):
+        self.acquire('write')
+        try:
+            yield self
+        finally:
+            self.release('write')
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, typ, val, tb):
+        return self.release()
+
+
+# Streams.
+#
+# A large value is better not sent as a single message, which each end must
+# hold in memory whole: `RemoteSyncManager.stream` sends it to the server as
+# a stream of chunks, over a connection of its own, and returns a `StreamRef`,
+# small enough to be put in a queue or a dict. Whoever gets the reference
+# reads the chunks one at a time with `RemoteSyncManager.read_stream`.
+
+class StreamRef:
+    '''
+        The reference to a stream of chunks held by the shard `shard` of a
+        server. A stream read `once` is forwarded to its reader, chunk by
+        chunk, holding at most `window` chunks in the server. Other streams
+        are stored, to be read any number of times, until deleted.
+    '''
+
+    def __init__(self, sid, shard=0, once=False, window=8):
+        self.sid = sid
+        self.shard = shard
+        self.once = once
+        self.window = window
+
+    def __repr__(self):
+        return f'<{type(self).__name__} {self.sid} shard={self.shard}{" once" if self.once else ""}>'
+
+
+class Stream:
+    '''
+        The chunks of a stream, in the server. They are never joined: each is
+        kept as received until sent to a reader.
+    '''
+
+    def __init__(self, once, window):
+        self.once = once
+        self.window = window
+        self.chunks = collections.deque() if once else []
+        self.condition = threading.Condition()
+        self.closed = False
+        self.error = None
+        self.count = self.size = 0
+
+    def write(self, chunk):
+        with self.condition:
+            while self.once and len(self.chunks) >= self.window and not self.closed:
+                self.condition.wait()
+            # Closed by its reader or deleted: nobody will read the chunks.
+            if self.closed:
+                raise EOFError(f'stream closed: {self.error}')
+            self.chunks.append(chunk)
+            self.count += 1
+            self.size += len(chunk)
+            self.condition.notify_all()
+
+    def close(self, error=None):
+        with self.condition:
+            # The first error is the one to tell.
+            if self.error:
+                return
+            self.closed = True
+            self.error = error
+            if error:
+                # The readers are told, the chunks are of no use.
+                self.chunks.clear()
+            self.condition.notify_all()
+
+    def read(self):
+        '''
+        Yield the chunks as they arrive, until the stream is closed.
+        '''
+        index = 0
+        while True:
+            with self.condition:
+                while True:
+                    if self.once and self.chunks:
+                        chunk = self.chunks.popleft()
+                        self.condition.notify_all()
+                        break
+                    if not self.once and index < len(self.chunks):
+                        chunk = self.chunks[index]
+                        break
+                    if self.closed:
+                        if self.error:
+                            raise EOFError(f'stream interrupted: {self.error}')
+                        return
+                    self.condition.wait()
+            index += 1
+            yield chunk
+
+
+# Persistence.
+#
+# With the `persist` option of `RemoteSyncManager`, each shard keeps its named
+# objects in a directory: a snapshot of all of them, taken periodically, and
+# in between an append-only log of the changes of its dicts, Namespaces and
+# Values. A server started again with the same directory restores them before
+# serving its first request.
+
+class Journal:
+    '''
+        Persists the named objects of a `RemoteSyncServer` in `directory`, in
+        the files `<name>.snapshot` and `<name>.log.<generation>`.
+
+        The snapshot of generation N holds the state of the objects (see
+        `RemoteSyncServer.persisted`) taken after the log N was started, so
+        that restoring is loading the snapshot and replaying the logs from N
+        on. The changes logged are the new values, not the operations, which
+        makes replaying a change already in the snapshot harmless. Queues,
+        lists, arrays and Events are only saved in the snapshots, as are the
+        Values in shared memory, which clients write directly.
+
+        Each change is flushed to the log, written through by the operating
+        system even if the server process dies; only the snapshots are
+        synced to disk.
+    '''
+
+    def __init__(self, server, directory, name, interval):
+        self.server = server
+        self.directory = directory
+        self.name = name
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.log = None
+        self.generation = 0
+        self.objects = {
+            name: obj for name, obj in server.namedobjects().items()
+            if self.persister(obj)
+        }
+        self.names = {id(obj): name for name, obj in self.objects.items()}
+
+    def persister(self, obj):
+        for objtype in type(obj).__mro__:
+            if objtype in self.server.persisted:
+                return self.server.persisted[objtype]
+        return None
+
+    def path(self, suffix):
+        return os.path.join(self.directory, f'{self.name}.{suffix}')
+
+    def generations(self):
+        prefix = f'{self.name}.log.'
+        return sorted(
+            int(filename[len(prefix):]) for filename in os.listdir(self.directory)
+            if filename.startswith(prefix) and filename[len(prefix):].isdigit()
+        )
+
+    def start(self):
+        '''
+        Restore the objects, start a new generation and take a snapshot every
+        `interval` seconds from now on.
+        '''
+        self.restore()
+        self.snapshot()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while not self.server.stop_event.wait(self.interval):
+            try:
+                self.snapshot()
+            except Exception:
+                mpm.util.info('snapshot failed: %s', traceback.format_exc())
+
+    def restore(self):
+        generation, states = 0, {}
+        with contextlib.suppress(FileNotFoundError), open(self.path('snapshot'), 'rb') as f:
+            # Large snapshots are unpickled straight from the page cache.
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    generation, states = pickle.loads(m)
+        for name, state in states.items():
+            if name in self.objects:
+                obj = self.objects[name]
+                self.persister(obj)[1](obj, state)
+
+        generations = [g for g in self.generations() if g >= generation]
+        for g in generations:
+            with open(self.path(f'log.{g}'), 'rb') as log:
+                while True:
+                    try:
+                        name, changes, reset = pickle.load(log)
+                    except EOFError:
+                        break
+                    except pickle.UnpicklingError:
+                        # The end of a change being written when the server
+                        # stopped.
+                        mpm.util.info('truncated change in %s', log.name)
+                        break
+                    obj = self.objects.get(name)
+                    if obj is None:
+                        continue
+                    if isinstance(obj, self.server.versioned):
+                        apply_changes(obj, changes, reset)
+                    else:
+                        self.persister(obj)[1](obj, changes)
+        self.generation = max(generations + [generation])
+        mpm.util.info('restored %d objects from %s, generation %d', len(states), self.directory, self.generation)
+
+    def record(self, obj, changes, reset):
+        '''
+        Log a change of `obj`, with the object lock held: `changes` and
+        `reset` as in `apply_changes` for dicts and Namespaces, the new value
+        for Values.
+        '''
+        name = self.names.get(id(obj))
+        if name is None:
+            return
+        with self.lock:
+            pickle.dump((name, changes, reset), self.log, pickle.HIGHEST_PROTOCOL)
+            self.log.flush()
+
+    def snapshot(self):
+        '''
+        Start a new log, save the state of all the objects to a new snapshot,
+        which replaces the previous one, and remove the logs it makes useless.
+        '''
+        with self.lock:
+            previous = self.log
+            self.generation += 1
+            generation = self.generation
+            self.log = open(self.path(f'log.{generation}'), 'ab')
+        if previous:
+            previous.close()
+
+        states = {}
+        for name, obj in self.objects.items():
+            with self.server.objectlock(obj):
+                states[name] = self.persister(obj)[0](obj)
+
+        temporary = self.path('snapshot.tmp')
+        with open(temporary, 'wb') as f:
+            pickle.dump((generation, states), f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path('snapshot'))
+        for g in self.generations():
+            if g < generation:
+                os.unlink(self.path(f'log.{g}'))
+
+
+# Read replicas.
+#
+# With the `replicas` option of `RemoteSyncManager`, the server starts replica
+# processes, which serve reads of the `replicated` dicts and Namespaces. Each
+# replica follows the changes of these objects, streamed in order by the
+# primary (see `RemoteSyncServer.accept_changes`), and refuses to serve reads
+# when it lags behind by more than `staleness` seconds: the client then reads
+# from the primary. Replicas run on the primary's host, so that their clocks
+# can be compared.
+
+class StaleReplica(Exception):
+    pass
+
+
+class ReplicaFeed:
+    '''
+        Keeps the replicated objects of a replica server up to date: a
+        thread per shard of the primary receives the changes of the objects
+        `names` (a dict mapping their names to their shard) and applies them,
+        reconnecting whenever the connection to the primary is lost.
+    '''
+
+    # The methods a replica serves, those which do not modify an object.
+    reads = {
+        '__getitem__', 'get', '__contains__', '__len__', 'keys', 'values',
+        'items', 'copy', '__iter__', '__next__', '__getattribute__',
+        'versioned_get', '__str__', '__repr__', '#GETVALUE',
+    }
+
+    def __init__(self, server, addresses, names, staleness):
+        self.server = server
+        self.staleness = staleness
+        # Per shard, the time of the primary up to which its changes are
+        # applied, 0 while not connected.
+        self.synced = {}
+        shardnames = collections.defaultdict(list)
+        for name, shard in names.items():
+            shardnames[shard].append(name)
+        for shard, names in shardnames.items():
+            self.synced[shard] = 0
+            threading.Thread(target=self.follow, args=(shard, addresses[shard], names), daemon=True).start()
+
+    def stale(self):
+        return time.monotonic() - min(self.synced.values()) > self.staleness
+
+    def follow(self, shard, address, names):
+        while not self.server.stop_event.is_set():
+            try:
+                self.apply(shard, address, names)
+            except (OSError, EOFError):
+                mpm.util.info('replica lost the primary at %r, reconnecting', address)
+            self.synced[shard] = 0
+            time.sleep(1)
+
+    def apply(self, shard, address, names):
+        authkey = self.server.authkey
+        tokens = server_call(address, authkey, 'create_many', ['get_' + name for name in names])
+        try:
+            objects = {
+                ident: self.server.registry['get_' + name][0]()
+                for name, (ident, exposed) in zip(names, tokens)
+            }
+            conn = Client(address, authkey=authkey)
+            try:
+                mpm.dispatch(conn, None, 'accept_changes', (list(objects), self.staleness / 4))
+                while True:
+                    ident, version, changes, reset, timestamp = conn.recv()
+                    if ident is not None:
+                        obj = objects[ident]
+                        with self.server.objectlock(obj):
+                            apply_changes(obj, changes, reset)
+                            self.server.versions['%x' % id(obj)] = version
+                    self.synced[shard] = timestamp
+            finally:
+                conn.close()
+        finally:
+            # The references `create_many` added, unless the primary is gone
+            # and took them with it.
+            with contextlib.suppress(OSError, EOFError):
+                for ident, exposed in tokens:
+                    server_call(address, authkey, 'decref', ident)
+
+
+class ReplicatedDictProxy:
+    '''
+        Wraps the `DictProxy` of a replicated dict: reads go to `replica`,
+        the proxy of the same dict in a replica, unless it is stale or
+        unreachable; everything else goes to the primary.
+    '''
+
+    def __init__(self, proxy, replica):
+        self._proxy = proxy
+        self._replica = replica
+
+    def _read(self, methodname, *args):
+        try:
+            return getattr(self._replica, methodname)(*args)
+        except (StaleReplica, OSError, EOFError):
+            return getattr(self._proxy, methodname)(*args)
+
+    def __getattr__(self, name):
+        if name in ('get', 'keys', 'values', 'items', 'copy'):
+            return functools.partial(self._read, name)
+        return getattr(self._proxy, name)
+
+    def __getitem__(self, key):
+        return self._read('__getitem__', key)
+
+    def __contains__(self, key):
+        return self._read('__contains__', key)
+
+    def __len__(self):
+        return self._read('__len__')
+
+    def __setitem__(self, key, value):
+        self._proxy[key] = value
+
+    def __delitem__(self, key):
+        del self._proxy[key]
+
+    def __iter__(self):
+        return iter(self._read('keys'))
+
+    def __str__(self):
+        return str(self._proxy)
+
+    def __repr__(self):
+        return repr(self._proxy)
+
+
+class ReplicatedNamespaceProxy:
+    '''
+        Wraps the `NamespaceProxy` of a replicated Namespace: attribute reads
+        go to `replica`, like `ReplicatedDictProxy` does for items.
+    '''
+
+    def __init__(self, proxy, replica):
+        object.__setattr__(self, '_proxy', proxy)
+        object.__setattr__(self, '_replica', replica)
+
+    def __getattr__(self, name):
+        if name[0] == '_':
+            raise AttributeError(name)
+        if callable(getattr(type(self._proxy), name, None)):
+            return getattr(self._proxy, name)
+        try:
+            return getattr(self._replica, name)
+        except (StaleReplica, OSError, EOFError):
+            return getattr(self._proxy, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._proxy, name, value)
+
+    def __delattr__(self, name):
+        delattr(self._proxy, name)
+
+    def __str__(self):
+        return str(self._proxy)
+
+    def __repr__(self):
+        return repr(self._proxy)
+
+
+# Connection pooling.
+#
+# With the `pool` option of `RemoteSyncManager`, the proxies of a process share
+# a `ConnectionPool` per shard instead of opening a connection per thread, and
+# survive a restart of the server: a call which fails for want of a server is
+# retried, with a growing delay, on a new connection, once the proxy has been
+# re-resolved, i.e. has asked the server for the id of its named object again.
+
+class ConnectionPool:
+    '''
+        The connections to the server at `address`, shared by the threads of a
+        process: a call takes an idle connection, or opens one, and gives it
+        back once it has its reply. Up to `size` idle connections are kept,
+        opened in advance.
+
+        An idle connection has nothing to read, unless the server closed it:
+        such a connection is a sign that the server went away, the other
+        idle connections are dropped with it and `epoch` is incremented, so
+        that the proxies know to re-resolve their object.
+    '''
+
+    def __init__(self, address, authkey, size):
+        self.address = address
+        self.authkey = authkey
+        self.size = size
+        self.epoch = 0
+        self.lock = threading.Lock()
+        self.idle = collections.deque()
+        self.warm()
+        mp.util.register_after_fork(self, ConnectionPool.after_fork)
+
+    def connect(self):
+        # A connection of proxies, as `BaseProxy._connect` opens.
+        conn = Client(self.address, authkey=self.authkey)
+        mpm.dispatch(conn, None, 'accept_connection', ('pool',))
+        return conn
+
+    def warm(self):
+        with contextlib.suppress(OSError, EOFError):
+            while len(self.idle) < self.size:
+                self.idle.append(self.connect())
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn = self.idle.pop()
+            if not select.select([conn], [], [], 0)[0]:
+                return conn
+            conn.close()
+            self.failed()
+        return self.connect()
+
+    def release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def failed(self):
+        '''
+        Drop the idle connections, after one of them or a call failed.
+        '''
+        with self.lock:
+            idle, self.idle = self.idle, collections.deque()
+            self.epoch += 1
+        for conn in idle:
+            conn.close()
+
+    def after_fork(self):
+        # The connections belong to the parent process.
+        self.lock = threading.Lock()
+        self.idle = collections.deque()
+
+
+def pooled(proxy, name, manager):
+    '''
+    Return a `_callmethod` for the proxy of the named object `name`, going
+    through the `ConnectionPool` of its shard, which retries a call for up to
+    `manager.reconnect` seconds when the server cannot be reached.
+
+    A call retried after its connection failed may have been executed by
+    the server all the same: calls are executed at least once.
+    '''
+    pool = manager.pools[manager.placement[name]]
+    resolved = [pool.epoch]
+
+    def _callmethod(methodname, args=(), kwds={}):
+        deadline = None
+        delay = 0.01
+        while True:
+            try:
+                if resolved[0] != pool.epoch:
+                    epoch = pool.epoch
+                    manager.resolve(name)
+                    resolved[0] = epoch
+                conn = pool.acquire()
+                if resolved[0] != pool.epoch:
+                    # Taking the connection told that the server went away.
+                    pool.release(conn)
+                    continue
+                try:
+                    conn.send((proxy._id, methodname, args, kwds))
+                    kind, result = conn.recv()
+                except BaseException:
+                    conn.close()
+                    raise
+                pool.release(conn)
+                break
+            except (OSError, EOFError):
+                pool.failed()
+                now = time.monotonic()
+                deadline = deadline or now + manager.reconnect
+                if now + delay > deadline:
+                    raise
+                time.sleep(delay)
+                delay = min(2 * delay, 1.0)
+
+        if kind == '#RETURN':
+            return result
+        elif kind == '#PROXY':
+            # As multiprocessing.managers.BaseProxy does.
+            exposed, token = result
+            proxytype = proxy._manager._registry[token.typeid][-1]
+            token.address = proxy._token.address
+            child = proxytype(
+                token, proxy._serializer, manager=proxy._manager,
+                authkey=proxy._authkey, exposed=exposed
+            )
+            server_call(token.address, proxy._authkey, 'decref', token.id)
+            return child
+        raise mpm.convert_to_error(kind, result)
+
+    return _callmethod
+
+
+# Client side caches.
+#
+# With the `cache` option of `RemoteSyncManager`, reads of dict items and
+# Namespace attributes are served from a local cache, which the server keeps
+# up to date by sending the changes of these objects (see `mutations`).
+
+class ProxyCache:
+    '''
+        A bounded, least recently used, cache of the items of a dict or the
+        attributes of a Namespace, with hit/miss statistics.
+
+        Values are fetched together with the version of the object, and only
+        stored if no more recent change was notified in the meantime. A
+        notified change drops the keys it modifies. Until its
+        `InvalidationListener` is running (`enabled`), nothing is cached.
+    '''
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.version = 0
+        self.enabled = False
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def lookup(self, key):
+        '''
+        Return the cached value of `key` (possibly MISSING), or raise KeyError.
+        '''
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def store(self, key, version, value):
+        with self.lock:
+            if not self.enabled or version < self.version:
+                return
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys, version=None):
+        '''
+        Drop `keys` (all keys if None) changed at `version`, if known.
+        '''
+        with self.lock:
+            if version is not None and version > self.version:
+                self.version = version
+            if keys is None:
+                self.entries.clear()
+            else:
+                for key in keys:
+                    self.entries.pop(key, None)
+            self.invalidations += 1
+
+    def disable(self):
+        with self.lock:
+            self.enabled = False
+            self.entries.clear()
+
+    def info(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'enabled': self.enabled,
+            }
+
+
+class InvalidationListener:
+    '''
+        Subscribes to the changes of the objects cached by `caches` (a dict
+        mapping object ids to their `ProxyCache`), and applies them in a
+        thread of its own. If the connection is lost, the caches are disabled.
+    '''
+
+    def __init__(self, address, authkey, caches):
+        self.caches = caches
+        self.conn = Client(address, authkey=authkey)
+        mpm.dispatch(self.conn, None, 'accept_invalidations', (list(caches),))
+        for cache in caches.values():
+            cache.enabled = True
+        self.thread = threading.Thread(target=self.listen, daemon=True)
+        self.thread.start()
+
+    def listen(self):
+        try:
+            while True:
+                ident, keys, version = self.conn.recv()
+                self.caches[ident].invalidate(keys, version)
+        except (OSError, EOFError):
+            pass
+        finally:
+            for cache in self.caches.values():
+                cache.disable()
+
+    def close(self):
+        for cache in self.caches.values():
+            cache.disable()
+        self.conn.close()
+
+
+class CachedDictProxy:
+    '''
+        Wraps a `DictProxy`: `d[key]`, `d.get(key)` and `key in d` are served
+        from a `ProxyCache` when possible; everything else goes to the proxy,
+        changes made through this object being dropped from the cache at once.
+    '''
+
+    def __init__(self, proxy, cache):
+        self._proxy = proxy
+        self._cache = cache
+
+    def _fetch(self, key):
+        try:
+            return self._cache.lookup(key)
+        except KeyError:
+            version, value = self._proxy._callmethod('versioned_get', (key,))
+            self._cache.store(key, version, value)
+            return value
+
+    def _call(self, methodname, *args, **kwds):
+        result = None
+        try:
+            result = getattr(self._proxy, methodname)(*args, **kwds)
+            return result
+        finally:
+            self._cache.invalidate(mutations[methodname](args, kwds, result))
+
+    def __getattr__(self, name):
+        if name in mutations:
+            return functools.partial(self._call, name)
+        return getattr(self._proxy, name)
+
+    def __getitem__(self, key):
+        value = self._fetch(key)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self._fetch(key)
+        return default if value is MISSING else value
+
+    def __contains__(self, key):
+        return self._fetch(key) is not MISSING
+
+    def __setitem__(self, key, value):
+        self._call('__setitem__', key, value)
+
+    def __delitem__(self, key):
+        self._call('__delitem__', key)
+
+    def __len__(self):
+        return len(self._proxy)
+
+    def __iter__(self):
+        return iter(self._proxy)
+
+    def __str__(self):
+        return str(self._proxy)
+
+    def __repr__(self):
+        return repr(self._proxy)
+
+    def cache_info(self):
+        return self._cache.info()
+
+
+class CachedNamespaceProxy:
+    '''
+        Wraps a `NamespaceProxy`: attribute reads are served from a
+        `ProxyCache` when possible, like `CachedDictProxy` does for items.
+    '''
+
+    def __init__(self, proxy, cache):
+        object.__setattr__(self, '_proxy', proxy)
+        object.__setattr__(self, '_cache', cache)
+
+    _fetch = CachedDictProxy._fetch
+    _call = CachedDictProxy._call
+
+    def __getattr__(self, name):
+        if name[0] == '_':
+            raise AttributeError(name)
+        if callable(getattr(type(self._proxy), name, None)):
+            if name in mutations:
+                return functools.partial(self._call, name)
+            return getattr(self._proxy, name)
+        value = self._fetch(name)
+        if value is MISSING:
+            raise AttributeError(name)
+        return value
+
+    def __setattr__(self, name, value):
+        if name[0] == '_':
+            object.__setattr__(self, name, value)
+        else:
+            self._call('__setattr__', name, value)
+
+    def __delattr__(self, name):
+        if name[0] == '_':
+            object.__delattr__(self, name)
+        else:
+            self._call('__delattr__', name)
+
+    def __str__(self):
+        return str(self._proxy)
+
+    def __repr__(self):
+        return repr(self._proxy)
+
+    def cache_info(self):
+        return self._cache.info()
+
+
+# Write coalescing.
+#
+# An `Accumulator` (see `RemoteSyncManager.accumulator`) adds up in the
+# process the increments of a Value, or of the items of a dict or Namespace,
+# and sends their sum to the server from time to time, in a single `incr` or
+# `incr_many` round trip, rather than one per increment.
+
+class Accumulator:
+    '''
+        Buffers the increments of the Value, dict or Namespace `proxy`, and
+        flushes them to it every `interval` seconds, every `batch` increments,
+        on `flush` or `close`, and when the process exits. Increments which
+        could not be flushed are kept for the next flush.
+
+        The increments of a process are not seen by the others, nor by `get`
+        in this process, before they are flushed.
+    '''
+
+    def __init__(self, proxy, interval=1.0, batch=1000):
+        self._proxy = proxy
+        self.interval = interval
+        self.batch = batch
+        # A Value has a single total, under the key None.
+        self.keyed = hasattr(proxy, 'incr_many')
+        self.flushed = {}
+        self.flushes = 0
+        self._reset()
+        mp.util.register_after_fork(self, Accumulator._reset)
+
+    # Also run in a forked child, which must not send the increments of its
+    # parent again.
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._flushing = threading.Lock()
+        self._deltas = {}
+        self._count = 0
+        self._stop = threading.Event()
+        self._thread = None
+        # Neither this nor the thread keep the accumulator alive: the
+        # increments left are flushed when it is garbage collected too.
+        self._finalizer = mp.util.Finalize(
+            self, Accumulator._close, exitpriority=20,
+            args=(self._stop, self._flushing, self._lock, self._deltas, self._proxy, self.keyed),
+        )
+
+    def add(self, *args):
+        '''
+        Add to the total: `add(key, delta=1)` for a dict or Namespace,
+        `add(delta=1)` for a Value.
+        '''
+        if self.keyed:
+            key, delta = args if len(args) == 2 else (args[0], 1)
+        else:
+            key, delta = None, args[0] if args else 1
+        with self._lock:
+            self._deltas[key] = self._deltas.get(key, 0) + delta
+            self._count += 1
+            full = self._count >= self.batch
+            if self._thread is None and self.interval:
+                self._thread = threading.Thread(
+                    target=Accumulator._run, name='Accumulator', daemon=True,
+                    args=(weakref.ref(self), self._stop, self.interval),
+                )
+                self._thread.start()
+        if full:
+            self.flush()
+
+    incr = add
+
+    def flush(self):
+        '''
+        Send the buffered increments to the server, and return the totals
+        they were added to, `{key: total}` (key None for a Value).
+        '''
+        with self._flushing:
+            with self._lock:
+                # `_deltas` is emptied, not replaced: `_close` has it.
+                deltas = self._deltas.copy()
+                self._deltas.clear()
+                self._count = 0
+            if not deltas:
+                return {}
+            try:
+                totals = Accumulator._send(self._proxy, self.keyed, deltas)
+            except BaseException:
+                with self._lock:
+                    for key, delta in deltas.items():
+                        self._deltas[key] = delta + self._deltas.get(key, 0)
+                    self._count += len(deltas)
+                raise
+            self.flushes += 1
+            self.flushed.update(totals)
+            return totals
+
+    @staticmethod
+    def _send(proxy, keyed, deltas):
+        if keyed:
+            return proxy.incr_many(deltas)
+        return {None: proxy.incr(deltas[None])}
+
+    def get(self, key=None, flush=False, default=0):
+        '''
+        Return the total of `key` (None for a Value): by default the one the
+        last flush of this accumulator returned, or that of the server if it
+        never flushed `key`; with `flush=True`, the total after flushing.
+        '''
+        if flush:
+            self.flush()
+        try:
+            return self.flushed[key]
+        except KeyError:
+            if not self.keyed:
+                return self._proxy.get()
+            if isinstance(self._proxy, (mpm.DictProxy, CachedDictProxy, ReplicatedDictProxy)):
+                return self._proxy.get(key, default)
+            return getattr(self._proxy, key, default)
+
+    def pending(self):
+        '''Return the increments not flushed yet, `{key: delta}`.'''
+        with self._lock:
+            return dict(self._deltas)
+
+    @staticmethod
+    def _run(ref, stop, interval):
+        while not stop.wait(interval):
+            accumulator = ref()
+            if accumulator is None:
+                return
+            try:
+                accumulator.flush()
+            except Exception:
+                mpm.util.info('accumulator flush failed: %s', traceback.format_exc())
+            del accumulator
+
+    @staticmethod
+    def _close(stop, flushing, lock, pending, proxy, keyed):
+        # At exit, or once the accumulator is garbage collected.
+        stop.set()
+        with flushing:
+            with lock:
+                deltas = pending.copy()
+                pending.clear()
+            if deltas:
+                Accumulator._send(proxy, keyed, deltas)
+
+    def close(self):
+        '''Stop the periodic flushes, and flush.'''
+        self._stop.set()
+        self.flush()
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, val, tb):
+        self.close()
+
+    def __repr__(self):
+        return f'<{type(self).__name__} pending={len(self._deltas)} flushes={self.flushes}>'
+
+
+class NamedObjects(dict):
+    '''
+        The `object` dict of a `RemoteSyncManager`, which maps the names of
+        the named objects to their proxy: a name not used yet is materialized
+        when looked up.
+    '''
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    def __missing__(self, name):
+        if name in self.manager.unmaterialized:
+            return self.manager.materialize(name)
+        raise KeyError(name)
+
+
 class RemoteSyncManager:
     '''
         `class RemoteSyncManager:` provides an easier interface to work with
@@ -78,6 +4353,91 @@ class RemoteSyncManager:
         It should be noted that managed objects do NOT play well within a
         Namespace.
 
+        Queues get a `QueueProxy`, which adds `put_many` and `get_many` to
+        move a batch of items in a single round trip. Values, dicts and
+        Namespaces get proxies with atomic operations (`incr`,
+        `compare_and_swap`, ...) executed by the server, e.g.
+        `remotesyncmgr.myvalue.incr(5)` needs neither a lock nor a second
+        round trip.
+
+        A `Channel` named object, e.g. `('mychannel', Channel(maxsize=100))`,
+        delivers each message published to all its subscribers, in a single
+        round trip. A `TaskQueue` named object hands out tasks to workers in
+        batches, with leases, acknowledgements and work stealing. A
+        `CacheDict` named object, e.g. `CacheDict(maxsize=10000, ttl=60)`, is
+        a dict kept within bounds by the server, which evicts its least
+        recently used or expired entries. An `RWLock` named object, e.g.
+        `RWLock(policy='fair')`, is a reader-writer lock, used as `with
+        RS.rw.read():` or `with RS.rw.write():`. The server records who holds
+        its locks and who waits for them, see `lock_stats`.
+
+        Counters updated very often are better updated through an
+        `accumulator`, which adds up the increments in the process and sends
+        their sum from time to time, in a single round trip.
+
+        With `sharedmemory=True`, numeric Values and array.array objects are
+        kept in shared memory segments (see `share_memory`): processes on the
+        server's host read and write them directly, without a round trip.
+
+        With `unixsocket=True` (or a path), the server also listens on an
+        AF_UNIX socket, which processes on the server's host use instead of
+        TCP.
+
+        With e.g. `cache={'mydict': 1000}`, reads of `mydict` items are
+        served from a local cache, invalidated by the server whenever an item
+        changes (see `use_cache`).
+
+        Functions given as `transactions` can be run by the server, with
+        several named objects at once, in a single round trip (see
+        `transact`).
+
+        With `metrics=True`, the server and its clients record the calls to
+        each named object: see `stats` and `metrics_text`.
+
+        With e.g. `codec=Codec(compress=4096)`, all the messages of the server
+        and its clients larger than 4 KiB are compressed, and with
+        `codecs={'q1': Codec('plain', compress=512)}` those to and from `q1`
+        are encoded as plain data and compressed above 512 bytes. See `Codec`
+        and `codec_stats`.
+
+        The proxy of a named object is only created when the object is first
+        used (see `materialize`), or all at once with `lazy=False`. With
+        `bulk=True`, the ids of all the named objects are fetched in a single
+        call per shard, after which creating a proxy costs no round trip.
+
+        By default, like any multiprocessing manager, the server has a thread
+        per connection, i.e. per thread of each client process using the
+        objects. With `engine='selector'`, a single thread waits on all the
+        connections, and threads are only busy while serving a request (see
+        `ConnectionSelector`), which suits many mostly idle clients.
+
+        With e.g. `shards=4`, the named objects are spread over 4 server
+        processes, by `placement` (e.g. `placement={'q1': 0, 'q2': 0}`) or by
+        a hash of their name, so that requests to objects on different shards
+        are served in parallel. `remotesyncmgr.myqueue` is used the same way
+        whichever shard it is on.
+
+        With e.g. `replicas=2, replicated=['mydict']`, two more server
+        processes hold copies of `mydict`, kept up to date by the shards, and
+        serve the reads of `mydict` by the clients while they lag behind by
+        less than `staleness` seconds; writes still go to the shard (see
+        `use_replicas`).
+
+        With e.g. `persist='/var/lib/myapp'`, the contents of the named
+        objects are kept in that directory (see `Journal`): a server started
+        again with the same directory gets them back, and listens on the same
+        ports as before if it can, so that the server data file it writes is
+        the same as that of the clients.
+
+        Large values are best sent as a stream of chunks, which is never held
+        in memory whole (see `stream`): the `StreamRef` to it is what goes in
+        a queue or a dict.
+
+        With e.g. `pool=4`, the proxies of all the threads of a process share
+        4 connections per shard, opened in advance (see `ConnectionPool`),
+        and when the server restarts, their calls are retried on a new
+        connection for up to `reconnect` seconds, rather than failing.
+
         To use this class, declare an object, associated with a filename and a
         list of named objects, let's call this object `remotesyncmgr`.
         The named objects are used with dot-notation of the local variable
@@ -96,11 +4456,65 @@ class RemoteSyncManager:
     '''
 
     class syncmanager(mpm.SyncManager):
-        pass
+        _Server = RemoteSyncServer
 
-    def __init__(self, serverdatafilename, authkey, namedobjects = None):
+        # See `BufferConnection`.
+        def __init__(self, address=None, authkey=None, serializer='pickle5', **kwds):
+            super().__init__(address, authkey, serializer, **kwds)
+
+    # The class `ContextWrap` is used to wrap the LockProxy object because
+    # it does not provide the context handling, at least not in python 3.6.
+    # I could have patched it, but I preferred a wrapper as a quick fix.
+    # This class works hand in hand with the dictionary `contextwrapmap`
+    # which matches the object type with the `__entry__` and `__exit__`
+    # context functions. Matching objects are stored in the `contextwrap`
+    # dictionary. The other attributes are those of the wrapped object, e.g.
+    # `read` of an `RWLockProxy`.
+    class ContextWrap:
+        def __init__(self, obj, enter, exit):
+            self.__obj = obj
+            self.__enter = getattr(obj, enter)
+            self.__exit = getattr(obj, exit)
+        def __enter__(self):
+            self.__enter()
+        def __exit__(self, typ, val, tb):
+            self.__exit()
+        def __getattr__(self, name):
+            if name.startswith('_ContextWrap__'):
+                raise AttributeError(name)
+            return getattr(self.__obj, name)
+
+    def __init__(self, serverdatafilename, authkey, namedobjects = None, sharedmemory = False, unixsocket = None, cache = None, shards = 1, placement = None, metrics = False, lazy = True, bulk = False, transactions = None, codec = None, codecs = None, engine = 'threads', replicas = 0, replicated = None, staleness = 1.0, persist = None, snapshotinterval = 60.0, pool = 0, reconnect = 30.0):
         # If namedobjects is defined, we start the server side
         # Otherwise we start the client side
+        # `sharedmemory` is a server side option, see `share_memory`.
+        # `unixsocket` is a server side option: True, or the path of an
+        # AF_UNIX socket on which the server listens in addition to TCP.
+        # `cache` maps the names of dict and Namespace objects to the size of
+        # their local cache, see `use_cache`.
+        # `shards` is a server side option: the number of server processes
+        # the named objects are spread over, by `placement[name]` if given,
+        # by `shard_of(name, shards)` otherwise.
+        # `metrics` is a server side option: True to record call metrics in
+        # the server and in all its clients, see `stats`.
+        # `lazy` and `bulk` decide when proxies are created, see `materialize`.
+        # `transactions` is a server side option: the functions `transact`
+        # may call, as a list or a dict by name.
+        # `codec` and `codecs` are server side options: the `Codec` of all
+        # the messages, and those of given named objects, by name.
+        # `engine` is a server side option: 'threads' or 'selector', see
+        # `RemoteSyncServer.options`.
+        # `replicas`, `replicated` and `staleness` are server side options:
+        # the number of read replicas of the dicts and Namespaces named in
+        # `replicated`, and how many seconds they may lag behind, see
+        # `use_replicas`.
+        # `persist` and `snapshotinterval` are server side options: the
+        # directory where the named objects are kept, and how often they are
+        # snapshotted, see `Journal`.
+        # `pool` is the number of connections per shard kept open for the
+        # proxies of this process, 0 for a connection per thread, and
+        # `reconnect` for how many seconds these proxies try to reach a
+        # server which went away, see `pooled`.
 
         # Classes register with multiprocessing.managers.SyncManager:
         #
@@ -226,22 +4640,6 @@ class RemoteSyncManager:
         def retobj(obj):
             return lambda: obj
 
-        # The class `ContextWrap` is used to wrap the LockProxy object because
-        # it does not provide the context handling, at least not in python 3.6.
-        # I could have patched it, but I preferred a wrapper as a quick fix.
-        # This class works hand in hand with the dictionary `contextwrapmap`
-        # which matches the object type with the `__entry__` and `__exit__`
-        # context functions. Matching objects are stored in the `contextwrap`
-        # dictionary.
-        class ContextWrap:
-            def __init__(self, obj, enter, exit):
-                self.__enter = getattr(obj, enter)
-                self.__exit = getattr(obj, exit)
-            def __enter__(self):
-                self.__enter()
-            def __exit__(self, typ, val, tb):
-                self.__exit()
-
         # `proxymap` is used to automatically identify the right proxy to each
         # named object.
         proxymap = {}
@@ -249,6 +4647,20 @@ class RemoteSyncManager:
             if objprops[0]:
                 proxymap[objprops[0]] = objprops[3]
 
+        # Some types get a proxy of our own, which knows about the server side
+        # `operations` of `RemoteSyncServer`.
+        proxymap[queue.Queue] = QueueProxy
+        proxymap[mpm.Value] = ValueProxy
+        proxymap[dict] = DictProxy
+        proxymap[mpm.Namespace] = NamespaceProxy
+        proxymap[SharedValue] = ValueProxy
+        proxymap[SharedArray] = mpm.ArrayProxy
+        proxymap[Channel] = ChannelProxy
+        proxymap[TaskQueue] = TaskQueueProxy
+        proxymap[CacheDict] = CacheDictProxy
+        proxymap[type(threading.Lock())] = LockProxy
+        proxymap[RWLock] = RWLockProxy
+
         # `exposedmap` is presently unused, it was an attempt to publish the
         # missing Lock attributes in the proxy, but clearly based on an
         # incorrect understanding of Lock proxies.
@@ -273,6 +4685,7 @@ class RemoteSyncManager:
         # See note with `ContextWrap` above.
         contextwrapmap = {
             type(threading.Lock()): ('acquire', 'release'),
+            RWLock: ('acquire', 'release'),
         }
 
         # The `formatmap` is used to identify those namedobjects which
@@ -281,26 +4694,52 @@ class RemoteSyncManager:
         formatmap = {
             queue.Queue:      'queue',
             threading.Event:  'event',
+            Channel:          'channel',
+            TaskQueue:        'taskqueue',
         }
 
         self.attributesmapping = {}
         self.contextwrap = {}
         self.formats = {}
+        self.sharedmemory = {}
+        self.serverinfo = {'sharedmemory': {}}
 
         self.isServer = False
+        self.authkey = authkey
         self.IP = get_ip()
         self.PID = mp.current_process().pid
         self.UID = self.IP + f'-P{self.PID}'
         self.shortID = ('S' if self.isServer else 'c') + chr(33 + self.PID % 94) + chr(33 + ip2int(self.IP) % 94) + self.IP[-2:]
+        self.host = (socket.gethostname(), self.IP)
 
         if namedobjects:
             self.isServer = True
             self.clientobjects = []
 
+            # Each shard is a server of its own, with a registry of its own
+            # holding only its objects: a subclass of `syncmanager` per shard,
+            # the registry being copied before it is first added to.
+            placement = placement or {}
+            self.placement = {}
+            if shards == 1:
+                self.syncmanagers = [self.syncmanager]
+            else:
+                self.syncmanagers = [
+                    type(f'syncmanager{n}', (self.syncmanager,), {'_registry': self.syncmanager._registry.copy()})
+                    for n in range(shards)
+                ]
+
             for objdesc in namedobjects:
+                name = objdesc[0]
+                self.placement[name] = placement.get(name, shard_of(name, shards))
+                syncmanager = self.syncmanagers[self.placement[name]]
+
                 if len(objdesc) == 2:
                     (name, obj) = objdesc
 
+                    if sharedmemory:
+                        obj = self.share_memory(name, obj)
+
                     objtype = type(obj)
                     if objtype in attributesmap:
                         self.attributesmapping[name] = attributesmap[objtype]
@@ -316,17 +4755,17 @@ class RemoteSyncManager:
                             self.clientobjects.append(
                                 (name, proxytype, exposed)
                             )
-                            self.syncmanager.register(
+                            syncmanager.register(
                                 'get_' + name, callable=retobj(obj),
                                 proxytype=proxytype,
                                 exposed=exposed
                             )
                         else:
                             self.clientobjects.append((name, proxytype))
-                            self.syncmanager.register('get_' + name, callable=retobj(obj), proxytype=proxytype)
+                            syncmanager.register('get_' + name, callable=retobj(obj), proxytype=proxytype)
                     else:
                         self.clientobjects.append((name,))
-                        self.syncmanager.register('get_' + name, callable=retobj(obj))
+                        syncmanager.register('get_' + name, callable=retobj(obj))
                 elif len(objdesc) == 3:
                     (name, obj, proxytype) = objdesc
                     objtype = type(obj)
@@ -336,38 +4775,115 @@ class RemoteSyncManager:
                         self.contextwrap[name] = contextwrapmap[objtype]
 
                     self.clientobjects.append((name, proxytype))
-                    self.syncmanager.register('get_' + name, callable=retobj(obj), proxytype=proxytype)
+                    syncmanager.register('get_' + name, callable=retobj(obj), proxytype=proxytype)
 
-            self.server = self.syncmanager(address = ('', 0), authkey = authkey)
-            self.server.start()
+            self.serverinfo['host'] = self.host
+            self.serverinfo['placement'] = self.placement
+            self.serverinfo['metrics'] = metrics
 
-            if serverdatafilename:
-                self.serveraddress = (self.IP, self.server.address[1])
-                with open(serverdatafilename, 'wb') as serverdata_file:
-                    pickle.dump((self.serveraddress, self.clientobjects, self.attributesmapping, self.contextwrap, self.formats), serverdata_file, pickle.HIGHEST_PROTOCOL)
+            transactions = transactions or {}
+            if not isinstance(transactions, dict):
+                transactions = {function.__name__: function for function in transactions}
+            self.serverinfo['transactions'] = sorted(transactions)
 
-            for objdesc in self.clientobjects:
-                name = objdesc[0]
+            codecs = codecs or {}
+            for name in codecs:
+                if name not in self.placement:
+                    raise ValueError(f'codec given for {name!r}, which is not a named object')
+            self.serverinfo['codec'] = codec
+            self.serverinfo['codecs'] = codecs
+            self.serverinfo['addresses'] = []
 
-                if name in self.contextwrap:
-                    setattr(self, '__context_wrapped__'+name, getattr(self.server, 'get_' + name)())
-                    setattr(self, name, ContextWrap(
-                        getattr(self, '__context_wrapped__'+name),
-                        self.contextwrap[name][0],
-                        self.contextwrap[name][1],
-                    ))
+            if unixsocket is True:
+                unixsocket = mpc.arbitrary_address('AF_UNIX')
 
-                else:
-                    setattr(self, name, getattr(self.server, 'get_' + name)())
+            # A persistent server listens on the ports of the previous one.
+            ports = [0] * shards
+            if persist:
+                os.makedirs(persist, exist_ok = True)
+                with contextlib.suppress(Exception):
+                    previous = read_serverdata(serverdatafilename)[5]['addresses']
+                    if len(previous) == shards:
+                        ports = [tcpaddress[1] for tcpaddress, unixaddress in previous]
+
+            # `servers` are the shard processes, `managers` what local proxies
+            # go through: the AF_UNIX socket when there is one.
+            self.servers = []
+            self.managers = []
+            for n, syncmanager in enumerate(self.syncmanagers):
+                serveroptions = {'metrics': metrics, 'transactions': transactions, 'codec': codec, 'codecs': codecs, 'engine': engine}
+                serveroptions['names'] = [name for name, shard in self.placement.items() if shard == n]
+                unixaddress = None
+                if unixsocket:
+                    unixaddress = serveroptions['unixaddress'] = unixsocket if n == 0 else f'{unixsocket}-{n}'
+                if persist:
+                    serveroptions['persist'] = {'directory': persist, 'name': f'shard{n}', 'interval': snapshotinterval}
+
+                server = syncmanager(address = ('', ports[n]), authkey = authkey)
+                try:
+                    server.start(RemoteSyncServer.configure, (serveroptions,))
+                except EOFError:
+                    if not ports[n]:
+                        raise
+                    # The server could not listen on the previous port.
+                    server = syncmanager(address = ('', 0), authkey = authkey)
+                    server.start(RemoteSyncServer.configure, (serveroptions,))
+                self.servers.append(server)
 
-                    if name in self.attributesmapping:
-                        obj = getattr(self, name)
-                        for pair in self.attributesmapping[name]:
-                            setattr(obj, pair[0], getattr(obj, pair[1]))
+                manager = server
+                if unixaddress:
+                    manager = syncmanager(address = unixaddress, authkey = authkey)
+                    manager.connect()
+                self.managers.append(manager)
+                self.serverinfo['addresses'].append(((self.IP, server.address[1]), unixaddress))
+
+            self.server = self.servers[0]
+            self.addresses = [manager.address for manager in self.managers]
+            self.address = self.addresses[0]
+            self.use_codecs()
+
+            # The replicas have a registry of their own, holding a copy of
+            # each replicated object, filled by their `ReplicaFeed`.
+            replicated = list(replicated or [])
+            namedtypes = {objdesc[0]: type(objdesc[1]) for objdesc in namedobjects}
+            for name in replicated:
+                if name not in namedtypes:
+                    raise ValueError(f'{name!r} is replicated but is not a named object')
+                if namedtypes[name] not in (dict, mpm.Namespace):
+                    raise TypeError(f'{name} cannot be replicated, only dict and Namespace objects can')
+            self.serverinfo['replicated'] = replicated
+            self.serverinfo['staleness'] = staleness
+            self.serverinfo['replicas'] = []
+            self.replicas = []
+            if replicas and replicated:
+                replicamanager = type('replicamanager', (self.syncmanager,), {'_registry': {
+                    typeid: props for typeid, props in self.syncmanager._registry.items()
+                    if not typeid.startswith('get_')
+                }})
+                for name in replicated:
+                    replicamanager.register('get_' + name, callable=retobj(namedtypes[name]()), proxytype=proxymap[namedtypes[name]])
+                replicaof = {
+                    'addresses': self.addresses,
+                    'names': {name: self.placement[name] for name in replicated},
+                }
+                for n in range(replicas):
+                    serveroptions = {'metrics': metrics, 'codec': codec, 'codecs': codecs, 'engine': engine, 'replicaof': replicaof, 'staleness': staleness}
+                    serveroptions['names'] = replicated
+                    unixaddress = None
+                    if unixsocket:
+                        unixaddress = serveroptions['unixaddress'] = f'{unixsocket}-r{n}'
+                    replica = replicamanager(address = ('', 0), authkey = authkey)
+                    replica.start(RemoteSyncServer.configure, (serveroptions,))
+                    self.replicas.append(replica)
+                    self.serverinfo['replicas'].append(((self.IP, replica.address[1]), unixaddress))
+
+            if serverdatafilename:
+                self.serveraddress = self.serverinfo['addresses'][0][0]
+                with open(serverdatafilename, 'wb') as serverdata_file:
+                    pickle.dump((self.serveraddress, self.clientobjects, self.attributesmapping, self.contextwrap, self.formats, self.serverinfo), serverdata_file, pickle.HIGHEST_PROTOCOL)
 
         else:
-            with open(serverdatafilename, 'rb') as serverdata_file:
-                (self.serveraddress, self.clientobjects, self.attributesmapping, self.contextwrap, self.formats) = pickle.load(serverdata_file)
+            (self.serveraddress, self.clientobjects, self.attributesmapping, self.contextwrap, self.formats, self.serverinfo) = read_serverdata(serverdatafilename)
 
             for objdesc in self.clientobjects:
                 if len(objdesc) == 1:
@@ -380,52 +4896,807 @@ class RemoteSyncManager:
                     (name, proxytype, exposed) = objdesc
                     self.syncmanager.register('get_' + name, proxytype=proxytype, exposed=exposed)
 
-            self.client = self.syncmanager(address = self.serveraddress, authkey = authkey)
-            self.client.connect()
+            # Client side, a single registry serves all the shards: it only
+            # decides which proxy to make of the objects.
+            self.placement = self.serverinfo['placement']
+            self.addresses = [preferred_address(self.serverinfo, n) for n in range(len(self.serverinfo['addresses']))]
+            self.address = self.addresses[0]
+            self.use_codecs()
+            self.managers = []
+            for address in self.addresses:
+                manager = self.syncmanager(address = address, authkey = authkey)
+                manager.connect()
+                self.managers.append(manager)
+            self.client = self.managers[0]
 
-            for objdesc in self.clientobjects:
-                name = objdesc[0]
+        # Named objects get their proxy on first use, unless `lazy` is False.
+        # With `bulk`, a single call per shard gets the tokens of all of them,
+        # so that creating a proxy then needs no round trip at all.
+        self.serverdatafilename = serverdatafilename
+        self.reconnect = reconnect
+        self.pools = [ConnectionPool(address, authkey, pool) for address in self.addresses] if pool else []
+        self.tokens = {}
+        if bulk:
+            self.fetch_tokens()
+        self.unmaterialized = {objdesc[0] for objdesc in self.clientobjects}
+        self.object = NamedObjects(self)
+        self.objectname = {}
+        self.proxies = {}
+        self.use_metrics()
+        if not lazy:
+            for name in list(self.unmaterialized):
+                self.materialize(name)
 
-                if name in self.contextwrap:
-                    setattr(self, '__context_wrapped__'+name, getattr(self.client, 'get_' + name)())
-                    setattr(self, name, ContextWrap(
-                        getattr(self, '__context_wrapped__'+name),
-                        self.contextwrap[name][0],
-                        self.contextwrap[name][1],
-                    ))
+        if self.isServer or self.serverinfo['host'] == self.host:
+            self.use_shared_memory()
+        self.use_cache(cache or {})
+        self.use_replicas(cache or {})
 
-                else:
-                    setattr(self, name, getattr(self.client, 'get_' + name)())
-                    obj = getattr(self, name)
+    def share_memory(self, name, obj):
+        '''
+        Server side: return a replacement for `obj` stored in shared memory
+        (`SharedValue` or `SharedArray`) if `obj` is a Value of a fixed size
+        type (int, float, bool or a struct/ctypes typecode such as 'i' or 'd')
+        or a non empty array.array. Return `obj` itself otherwise.
 
-                    if name in self.attributesmapping:
-                        for pair in self.attributesmapping[name]:
-                            setattr(obj, pair[0], getattr(obj, pair[1]))
+        The replacement becomes the named object: `obj` is only used for its
+        initial contents. The segments are advertised in the server data
+        file, and unlinked when this object is finalized.
+        '''
+        if isinstance(obj, mpm.Value):
+            fmt = sharedvalueformats.get(obj._typecode, obj._typecode)
+            try:
+                size = struct.calcsize(fmt)
+            except (TypeError, struct.error):
+                return obj
+            shm = create_shared_memory(size)
+            shared = SharedValue(obj._typecode, fmt, shm)
+            shared.set(obj.get())
+            segment = ('Value', shm.name, obj._typecode, fmt)
 
-        #
-        self.object = {}
-        self.objectname = {}
+        elif isinstance(obj, array.array) and obj.typecode != 'u' and len(obj):
+            shm = create_shared_memory(obj.itemsize * len(obj))
+            shared = SharedArray(obj.typecode, len(obj), shm)
+            shared[:] = obj
+            segment = ('Array', shm.name, obj.typecode, len(obj))
+
+        else:
+            return obj
+
+        if not self.sharedmemory:
+            mp.util.Finalize(self, RemoteSyncManager.unlink_shared_memory, args=(self.sharedmemory,), exitpriority=0)
+        self.sharedmemory[name] = shm
+        self.serverinfo['sharedmemory'][name] = segment
+        return shared
+
+    @staticmethod
+    def unlink_shared_memory(sharedmemory):
+        for shm in sharedmemory.values():
+            with contextlib.suppress(OSError):
+                unlink_shared_memory(shm)
 
+    def use_shared_memory(self):
+        '''
+        Replace the proxies of shared memory backed named objects by direct
+        views of their segment. Only meaningful on the server's host.
+        '''
+        for name, (kind, segmentname, typecode, extra) in self.serverinfo['sharedmemory'].items():
+            shm = self.sharedmemory.get(name)
+            if shm is None:
+                try:
+                    shm = attach_shared_memory(segmentname)
+                except OSError:
+                    continue
+                self.sharedmemory[name] = shm
+
+            if kind == 'Value':
+                self.bind(name, SharedValue(typecode, extra, shm, getattr(self, name)))
+            else:
+                self.bind(name, SharedArray(typecode, extra, shm))
+
+    def __getattr__(self, name):
+        # Only called for missing attributes: named objects not used yet.
+        if name in self.__dict__.get('unmaterialized', ()):
+            return self.materialize(name)
+        raise AttributeError(f'{type(self).__name__!r} object has no attribute {name!r}')
+
+    def shardnames(self):
+        '''
+        Return the names of the named objects, per shard.
+        '''
+        names = collections.defaultdict(list)
         for objdesc in self.clientobjects:
-            name = objdesc[0]
-            obj = getattr(self, name)
-            self.object[name] = obj
-            self.objectname[obj] = name
+            names[self.placement[objdesc[0]]].append(objdesc[0])
+        return names
+
+    def fetch_tokens(self):
+        '''
+        Get the ids of all the named objects, with one `create_many` call per
+        shard, for `materialize` to use.
+        '''
+        for shard, shardnames in self.shardnames().items():
+            tokens = server_call(self.addresses[shard], self.authkey, 'create_many', ['get_' + name for name in shardnames])
+            self.tokens.update(zip(shardnames, tokens))
+
+    def materialize(self, name):
+        '''
+        Create the proxy of the named object `name`, wrapped as need be, and
+        make it the attribute `name`. By default this happens on first use of
+        the attribute, so that a process only pays for the objects it uses.
+
+        Proxies made from the tokens of `fetch_tokens` do not add a reference
+        of their own: the objects are referenced by `create_many`, as named
+        objects always are anyway, for the lifetime of the server.
+        '''
+        manager = self.managers[self.placement[name]]
+        token = self.tokens.pop(name, None)
+        if token:
+            ident, exposed = token
+            typeid = 'get_' + name
+            proxytype = manager._registry[typeid][3]
+            proxy = proxytype(
+                mpm.Token(typeid, manager.address, ident), manager._serializer,
+                manager=manager, authkey=manager._authkey, exposed=exposed, incref=False,
+            )
+        else:
+            proxy = getattr(manager, 'get_' + name)()
+
+        if isinstance(proxy, (LockProxy, RWLockProxy)):
+            proxy.ip = self.IP
+        # Locks, Semaphores and Conditions keep a connection per thread: they
+        # belong to the thread of the server which acquired them.
+        if self.pools and isinstance(proxy, mpm.BaseProxy) and not hasattr(proxy, 'acquire'):
+            proxy._callmethod = pooled(proxy, name, self)
+        if self.metrics and isinstance(proxy, mpm.BaseProxy):
+            proxy._callmethod = timed(proxy._callmethod, name, self.metrics)
+        if name in self.codecs and isinstance(proxy, mpm.BaseProxy):
+            self.identcodecs[proxy._token.id] = self.codecs[name]
+        self.proxies[name] = proxy
+
+        if name in self.contextwrap:
+            setattr(self, '__context_wrapped__'+name, proxy)
+            obj = self.ContextWrap(proxy, self.contextwrap[name][0], self.contextwrap[name][1])
+        else:
+            obj = proxy
+            if name in self.attributesmapping:
+                for pair in self.attributesmapping[name]:
+                    setattr(obj, pair[0], getattr(obj, pair[1]))
+
+        self.unmaterialized.discard(name)
+        return self.bind(name, obj)
+
+    def stream(self, chunks=None, name=None, once=False, window=8):
+        '''
+        Send the bytes-like `chunks` (an iterable, e.g. a generator reading
+        a file: `iter(lambda: f.read(1 << 20), b'')`) to the server, on the
+        shard of the named object `name` if given, and return a `StreamRef`
+        to them, which can be put in a queue or dict like any value. Only a
+        chunk at a time is held in memory.
+
+        Without `chunks`, return the reference to a stream which
+        `write_stream` will send, so that it can be passed on first: with
+        `once`, the reader then gets the chunks as they are written, and the
+        writer waits while `window` chunks are not read.
+        '''
+        shard = self.placement[name] if name else 0
+        ref = StreamRef(uuid.uuid4().hex, shard, once, window)
+        if chunks is not None:
+            self.write_stream(ref, chunks)
+        return ref
+
+    def write_stream(self, ref, chunks):
+        '''
+        Send the bytes-like `chunks` of the stream `ref`, and return their
+        number and total size.
+        '''
+        conn = Client(self.addresses[ref.shard], authkey=self.authkey)
+        try:
+            conn.send((None, 'write_stream', (ref.sid, ref.once, ref.window), {}))
+            # A reply before the end is the error which made the server stop
+            # reading the chunks, e.g. the stream was deleted.
+            try:
+                for chunk in chunks:
+                    if not isinstance(chunk, (bytes, bytearray, memoryview)):
+                        raise TypeError(f'stream chunks must be bytes-like, not {type(chunk).__name__}')
+                    if conn.poll():
+                        break
+                    conn.send(chunk)
+                else:
+                    conn.send(None)
+            except OSError:
+                if not conn.poll():
+                    raise
+            kind, result = conn.recv()
+        finally:
+            conn.close()
+        if kind != '#RETURN':
+            raise mpm.convert_to_error(kind, result)
+        return result
+
+    def read_stream(self, ref):
+        '''
+        Yield the chunks of the stream `ref`, as they arrive if it is still
+        being written. A stream read `once` is gone afterwards, others stay
+        until `delete_stream`.
+        '''
+        conn = Client(self.addresses[ref.shard], authkey=self.authkey)
+        try:
+            conn.send((None, 'read_stream', (ref.sid, ref.once, ref.window), {}))
+            while True:
+                msg = conn.recv()
+                # The chunks are bytes, the reply which ends them a tuple.
+                if isinstance(msg, tuple):
+                    kind, result = msg
+                    if kind != '#RETURN':
+                        raise mpm.convert_to_error(kind, result)
+                    return
+                yield msg
+        finally:
+            conn.close()
+
+    def delete_stream(self, ref):
+        server_call(self.addresses[ref.shard], self.authkey, 'delete_stream', ref.sid)
+
+    def resolve(self, name):
+        '''
+        Ask the server, which may have been restarted, for the id of the named
+        object `name` again, and make its proxy use it. A client first reads
+        the server data file again, in case the server moved.
+        '''
+        shard = self.placement[name]
+        if not self.isServer:
+            with contextlib.suppress(OSError, EOFError, pickle.UnpicklingError):
+                serverinfo = read_serverdata(self.serverdatafilename)[5]
+                address = preferred_address(serverinfo, shard)
+                if address != self.addresses[shard]:
+                    addresscodecs[address] = (self.codec, self.identcodecs)
+                    self.addresses[shard] = self.pools[shard].address = address
+
+        proxy = self.proxies[name]
+        ident, exposed = server_call(self.addresses[shard], self.authkey, 'create', 'get_' + name)
+        if proxy._id in self.identcodecs:
+            self.identcodecs[ident] = self.identcodecs.pop(proxy._id)
+        proxy._token.address = self.addresses[shard]
+        proxy._token.id = proxy._id = ident
+
+    def bind(self, name, obj):
+        '''
+        Make `obj` the named object `name`, i.e. the attribute `name`.
+        '''
+        previous = self.object.get(name)
+        if previous is not None:
+            self.objectname.pop(previous, None)
+        setattr(self, name, obj)
+        self.object[name] = obj
+        self.objectname[obj] = name
+        return obj
+
+    def accumulator(self, name, interval = 1.0, batch = 1000):
+        '''
+        Return an `Accumulator` of the named Value, dict or Namespace `name`:
+        its increments are added up in this process, and flushed to the
+        server every `interval` seconds (never if 0), every `batch`
+        increments and at exit, e.g.:
+
+            hits = RS.accumulator('stats')
+            for item in items:
+                hits.add('items')
+                hits.add('bytes', len(item))
+            hits.get('items', flush=True)
+        '''
+        return Accumulator(getattr(self, name), interval, batch)
+
+    def transact(self, function, *names, **kwds):
+        '''
+        Run the transaction `function` (or the function of that name) in the
+        server, as `function(*objects, **kwds)` where `objects` are the named
+        objects `names` themselves, not proxies, and return its result. It
+        takes a single round trip, during which the named locks among `names`
+        are held (see `RemoteSyncServer.transact`). E.g. with
+
+            def start(lo, vi, vf, di, name):
+                vi.value += 1234
+                vf.value = vf.value * vi.value
+                di[name] = 'start'
+
+        given to the server as `transactions=[start]`, a client does
+        `RS.transact(start, 'lo', 'vi', 'vf', 'di', name='proca')`.
+        All the objects must be on the same shard.
+        '''
+        funcname = function if isinstance(function, str) else function.__name__
+        if len({self.placement[name] for name in names}) != 1:
+            raise ValueError('the objects of a transaction must be on a single shard')
+        if names[0] not in self.proxies:
+            self.materialize(names[0])
+        return self.proxies[names[0]]._callmethod('transact', (funcname, names, kwds, holder_id(self.IP)))
+
+    def use_metrics(self):
+        '''
+        If the server records metrics, time the calls of the proxies of the
+        named objects in this process as well.
+        '''
+        self.metrics = None
+        if self.serverinfo.get('metrics'):
+            self.metrics = Metrics()
+            mp.util.register_after_fork(self.metrics, Metrics.reset)
+
+    def server_metrics(self):
+        '''
+        Return the `Metrics` of the server, all shards together.
+        '''
+        metrics = Metrics()
+        for address in self.addresses:
+            shardmetrics = server_call(address, self.authkey, 'get_metrics')
+            if shardmetrics:
+                metrics.merge(shardmetrics)
+        return metrics
+
+    def stats(self):
+        '''
+        Return the call metrics, per named object and method, recorded by the
+        server (execution time, bytes received and sent) and by the proxies
+        of this process (round trip time), when the server was started with
+        `metrics=True`:
+
+            {'server': {'vi': {'incr': {'calls': ..., 'latency_us': {...}}}},
+             'client': {...}}
+
+        The time `RS.lo.acquire` takes on the server (as `acquire_as`) is the
+        time spent waiting for the lock, see also `lock_stats`.
+        '''
+        return {
+            'server': self.server_metrics().stats(),
+            'client': self.metrics.stats() if self.metrics else {},
+        }
+
+    def lock_stats(self):
+        '''
+        Return, for each lock acquired so far, who holds it and for how long,
+        who waits for it, and the time waited and held, e.g.:
+
+            {'lo': {'holders': {'192.168.1.7-P4242/MainThread':
+                                    [{'mode': 'write', 'held_s': 12.5}]},
+                    'waiters': {...}, 'acquisitions': 1234, 'failures': 0,
+                    'wait_us': {'count': ..., 'p99': ...}, 'hold_us': {...}}}
+
+        A holder is the `UID` of a process (see `holder_id`) and a thread name.
+        '''
+        locks = {}
+        for address in self.addresses:
+            locks.update(server_call(address, self.authkey, 'get_locks'))
+        return locks
+
+    def metrics_text(self):
+        '''
+        Return the same metrics as `stats`, in the Prometheus text format.
+        '''
+        text = self.server_metrics().dump('remotesyncmanager_server')
+        if self.metrics:
+            text += self.metrics.dump('remotesyncmanager_client')
+        return text
+
+    def use_codecs(self):
+        '''
+        Encode the messages of this process to the server with the codecs of
+        the server data file, see `Codec`: the connections to the addresses
+        of the server get these codecs from `Client`.
+        '''
+        self.codec = self.serverinfo.get('codec')
+        self.codecs = self.serverinfo.get('codecs', {})
+        # The ids of the named objects which have a codec of their own, see
+        # `materialize`.
+        self.identcodecs = {}
+        for address in self.addresses:
+            addresscodecs[address] = (self.codec, self.identcodecs)
+        for codec in [self.codec] + list(self.codecs.values()):
+            if codec is not None:
+                mp.util.register_after_fork(codec, Codec.reset)
+
+    def codec_stats(self):
+        '''
+        Return the counters of the codecs (see `Codec.info`) of the server,
+        all shards together, and of this process, as
+
+            {'server': {None: {...}, 'q1': {'messages': ..., 'bytes_saved': ...}},
+             'client': {...}}
+
+        None being the codec of all the messages, the others those of named
+        objects. The server counts the replies it sends, a client its
+        requests.
+        '''
+        server = {}
+        for address in self.addresses:
+            for name, codec in server_call(address, self.authkey, 'get_codecs').items():
+                if name in server:
+                    server[name].merge(codec)
+                else:
+                    server[name] = codec
+        client = dict(self.codecs)
+        if self.codec is not None:
+            client[None] = self.codec
+        return {
+            'server': {name: codec.info() for name, codec in server.items()},
+            'client': {name: codec.info() for name, codec in client.items()},
+        }
+
+    def use_cache(self, cache):
+        '''
+        Replace the proxies of the dict and Namespace objects named in `cache`
+        by a `CachedDictProxy` or `CachedNamespaceProxy`, with a local cache
+        of `cache[name]` entries, e.g. `cache={'di': 1000}`. A single
+        `InvalidationListener` per shard and process keeps all these caches up
+        to date.
+        '''
+        self.caches = collections.defaultdict(dict)
+        for name, maxsize in cache.items():
+            proxy = getattr(self, name)
+            if isinstance(proxy, DictProxy):
+                wrapper = CachedDictProxy
+            elif isinstance(proxy, NamespaceProxy):
+                wrapper = CachedNamespaceProxy
+            else:
+                raise TypeError(f'{name} cannot be cached, only dict and Namespace objects can')
+            proxycache = self.caches[self.placement[name]][proxy._token.id] = ProxyCache(maxsize)
+            self.bind(name, wrapper(proxy, proxycache))
+
+        if self.caches:
+            self.listeners = [
+                InvalidationListener(self.addresses[shard], self.authkey, caches)
+                for shard, caches in self.caches.items()
+            ]
+            mp.util.register_after_fork(self, RemoteSyncManager.after_fork)
+
+    def use_replicas(self, cache):
+        '''
+        Replace the proxies of the replicated dicts and Namespaces (but those
+        in `cache`, whose reads are already local) by a `ReplicatedDictProxy`
+        or `ReplicatedNamespaceProxy`, which reads from the least loaded of
+        the read replicas: that which serves the fewest connections.
+        '''
+        replicated = [name for name in self.serverinfo.get('replicated', ()) if name not in cache]
+        if not replicated or not self.serverinfo.get('replicas'):
+            return
+
+        loads = []
+        for tcpaddress, unixaddress in self.serverinfo['replicas']:
+            address = local_address(self.serverinfo, tcpaddress, unixaddress)
+            try:
+                loads.append((server_call(address, self.authkey, 'get_load'), random.random(), address))
+            except (OSError, EOFError):
+                mp.util.info('replica at %r unreachable', address)
+        if not loads:
+            return
+        load, tiebreak, self.replicaaddress = min(loads)
 
+        # As in `materialize`, the tokens of `create_many` make proxies.
+        tokens = server_call(self.replicaaddress, self.authkey, 'create_many', ['get_' + name for name in replicated])
+        for name, (ident, exposed) in zip(replicated, tokens):
+            proxy = getattr(self, name)
+            replica = type(proxy)(
+                mpm.Token('get_' + name, self.replicaaddress, ident), proxy._serializer,
+                authkey=self.authkey, exposed=exposed, incref=False,
+            )
+            if isinstance(proxy, DictProxy):
+                self.bind(name, ReplicatedDictProxy(proxy, replica))
+            else:
+                self.bind(name, ReplicatedNamespaceProxy(proxy, replica))
+
+    def after_fork(self):
+        # A child process needs its own InvalidationListeners, the inherited
+        # connections belong to the parent's listener threads.
+        for listener in self.listeners:
+            listener.close()
+        self.listeners = []
+        for shard, caches in self.caches.items():
+            try:
+                self.listeners.append(InvalidationListener(self.addresses[shard], self.authkey, caches))
+            except Exception:
+                mp.util.info('caches disabled: %s', traceback.format_exc())
+
+    def snapshot(self):
+        '''
+        Return the state of all the named objects, gathered by the server in
+        a single call per shard (see `RemoteSyncServer.snapshot`), e.g.:
+
+            {'q1': {'type': 'Queue', 'repr': '<queue.Queue object at ...>',
+                    'qsize': 0, 'maxsize': 1, 'empty': True, 'full': False},
+             'lo': {'type': 'lock', 'repr': '<unlocked _thread.lock ...>',
+                    'locked': False},
+             ...}
+        '''
+        states = {}
+        for shard, shardnames in self.shardnames().items():
+            proxy = self.shardproxy(shardnames)
+            if proxy is None:
+                states.update(server_call(self.addresses[shard], self.authkey, 'snapshot', shardnames))
+            else:
+                states.update(proxy._callmethod('snapshot', (shardnames,)))
+        return {objdesc[0]: states[objdesc[0]] for objdesc in self.clientobjects if objdesc[0] in states}
+
+    def shardproxy(self, shardnames):
+        '''
+        Return the proxy of one of the named objects `shardnames` of a shard,
+        through whose connection calls to the server can go, materializing
+        one if need be; None if there is none, e.g. all in shared memory.
+        '''
+        for name in shardnames:
+            if name in self.proxies:
+                return self.proxies[name]
+        for name in shardnames:
+            if name in self.__dict__.get('unmaterialized', ()):
+                self.materialize(name)
+                return self.proxies[name]
+        return None
 
     def __str__(self):
         S = []
-        for objdesc in self.clientobjects:
-            name = objdesc[0]
-            obj = getattr(self, name)
-            if name in self.formats:
-                strformat = self.formats[name]
-                if strformat == 'queue':
-                    S.append(f'{name}: {obj} ' + ('E' if obj.empty() else (f'{obj.qsize()}' + ('F' if obj.full() else ''))))
-                if strformat == 'event':
-                    S.append(f'{name}: {obj} is_set={obj.is_set()}')
+        for name, state in self.snapshot().items():
+            obj = state.get('repr', state.get('error'))
+            strformat = self.formats.get(name)
+            if strformat == 'queue' and 'qsize' in state:
+                S.append(f'{name}: {obj} ' + ('E' if state['empty'] else (f'{state["qsize"]}' + ('F' if state['full'] else ''))))
+            elif strformat == 'event' and 'is_set' in state:
+                S.append(f'{name}: {obj} is_set={state["is_set"]}')
+            elif strformat == 'channel' and 'pending' in state:
+                S.append(f'{name}: {obj} pending={state["pending"]}')
+            elif strformat == 'taskqueue' and 'pending' in state:
+                S.append(f'{name}: {obj} pending={state["pending"]} leased={state["leased"]}')
             else:
                 S.append(f'{name}: {obj}')
         return '\n'.join(S)
 
+
+def async_holder_id(ip=None):
+    '''
+    Return the holder id of the current asyncio task: that of its thread
+    (see `holder_id`) and the name of the task.
+    '''
+    return f'{holder_id(ip)}/{asyncio.current_task().get_name()}'
+
+
+class AsyncProxy:
+    '''
+        Proxy for a named object of an `AsyncRemoteSyncManager`. Its methods
+        are those exposed by the remote object, plus the server side operations
+        (e.g. `put_many`), and they return awaitables:
+
+            await RS.q1.put('hello')
+            value = await RS.di['key']
+            await RS.di.__setitem__('key', value + 1)
+            await RS.vi.incr(5)
+
+        Named locks (see `ContextWrap`) also work with `async with RS.lo:`,
+        on behalf of the task (see `async_holder_id`). Note that cancelling
+        a call does not cancel it on the server, e.g. a cancelled `get` may
+        still remove an item from the queue.
+
+        RLocks and Conditions are acquired and released by `async with` too.
+        They belong to the connection, served by a single thread of the
+        server: its tasks share them, as the code of a thread would.
+    '''
+
+    _ip = None
+
+    def __init__(self, connection, ident, exposed, context=None):
+        self._connection = connection
+        self._ident = ident
+        self._exposed = exposed
+        self._context = context
+
+    def __getattr__(self, methodname):
+        if methodname.startswith('_') and methodname not in self._exposed:
+            raise AttributeError(methodname)
+        return functools.partial(self._callmethod, methodname)
+
+    def _callmethod(self, methodname, *args, **kwds):
+        return self._connection.call(self._ident, methodname, args, kwds)
+
+    def __getitem__(self, key):
+        return self._callmethod('__getitem__', key)
+
+    async def __aenter__(self):
+        if self._context == ('acquire', 'release'):
+            await self._callmethod('acquire_as', async_holder_id(self._ip))
+        elif self._context:
+            await self._callmethod(self._context[0])
+        else:
+            await self._callmethod('acquire')
+
+    async def __aexit__(self, typ, val, tb):
+        if self._context == ('acquire', 'release'):
+            await self._callmethod('release_as', async_holder_id(self._ip))
+        elif self._context:
+            await self._callmethod(self._context[1])
+        else:
+            await self._callmethod('release')
+
+    def __repr__(self):
+        return f'<AsyncProxy of object {self._ident}>'
+
+
+class AsyncConnection:
+    '''
+        A pipelined connection (see `RemoteSyncServer.accept_pipelined`) to
+        one server process, i.e. one shard: each request is tagged with a
+        request id, and any number of them can be in flight at once.
+    '''
+
+    def __init__(self, address, authkey, codec=None, codecs=None):
+        self.address = address
+        self.authkey = authkey
+        # The codecs of the requests, see `Codec`: `codecs` by object id.
+        self.codec = codec
+        self.codecs = codecs or {}
+        self.reqids = itertools.count()
+        self.pending = {}
+        self.proxied = []
+        self.idents = []
+        self.reader = self.writer = self.receiver = None
+
+    async def open(self, names):
+        '''
+        Connect, and return the `(name, (ident, exposed))` pairs of the named
+        objects `names`.
+        '''
+        loop = asyncio.get_running_loop()
+        sock, tokens = await loop.run_in_executor(None, self.handshake, names)
+        self.reader, self.writer = await asyncio.open_connection(sock=sock)
+        self.receiver = loop.create_task(self.receive())
+        self.idents = [ident for name, (ident, exposed) in tokens]
+        return tokens
+
+    def handshake(self, names):
+        '''
+        Blocking part of `open`, run in a thread: get an object id for each
+        named object, then open the pipelined connection, authenticated as any
+        multiprocessing connection would be.
+        '''
+        tokens = list(zip(names, server_call(self.address, self.authkey, 'create_many', ['get_' + name for name in names])))
+
+        conn = Client(self.address, authkey=self.authkey)
+        try:
+            mpm.dispatch(conn, None, 'accept_pipelined', (f'AsyncRemoteSyncManager-{os.getpid()}',))
+            sock = socket.socket(fileno=os.dup(conn.fileno()))
+        finally:
+            conn.close()
+        sock.setblocking(False)
+        return sock, tokens
+
+    async def close(self):
+        if self.receiver:
+            self.receiver.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.receiver
+        if self.writer:
+            self.writer.close()
+            with contextlib.suppress(OSError):
+                await self.writer.wait_closed()
+        self.reader = self.writer = self.receiver = None
+
+        idents = self.idents + self.proxied
+        self.idents = []
+        self.proxied = []
+        await asyncio.get_running_loop().run_in_executor(None, self.release, idents)
+
+    def release(self, idents):
+        for ident in idents:
+            with contextlib.suppress(Exception):
+                server_call(self.address, self.authkey, 'decref', ident)
+
+    # The messages are those of a `BufferConnection`, see `encode_message`.
+
+    def send(self, obj, codec=None):
+        for chunk in encode_message(obj, codec)[0]:
+            self.writer.write(chunk)
+
+    async def recv(self):
+        bodysize, count, flags = messageheader.unpack(await self.reader.readexactly(13))
+        sizes = struct.unpack(f'!{count}Q', await self.reader.readexactly(8 * count)) if count else ()
+        buffers = [await self.reader.readexactly(size) for size in sizes]
+        return decode_message(await self.reader.readexactly(bodysize), flags, buffers)
+
+    async def call(self, ident, methodname, args, kwds):
+        if self.receiver is None or self.receiver.done():
+            raise ConnectionError('AsyncRemoteSyncManager is not connected')
+        reqid = next(self.reqids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[reqid] = future
+        self.send((reqid, (ident, methodname, args, kwds)), self.codecs.get(ident, self.codec))
+        await self.writer.drain()
+        return await future
+
+    async def receive(self):
+        '''
+        Read the replies, in whatever order they come, and hand each of them
+        to the call waiting for it.
+        '''
+        try:
+            while True:
+                reqid, (kind, result) = await self.recv()
+                future = self.pending.pop(reqid, None)
+                if future is None or future.done():
+                    continue
+                if kind == '#RETURN':
+                    future.set_result(result)
+                elif kind == '#PROXY':
+                    exposed, token = result
+                    self.proxied.append(token.id)
+                    future.set_result(AsyncProxy(self, token.id, exposed))
+                else:
+                    future.set_exception(mpm.convert_to_error(kind, result))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            pending, self.pending = self.pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('connection to the server was lost'))
+
+
+class AsyncRemoteSyncManager:
+    '''
+        `class AsyncRemoteSyncManager:` is the asyncio counterpart of the
+        client side of `RemoteSyncManager`. It reads the same server data file
+        and hands out an `AsyncProxy` for each named object:
+
+            async with AsyncRemoteSyncManager('mpSERVERDATA.pkl', authkey) as RS:
+                await RS.q1.put('hello')
+
+        All the proxies of a shard share a single pipelined `AsyncConnection`,
+        e.g. `await asyncio.gather(*(RS.q1.get() for n in range(1000)))` puts
+        all the requests in flight at once. A blocking call, such as a `get`
+        on an empty queue, does not delay the others.
+    '''
+
+    def __init__(self, serverdatafilename, authkey):
+        (self.serveraddress, self.clientobjects, self.attributesmapping, self.contextwrap, self.formats, self.serverinfo) = read_serverdata(serverdatafilename)
+        self.placement = self.serverinfo['placement']
+        self.authkey = authkey
+        self.codecs = self.serverinfo.get('codecs', {})
+        self.IP = get_ip()
+        self.connections = [
+            AsyncConnection(preferred_address(self.serverinfo, n), authkey, self.serverinfo.get('codec'))
+            for n in range(len(self.serverinfo['addresses']))
+        ]
+        self.object = {}
+
+    async def connect(self):
+        names = [[] for connection in self.connections]
+        for objdesc in self.clientobjects:
+            name = objdesc[0]
+            names[self.placement[name]].append(name)
+
+        shardtokens = await asyncio.gather(*(
+            connection.open(shardnames)
+            for connection, shardnames in zip(self.connections, names)
+        ))
+
+        for connection, tokens in zip(self.connections, shardtokens):
+            for name, (ident, exposed) in tokens:
+                if name in self.codecs:
+                    connection.codecs[ident] = self.codecs[name]
+                proxy = AsyncProxy(connection, ident, exposed, self.contextwrap.get(name))
+                proxy._ip = self.IP
+                setattr(self, name, proxy)
+                self.object[name] = proxy
+        return self
+
+    async def close(self):
+        await asyncio.gather(*(connection.close() for connection in self.connections))
+
+    async def transact(self, function, *names, **kwds):
+        '''
+        Asyncio counterpart of `RemoteSyncManager.transact`.
+        '''
+        funcname = function if isinstance(function, str) else function.__name__
+        if len({self.placement[name] for name in names}) != 1:
+            raise ValueError('the objects of a transaction must be on a single shard')
+        return await self.object[names[0]]._callmethod('transact', funcname, names, kwds, async_holder_id(self.IP))
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, typ, val, tb):
+        await self.close()
+
 # vim: se ai ts=2 expandtab sw=2 tw=80 :
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+'''
+    Benchmarks of the objects shared by a `RemoteSyncManager`.
+
+    A server is started in this process, then for each workload N client
+    processes connect to it through the server data file, as remote clients
+    would, and time each of their operations. The results, ops/sec and
+    latency percentiles per workload, are printed as JSON, e.g.:
+
+        python3 remotesyncmanager_benchmark.py --clients 4 --ops 5000
+        python3 remotesyncmanager_benchmark.py --unixsocket --shards 2 pingpong lock
+
+    The same runs can be made from python with `run_benchmark`.
+'''
+
+import os
+import sys
+import json
+import time
+import queue
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import threading
+import multiprocessing as mp
+import multiprocessing.managers as mpm
+import remotesyncmanager as rsm
+
+
+AUTHKEY = b'remotesyncmanager-benchmark'
+KEYS = 1000
+
+
+# The workloads.
+#
+# Each workload is a function `workload(RS, index, ops)` run by every client
+# process, which returns the latency of each of its `ops` operations, in
+# nanoseconds. `RS` is the client side RemoteSyncManager, `index` the number
+# of the client.
+
+def pingpong(RS, index, ops):
+    # A round trip through two queues, echoed by a thread of the server
+    # process (see `echo`).
+    ping = getattr(RS, f'ping{index}')
+    pong = getattr(RS, f'pong{index}')
+    latencies = []
+    for n in range(ops):
+        t = time.perf_counter_ns()
+        ping.put(n)
+        pong.get()
+        latencies.append(time.perf_counter_ns() - t)
+    return latencies
+
+def fanin(RS, index, ops):
+    # All clients put into the same queue, emptied by a thread of the server
+    # process (see `drain`).
+    latencies = []
+    for n in range(ops):
+        t = time.perf_counter_ns()
+        RS.fanin.put((index, n))
+        latencies.append(time.perf_counter_ns() - t)
+    return latencies
+
+def lock(RS, index, ops):
+    # All clients take turns with the same lock, through `ContextWrap`.
+    latencies = []
+    for n in range(ops):
+        t = time.perf_counter_ns()
+        with RS.lo:
+            pass
+        latencies.append(time.perf_counter_ns() - t)
+    return latencies
+
+def dict_mix(writes):
+    def workload(RS, index, ops):
+        rnd = random.Random(index)
+        latencies = []
+        for n in range(ops):
+            key = rnd.randrange(KEYS)
+            if rnd.random() < writes:
+                t = time.perf_counter_ns()
+                RS.di[key] = n
+            else:
+                t = time.perf_counter_ns()
+                RS.di[key]
+            latencies.append(time.perf_counter_ns() - t)
+        return latencies
+    return workload
+
+def value_incr(RS, index, ops):
+    latencies = []
+    for n in range(ops):
+        t = time.perf_counter_ns()
+        RS.vi.incr()
+        latencies.append(time.perf_counter_ns() - t)
+    return latencies
+
+def namespace(RS, index, ops):
+    # Attribute reads, with one write in ten.
+    latencies = []
+    attribute = f'a{index}'
+    for n in range(ops):
+        t = time.perf_counter_ns()
+        if n % 10:
+            getattr(RS.ns, attribute)
+        else:
+            setattr(RS.ns, attribute, n)
+        latencies.append(time.perf_counter_ns() - t)
+    return latencies
+
+def event(RS, index, ops):
+    latencies = []
+    for n in range(ops):
+        t = time.perf_counter_ns()
+        RS.ev.is_set()
+        latencies.append(time.perf_counter_ns() - t)
+    return latencies
+
+workloads = {
+    'pingpong':   pingpong,
+    'fanin':      fanin,
+    'lock':       lock,
+    'dict_read':  dict_mix(0.1),
+    'dict_write': dict_mix(0.9),
+    'value_incr': value_incr,
+    'namespace':  namespace,
+    'event':      event,
+}
+
+
+def namedobjects(clients):
+    '''
+    The objects shared by the benchmark server: a pair of queues per client
+    for the ping-pong, and one object of each type for the other workloads.
+    '''
+    objects = []
+    for index in range(clients):
+        objects.append((f'ping{index}', queue.Queue()))
+        objects.append((f'pong{index}', queue.Queue()))
+    ns = mpm.Namespace()
+    for index in range(clients):
+        setattr(ns, f'a{index}', 0)
+    objects.extend((
+        ('fanin', queue.Queue()),
+        ('lo', threading.Lock()),
+        ('ev', threading.Event()),
+        ('di', {key: 0 for key in range(KEYS)}),
+        ('vi', mpm.Value(int, 0)),
+        ('ns', ns),
+    ))
+    return objects
+
+
+def echo(ping, pong):
+    while True:
+        item = ping.get()
+        if item is None:
+            return
+        pong.put(item)
+
+def drain(fanin, count):
+    while count > 0:
+        count -= len(fanin.get_many(1000))
+
+
+def client(serverdatafilename, name, index, ops, cache, barrier, results):
+    '''
+    Body of a client process: connect, wait for all the others, run the
+    workload and send back `(index, start, end, latencies)`.
+    '''
+    try:
+        RS = rsm.RemoteSyncManager(serverdatafilename, AUTHKEY, cache = cache)
+        barrier.wait()
+        start = time.perf_counter()
+        latencies = workloads[name](RS, index, ops)
+        end = time.perf_counter()
+        results.put((index, start, end, latencies))
+    except BaseException as e:
+        # The other clients must not wait for this one.
+        barrier.abort()
+        results.put((index, None, None, f'{type(e).__name__}: {e}'))
+        raise
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summary(ops, seconds, latencies):
+    latencies.sort()
+    return {
+        'ops': ops,
+        'seconds': seconds,
+        'ops_per_sec': ops / seconds,
+        'latency_us': {
+            'mean': sum(latencies) / len(latencies) / 1000,
+            'p50': percentile(latencies, 0.5) / 1000,
+            'p99': percentile(latencies, 0.99) / 1000,
+            'p999': percentile(latencies, 0.999) / 1000,
+            'max': latencies[-1] / 1000,
+        },
+    }
+
+
+def run_workload(RS, serverdatafilename, name, clients, ops, cache):
+    helpers = []
+    if name == 'pingpong':
+        for index in range(clients):
+            helpers.append(threading.Thread(target=echo, args=(getattr(RS, f'ping{index}'), getattr(RS, f'pong{index}')), daemon=True))
+    elif name == 'fanin':
+        helpers.append(threading.Thread(target=drain, args=(RS.fanin, clients * ops), daemon=True))
+    for helper in helpers:
+        helper.start()
+
+    barrier = mp.Barrier(clients)
+    results = mp.Queue()
+    processes = [
+        mp.Process(target=client, args=(serverdatafilename, name, index, ops, cache, barrier, results))
+        for index in range(clients)
+    ]
+    for process in processes:
+        process.start()
+    reports = [results.get() for process in processes]
+    for process in processes:
+        process.join()
+
+    errors = [latencies for index, start, end, latencies in reports if start is None]
+    if errors:
+        raise RuntimeError(f'{name}: {errors[0]}')
+
+    if name == 'pingpong':
+        for index in range(clients):
+            getattr(RS, f'ping{index}').put(None)
+    for helper in helpers:
+        helper.join()
+
+    # perf_counter is system wide, the clients' clocks can be compared.
+    start = min(report[1] for report in reports)
+    end = max(report[2] for report in reports)
+    latencies = [latency for report in reports for latency in report[3]]
+    return summary(clients * ops, end - start, latencies)
+
+
+def run_benchmark(names = None, clients = 4, ops = 2000, sharedmemory = False, unixsocket = None, cache = None, shards = 1, engine = 'threads', replicas = 0):
+    '''
+    Start a server with the given `RemoteSyncManager` options, run the
+    workloads `names` (all of them by default) with `clients` client
+    processes doing `ops` operations each, and return the results as a dict.
+    `cache`, if given, is the size of the clients' cache of the dict `di`.
+    With `replicas`, the dict `di` and the Namespace `ns` are read from that
+    many read replicas.
+    '''
+    names = names or list(workloads)
+    directory = tempfile.mkdtemp(prefix='rsm-benchmark-')
+    serverdatafilename = os.path.join(directory, 'serverdata.pkl')
+    try:
+        RS = rsm.RemoteSyncManager(
+            serverdatafilename, AUTHKEY, namedobjects(clients),
+            sharedmemory = sharedmemory, unixsocket = unixsocket, shards = shards,
+            engine = engine, replicas = replicas, replicated = ['di', 'ns'] if replicas else None,
+        )
+        clientcache = {'di': cache} if cache else None
+        results = {}
+        try:
+            for name in names:
+                results[name] = run_workload(RS, serverdatafilename, name, clients, ops, clientcache)
+        finally:
+            for server in RS.servers + RS.replicas:
+                server.shutdown()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        'config': {
+            'clients': clients,
+            'ops': ops,
+            'sharedmemory': sharedmemory,
+            'unixsocket': bool(unixsocket),
+            'cache': cache,
+            'shards': shards,
+            'engine': engine,
+            'replicas': replicas,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'workloads': results,
+    }
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Benchmark the objects shared by a RemoteSyncManager.')
+    parser.add_argument('workloads', nargs='*', help=f'workloads to run, all by default: {", ".join(workloads)}')
+    parser.add_argument('--clients', type=int, default=4, help='number of client processes')
+    parser.add_argument('--ops', type=int, default=2000, help='operations per client')
+    parser.add_argument('--sharedmemory', action='store_true', help='keep the Value in shared memory')
+    parser.add_argument('--unixsocket', action='store_true', help='connect the clients through an AF_UNIX socket')
+    parser.add_argument('--cache', type=int, default=0, help='size of the clients\' cache of the dict')
+    parser.add_argument('--shards', type=int, default=1, help='number of server processes')
+    parser.add_argument('--engine', choices=('threads', 'selector'), default='threads', help='server engine')
+    parser.add_argument('--replicas', type=int, default=0, help='number of read replicas of the dict and Namespace')
+    parser.add_argument('--output', help='write the JSON results to this file rather than stdout')
+    args = parser.parse_args(argv)
+    for name in args.workloads:
+        if name not in workloads:
+            parser.error(f'unknown workload {name!r}')
+
+    results = run_benchmark(
+        args.workloads, clients = args.clients, ops = args.ops,
+        sharedmemory = args.sharedmemory, unixsocket = args.unixsocket or None,
+        cache = args.cache, shards = args.shards, engine = args.engine,
+        replicas = args.replicas,
+    )
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: se ai ts=2 expandtab sw=2 tw=80 :
@@ -0,0 +1,888 @@
+'''
+    Behaviour checks of `RemoteSyncManager`: each test starts a server in this
+    process, from the named objects it needs, and uses it through a client
+    side `RemoteSyncManager` reading the same server data file, as a remote
+    process would. Run with `python3 -m pytest` from this directory.
+'''
+
+import os
+import time
+import array
+import pickle
+import signal
+import socket
+import struct
+import queue
+import asyncio
+import threading
+import multiprocessing as mp
+import multiprocessing.managers as mpm
+
+import pytest
+
+pytest.importorskip('netifaces')
+
+import remotesyncmanager as rsm
+
+
+AUTHKEY = b'remotesyncmanager-test'
+
+
+@pytest.fixture
+def server(tmp_path):
+    '''
+    Return a function starting a server with the given named objects and
+    options, and a client connected to it: `RS, C = server(namedobjects)`.
+    The servers are shut down at the end of the test.
+    '''
+    started = []
+    serverdatafilename = str(tmp_path / 'serverdata.pkl')
+
+    def start(namedobjects, client = None, **options):
+        RS = rsm.RemoteSyncManager(serverdatafilename, AUTHKEY, namedobjects, **options)
+        started.append(RS)
+        C = rsm.RemoteSyncManager(serverdatafilename, AUTHKEY, **(client or {}))
+        return RS, C
+
+    yield start
+    for RS in started:
+        for manager in RS.servers + RS.replicas:
+            manager.shutdown()
+
+
+def run(function, timeout = 5):
+    '''
+    Run `function` in a thread and return its result, or fail if it has not
+    returned after `timeout` seconds.
+    '''
+    result = []
+    thread = threading.Thread(target=lambda: result.append(function()), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), f'{function} still running after {timeout}s'
+    assert result, f'{function} raised'
+    return result[0]
+
+
+# Batched queue operations.
+
+def test_queue_put_many_get_many(server):
+    RS, C = server((('q', queue.Queue(maxsize = 3)),))
+    assert C.q.put_many(range(5), timeout = 0.1) == 3
+    assert C.q.get_many(2) == [0, 1]
+    assert C.q.put_many(['a'], block = False) == 1
+    assert C.q.get_many(10) == [2, 'a']
+    start = time.monotonic()
+    assert C.q.get_many(10, timeout = 0.1) == []
+    assert time.monotonic() - start >= 0.1
+    assert C.q.get_many(10, block = False) == []
+    assert C.q.get_many(0) == []
+
+
+# Atomic operations.
+
+def test_compare_and_swap(server):
+    RS, C = server((('di', {}), ('ns', mpm.Namespace()), ('vi', mpm.Value(int, 0))))
+    # MISSING stands for an absent key, and comes back as is.
+    assert C.di.compare_and_swap('a', rsm.MISSING, 1) == (True, rsm.MISSING)
+    swapped, previous = C.di.compare_and_swap('a', rsm.MISSING, 2)
+    assert not swapped and previous == 1
+    assert C.di.compare_and_swap('a', 1, 2) == (True, 1) and C.di['a'] == 2
+    assert C.ns.compare_and_swap('x', rsm.MISSING, 'y') == (True, rsm.MISSING)
+    assert C.ns.x == 'y'
+    assert C.vi.compare_and_swap(1, 5) == (False, 0)
+    assert C.vi.compare_and_swap(0, 5) == (True, 0) and C.vi.value == 5
+
+
+def test_update_if_and_pop_many(server):
+    RS, C = server((('di', {'a': 1}), ('ns', mpm.Namespace(x = 1))))
+    assert not C.di.update_if({'a': 2}, {'b': 1})
+    assert not C.di.update_if({'a': 1, 'b': 0}, {'b': 1})
+    assert C.di.update_if({'a': 1, 'b': rsm.MISSING}, {'a': 2, 'b': 2})
+    assert C.di.copy() == {'a': 2, 'b': 2}
+    assert C.di.pop_many(['a', 'c']) == {'a': 2}
+    assert C.di.copy() == {'b': 2}
+    assert C.ns.update_if({'x': 1}, {'y': 2})
+    assert C.ns.pop_many(['x', 'z']) == {'x': 1}
+    assert C.ns.y == 2 and not hasattr(C.ns, 'x')
+
+
+# Shared memory.
+
+def test_shared_memory_values_and_arrays(server):
+    RS, C = server((('vi', mpm.Value(int, 1)), ('vs', mpm.Value(str, 'x')), ('ar', array.array('d', [0.0] * 4))), sharedmemory = True)
+    assert isinstance(C.vi, rsm.SharedValue) and isinstance(C.ar, rsm.SharedArray)
+    # Not of a fixed size, a proxy as usual.
+    assert not isinstance(C.vs, rsm.SharedValue) and C.vs.value == 'x'
+    # Direct stores, seen by the atomic operations of the server.
+    C.vi.value = 10
+    assert C.vi.incr(2) == 12 and C.vi.value == 12
+    assert C.vi.compare_and_swap(12, 0) == (True, 12) and C.vi.get() == 0
+    C.ar[1] = 2.5
+    C.ar[2:4] = [3.0, 4.0]
+    assert len(C.ar) == 4 and C.ar.tolist() == [0.0, 2.5, 3.0, 4.0]
+    # Another client of the same host, on the same segments.
+    other = rsm.RemoteSyncManager(C.serverdatafilename, AUTHKEY)
+    assert other.vi.value == 0 and other.ar[1:3] == [2.5, 3.0]
+    assert C.snapshot()['ar']['len'] == 4
+
+
+# Unix domain sockets.
+
+def test_unix_socket_for_local_clients(server, tmp_path):
+    path = str(tmp_path / 'server.sock')
+    RS, C = server((('q', queue.Queue()),), unixsocket = path)
+    assert C.addresses == [path] and C.q._token.address == path
+    C.q.put('x')
+    assert C.q.get() == 'x'
+    # The TCP address is served too.
+    (tcpaddress, unixaddress), = C.serverinfo['addresses']
+    assert unixaddress == path
+    assert rsm.server_call(tcpaddress, AUTHKEY, 'get_load') >= 1
+    # Without the socket file, e.g. on another host, clients use TCP.
+    os.rename(path, path + '.moved')
+    other = rsm.RemoteSyncManager(C.serverdatafilename, AUTHKEY)
+    assert other.addresses == [tcpaddress]
+    other.q.put('y')
+    assert C.q.get() == 'y'
+
+
+# Shards.
+
+def test_shard_placement(server):
+    names = ['q1', 'q2', 'q3', 'd1', 'd2', 'lo']
+    namedobjects = [(name, queue.Queue()) for name in names[:3]] + [('d1', {}), ('d2', {}), ('lo', threading.Lock())]
+    RS, C = server(namedobjects, shards = 3, placement = {'lo': 2})
+    assert len(RS.servers) == len(C.addresses) == len(set(C.addresses)) == 3
+    assert C.placement == {name: 2 if name == 'lo' else rsm.shard_of(name, 3) for name in names}
+    for name in names:
+        assert getattr(C, name)._token.address == C.addresses[C.placement[name]]
+    # Each shard serves its own objects only.
+    for shard, address in enumerate(C.addresses):
+        shardnames = [name for name in names if C.placement[name] == shard]
+        assert sorted(rsm.server_call(address, AUTHKEY, 'snapshot')) == sorted(shardnames)
+    C.q1.put(1)
+    C.d2['k'] = 'v'
+    assert C.q1.get() == 1 and C.d2['k'] == 'v'
+    assert sorted(C.snapshot()) == sorted(names)
+    # 'd1' is on shard 1, 'd2' on shard 2.
+    with pytest.raises(ValueError):
+        C.transact('count', 'd1', 'd2')
+
+
+# Metrics.
+
+def test_metrics(server):
+    RS, C = server((('q', queue.Queue()), ('d', {})), metrics = True)
+    for i in range(10):
+        C.q.put(b'x' * 1000)
+    with pytest.raises(KeyError):
+        C.d['missing']
+    stats = C.stats()
+    # The server times the execution of the calls, the client the round trips.
+    for side in ('server', 'client'):
+        put = stats[side]['q']['put']
+        assert put['calls'] == put['latency_us']['count'] == 10 and put['errors'] == 0
+        assert stats[side]['d']['__getitem__']['errors'] == 1
+    assert stats['server']['q']['put']['bytes_received'] >= 10 * 1000
+    assert stats['server']['q']['put']['bytes_sent'] > 0
+    text = C.metrics_text()
+    assert 'remotesyncmanager_server_seconds_count{object="q",method="put"} 10\n' in text
+    assert 'remotesyncmanager_client_seconds_count{object="q",method="put"} 10\n' in text
+    assert 'remotesyncmanager_server_errors_total{object="d",method="__getitem__"} 1\n' in text
+
+
+def test_no_metrics_by_default(server):
+    RS, C = server((('q', queue.Queue()),))
+    C.q.put(1)
+    assert C.stats() == {'server': {}, 'client': {}}
+
+
+# Lazy proxies.
+
+def test_proxies_materialized_on_first_use(server):
+    RS, C = server((('q', queue.Queue()), ('d', {}), ('lo', threading.Lock())))
+    assert C.unmaterialized == {'q', 'd', 'lo'} and not C.proxies
+    C.q.put(1)
+    assert C.unmaterialized == {'d', 'lo'} and list(C.proxies) == ['q']
+    assert C.__dict__['q'] is C.q
+    with pytest.raises(AttributeError):
+        C.missing
+    eager = rsm.RemoteSyncManager(C.serverdatafilename, AUTHKEY, lazy = False)
+    assert not eager.unmaterialized and sorted(eager.proxies) == ['d', 'lo', 'q']
+    assert eager.q.get() == 1
+
+
+def test_bulk_tokens(server):
+    RS, C = server((('q', queue.Queue()), ('d', {}), ('e', {})), client = {'bulk': True}, shards = 2)
+    tokens = dict(C.tokens)
+    assert sorted(tokens) == ['d', 'e', 'q']
+    C.d['k'] = 'v'
+    assert C.d._token.id == tokens['d'][0] and 'd' not in C.tokens
+    # The proxies of the tokens are those of the named objects themselves.
+    lazy = rsm.RemoteSyncManager(C.serverdatafilename, AUTHKEY)
+    for name in ('q', 'd', 'e'):
+        assert getattr(lazy, name)._token.id == tokens[name][0]
+    assert lazy.d['k'] == 'v'
+    # They add no reference of their own: deleting one leaves the object be.
+    del C.d, C.proxies['d']
+    assert lazy.d['k'] == 'v'
+
+
+# Codecs.
+
+def test_codecs(server):
+    codecs = {'big': rsm.Codec('pickle', compress = 1000)}
+    RS, C = server((('q', queue.Queue()), ('big', queue.Queue())), codec = rsm.Codec('plain'), codecs = codecs)
+    C.q.put({'a': [1, 2.5, 'b', (None, True)]})
+    C.q.put(range(3))
+    C.q.put(array.array('i', [1]))
+    assert C.q.get() == {'a': [1, 2.5, 'b', (None, True)]}
+    assert C.q.get() == range(3)
+    # Bytes-like objects come back as bytes.
+    assert C.q.get() == array.array('i', [1]).tobytes()
+    # Compressed above the threshold, unless that does not make it smaller.
+    random = os.urandom(2000)
+    for message in (b'x' * 10000, b'x' * 100, random):
+        C.big.put(message)
+        assert C.big.get() == message
+    stats = C.codec_stats()
+    for side in ('server', 'client'):
+        assert stats[side][None]['format'] == 'plain'
+        assert stats[side]['big']['format'] == 'pickle' and stats[side]['big']['compress'] == 1000
+        big = stats[side]['big']
+        assert big['messages'] == 6 and big['plain'] == 0
+        assert big['compressed'] == 1 and big['bytes_saved'] > 9000
+    # The range, sent by the client and returned by the server, is pickled.
+    requests, replies = stats['client'][None], stats['server'][None]
+    assert requests['messages'] - requests['plain'] >= 1 and replies['messages'] - replies['plain'] >= 1
+    assert requests['compressed'] == replies['compressed'] == 0
+
+
+def test_codec_of_a_missing_object(server):
+    with pytest.raises(ValueError):
+        rsm.Codec('json')
+    with pytest.raises(ValueError):
+        server((('q', queue.Queue()),), codecs = {'missing': rsm.Codec()})
+
+
+# Watches.
+
+def test_watch_times_out(server):
+    RS, C = server((('di', {'a': 1}),))
+    C.di['a'] = 2
+    version, changed = C.di.watch(since_version = 0, timeout = 0)
+    assert version > 0 and changed == {'a': 2}
+    start = time.monotonic()
+    assert C.di.watch(['a'], timeout = 0.2) == (version, {})
+    assert time.monotonic() - start >= 0.2
+
+
+def test_watch_wakes_on_a_change(server):
+    RS, C = server((('di', {}), ('ns', mpm.Namespace())))
+    version = C.di.watch(timeout = 0)[0]
+    started = threading.Event()
+
+    def watch():
+        started.set()
+        return C.di.watch(['b'], version, timeout = 5)
+
+    def change():
+        started.wait()
+        time.sleep(0.1)
+        # Not a watched key.
+        C.di['a'] = 1
+        time.sleep(0.1)
+        C.di['b'] = 2
+
+    changer = threading.Thread(target=change)
+    changer.start()
+    start = time.monotonic()
+    newversion, changed = run(watch)
+    changer.join()
+    assert changed == {'b': 2} and newversion > version
+    assert 0.2 <= time.monotonic() - start < 5
+    # Deleted keys come back as MISSING, changes before the watch are seen.
+    del C.di['b']
+    assert C.di.watch(['b'], newversion, timeout = 5)[1] == {'b': rsm.MISSING}
+
+    version = C.ns.watch(timeout = 0)[0]
+    threading.Timer(0.1, setattr, (C.ns, 'x', 1)).start()
+    assert run(lambda: C.ns.watch(['x'], version, timeout = 5))[1] == {'x': 1}
+
+
+# Transactions.
+
+def count(lo, d1, d2, d3):
+    d2['n'] = d2.get('n', 0) + 1
+    return d2['n']
+
+
+def test_transact_with_named_lock_held_by_a_client(server):
+    # The server used to take the locks of a transaction in the order of
+    # their ids, object locks (created by the server) and named locks alike.
+    # The named lock is allocated after others which are then freed, so that
+    # the object locks tend to reuse their room and be ordered first.
+    padding = [threading.Lock() for n in range(10000)]
+    lo = threading.Lock()
+    del padding
+    RS, C = server((('lo', lo), ('d1', {}), ('d2', {}), ('d3', {})), transactions = [count])
+    transaction = threading.Thread(target=C.transact, args=(count, 'lo', 'd1', 'd2', 'd3'), daemon=True)
+    with C.lo:
+        transaction.start()
+        transaction.join(0.2)
+        # The transaction waits for the lock, not holding the object locks.
+        run(lambda: C.d1.__setitem__('x', 1))
+        assert transaction.is_alive()
+    transaction.join(5)
+    assert not transaction.is_alive()
+    assert C.d2['n'] == 1
+    assert run(lambda: C.transact(count, 'lo', 'd1', 'd2', 'd3')) == 2
+
+
+# Server engines.
+
+@pytest.mark.parametrize('engine', ['threads', 'selector'])
+def test_thread_owned_objects(server, engine, monkeypatch):
+    # Each request of the selector engine is then served by any free thread.
+    monkeypatch.setattr(rsm.ConnectionSelector, 'linger', 0)
+    RS, C = server((('rl', threading.RLock()), ('co', threading.Condition()), ('q', queue.Queue())), engine = engine)
+
+    def use(n):
+        for i in range(n):
+            C.rl.acquire()
+            C.rl.acquire()
+            C.q.put(i)
+            C.rl.release()
+            C.rl.release()
+            C.co.acquire()
+            C.co.notify_all()
+            C.co.release()
+        return n
+
+    # Materialized here, not by the threads at once.
+    C.rl, C.co, C.q
+    # Other connections keep the threads of the selector engine busy.
+    others = [threading.Thread(target=use, args=(50,), daemon=True) for n in range(4)]
+    for other in others:
+        other.start()
+    assert run(lambda: use(50), timeout = 20) == 50
+    for other in others:
+        other.join(20)
+    assert C.q.qsize() == 250
+
+
+def test_async_thread_owned_objects(server):
+    RS, C = server((('rl', threading.RLock()), ('co', threading.Condition()), ('q', queue.Queue())))
+
+    async def use(A, n):
+        for i in range(n):
+            async with A.rl:
+                await A.q.put(i)
+            async with A.co:
+                await A.co.notify_all()
+
+    async def main():
+        async with rsm.AsyncRemoteSyncManager(C.serverdatafilename, AUTHKEY) as A:
+            # Concurrent requests of the same connection, served by as many
+            # threads of the server.
+            await asyncio.gather(*(use(A, 20) for n in range(5)))
+            return await A.q.qsize()
+
+    assert run(lambda: asyncio.run(main()), timeout = 20) == 100
+
+
+# Messages.
+
+def exchange(obj):
+    '''
+    Send `obj` on a `BufferConnection` and return what the other end
+    receives, with the sizes both ends counted.
+    '''
+    a, b = socket.socketpair()
+    sender, receiver = rsm.BufferConnection(a.detach()), rsm.BufferConnection(b.detach())
+    try:
+        sent = []
+        thread = threading.Thread(target=lambda: sent.append(sender.send(obj)), daemon=True)
+        thread.start()
+        received, size = receiver.recv_sized()
+        thread.join(5)
+        return received, size, sent[0]
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def outofband(obj):
+    header = bytes(rsm.encode_message(obj)[0][0])
+    return rsm.messageheader.unpack(header[:13])[1]
+
+
+def test_message_header_with_outofband_buffers():
+    data = bytearray(os.urandom(1 << 15))
+    chunks, size = rsm.encode_message({'data': pickle.PickleBuffer(data)})
+    bodysize, count, flags = rsm.messageheader.unpack(chunks[0][:13])
+    assert (count, flags) == (1, 0)
+    assert struct.unpack('!Q', chunks[0][13:]) == (len(data),)
+    # The buffer is sent from the memory of `data`, not copied.
+    assert chunks[1].readonly is False and chunks[1].obj is data
+    assert size == 13 + 8 + len(data) + bodysize == sum(len(bytes(chunk)) for chunk in chunks)
+    body = b''.join(bytes(chunk) for chunk in chunks[2:])
+    assert rsm.decode_message(body, flags, [bytearray(chunks[1])]) == {'data': data}
+
+
+# Only contiguous memoryviews are sent out-of-band, the others, bytearrays
+# and arrays are pickled in-band.
+@pytest.mark.parametrize('obj, buffers', [
+    (memoryview(bytearray(range(256)) * 256), 1),
+    (memoryview(bytearray(range(256)) * 512)[::2], 0),
+    (memoryview(bytearray(range(256)) * 256).cast('i', (128, 128)), 1),
+    (bytearray(range(256)) * 256, 0),
+    (array.array('d', range(1 << 13)), 0),
+    (bytearray(range(256)), 0),
+], ids=['contiguous', 'non-contiguous', '2-D', 'bytearray', 'array', 'small'])
+def test_message_round_trip(obj, buffers):
+    assert outofband(obj) == buffers
+    received, size, sent = exchange(obj)
+    assert size == sent
+    assert type(received) is type(obj)
+    if isinstance(obj, memoryview):
+        assert (received.format, received.shape) == (obj.format, obj.shape)
+        assert received.tolist() == obj.tolist()
+    else:
+        assert received == obj
+
+
+def test_message_in_band_below_the_threshold(monkeypatch):
+    data = memoryview(os.urandom(1 << 15))
+    monkeypatch.setattr(rsm.BufferConnection, 'outofband', len(data) + 1)
+    assert outofband(data) == 0
+    received, size, sent = exchange(data)
+    assert received == data and size == sent
+
+
+# Client side caches.
+
+def test_cache_hits_and_invalidations(server):
+    RS, C = server((('di', {'a': 1}),), client = {'cache': {'di': 10}})
+    other = rsm.RemoteSyncManager(C.serverdatafilename, AUTHKEY)
+    assert C.di['a'] == 1 and C.di['a'] == 1
+    assert 'b' not in C.di and 'b' not in C.di
+    info = C.di.cache_info()
+    assert (info['hits'], info['misses'], info['size']) == (2, 2, 2)
+    # Changed by another client, the key is dropped once the server says so.
+    other.di['a'] = 2
+    deadline = time.monotonic() + 5
+    while C.di['a'] != 2:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert C.di.cache_info()['invalidations'] >= 1
+    # Changed through the cache, at once.
+    C.di['b'] = 3
+    assert C.di['b'] == 3
+
+
+def test_cache_disabled_when_its_listener_connection_drops(server):
+    RS, C = server((('di', {'a': 1}),), client = {'cache': {'di': 10}})
+    other = rsm.RemoteSyncManager(C.serverdatafilename, AUTHKEY)
+    assert C.di['a'] == 1
+    listener, = C.listeners
+    sock = socket.socket(fileno=os.dup(listener.conn.fileno()))
+    sock.shutdown(socket.SHUT_RDWR)
+    sock.close()
+    listener.thread.join(5)
+    assert not listener.thread.is_alive()
+    info = C.di.cache_info()
+    assert not info['enabled'] and info['size'] == 0
+    # Not told of the changes anymore, reads go to the server.
+    other.di['a'] = 2
+    assert C.di['a'] == 2 and C.di['a'] == 2
+    assert C.di.cache_info()['hits'] == info['hits']
+
+
+# Read replicas.
+
+def test_replica_reads(server):
+    RS, C = server((('di', {}),), replicas = 1, replicated = ['di'])
+    assert isinstance(C.di, rsm.ReplicatedDictProxy)
+    C.di['a'] = 1
+    # Written to the primary, read from the replica once it got the change.
+    deadline = time.monotonic() + 5
+    while C.di._replica.get('a') != 1:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert C.di['a'] == 1 and 'a' in C.di and len(C.di) == 1
+    assert C.di.items() == [('a', 1)]
+
+
+def test_stale_replica(server):
+    RS, C = server((('di', {'a': 1}),), replicas = 1, replicated = ['di'], staleness = 0.2)
+    primary, = RS.servers
+    deadline = time.monotonic() + 5
+    while C.di._replica.get('a') != 1:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    # The primary stopped, the replica is soon too far behind to be read.
+    os.kill(primary._process.pid, signal.SIGSTOP)
+    try:
+        time.sleep(0.5)
+        with pytest.raises(rsm.StaleReplica):
+            C.di._replica['a']
+    finally:
+        os.kill(primary._process.pid, signal.SIGCONT)
+    # Read from the primary then, until the replica catches up.
+    assert C.di['a'] == 1
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            assert C.di._replica['a'] == 1
+            break
+        except rsm.StaleReplica:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+
+# Streams.
+
+def write_in_thread(C, ref, count = 10000):
+    result = []
+
+    def write():
+        try:
+            result.append(C.write_stream(ref, (b'x' * 1000 for n in range(count))))
+        except Exception as e:
+            result.append(e)
+
+    thread = threading.Thread(target=write, daemon=True)
+    thread.start()
+    return thread, result
+
+
+def test_stream_read_once(server):
+    RS, C = server((('q', queue.Queue()),))
+    ref = C.stream(name = 'q', once = True, window = 2)
+    writer, result = write_in_thread(C, ref, 100)
+    assert sum(len(chunk) for chunk in C.read_stream(ref)) == 100000
+    writer.join(5)
+    assert result == [(100, 100000)]
+
+
+def test_stream_read_once_abandoned_by_its_reader(server):
+    RS, C = server((('q', queue.Queue()),))
+    ref = C.stream(name = 'q', once = True, window = 2)
+    writer, result = write_in_thread(C, ref)
+    chunks = C.read_stream(ref)
+    next(chunks)
+    chunks.close()
+    writer.join(5)
+    assert not writer.is_alive()
+    assert isinstance(result[0], mpm.RemoteError) and 'stream closed' in str(result[0])
+
+
+def test_stream_deleted_while_written(server):
+    RS, C = server((('q', queue.Queue()),))
+    ref = C.stream(name = 'q', once = True, window = 2)
+    writer, result = write_in_thread(C, ref)
+    chunks = C.read_stream(ref)
+    next(chunks)
+    C.delete_stream(ref)
+    writer.join(5)
+    assert not writer.is_alive()
+    assert isinstance(result[0], mpm.RemoteError)
+    with pytest.raises(mpm.RemoteError, match='deleted'):
+        list(chunks)
+
+
+# Locks.
+
+def hold(RS, seconds):
+    with RS.lo:
+        time.sleep(seconds)
+
+
+def test_lock_holders_of_forked_children(server):
+    RS, C = server((('lo', threading.Lock()),))
+    children = [mp.get_context('fork').Process(target=hold, args=(C, 1)) for n in range(2)]
+    for child in children:
+        child.start()
+    time.sleep(0.5)
+    stats = C.lock_stats()['lo']
+    for child in children:
+        child.join()
+    holders = list(stats['holders']) + list(stats['waiters'])
+    assert sorted(holders) == sorted(f'{C.IP}-P{child.pid}/MainThread' for child in children)
+    assert C.lock_stats()['lo']['acquisitions'] == 2
+
+
+def locked(lo, rw, d1):
+    d1['n'] = d1.get('n', 0) + 1
+
+
+def test_lock_stats_of_async_with(server):
+    RS, C = server((('lo', threading.Lock()),))
+
+    async def use():
+        async with rsm.AsyncRemoteSyncManager(C.serverdatafilename, AUTHKEY) as A:
+            async with A.lo:
+                return C.lock_stats()['lo']['holders']
+
+    holders = run(lambda: asyncio.run(use()))
+    assert len(holders) == 1
+    assert next(iter(holders)).startswith(f'{C.IP}-P{os.getpid()}/')
+    assert C.lock_stats()['lo']['holders'] == {}
+
+
+def test_transact_holds_named_locks(server):
+    RS, C = server((('lo', threading.Lock()), ('rw', rsm.RWLock()), ('d1', {})), transactions = [locked])
+    with C.rw.read():
+        transaction = threading.Thread(target=C.transact, args=(locked, 'lo', 'rw', 'd1'), daemon=True)
+        transaction.start()
+        transaction.join(0.2)
+        # Held for writing by the transaction, the RWLock waits for readers.
+        assert transaction.is_alive()
+        assert list(C.lock_stats()['rw']['waiters']) == [f'{C.IP}-P{os.getpid()}/{transaction.name}']
+    transaction.join(5)
+    assert C.d1['n'] == 1
+    stats = C.lock_stats()
+    assert stats['lo']['acquisitions'] == 1 and stats['rw']['acquisitions'] == 2
+
+
+def test_rwlock_readers_share_writers_exclude(server):
+    RS, C = server((('rw', rsm.RWLock()),))
+    with C.rw.read():
+        assert run(lambda: C.rw.acquire('read', timeout = 1))
+        C.rw.release('read')
+        assert not run(lambda: C.rw.acquire('write', timeout = 0.1))
+    with C.rw.write():
+        assert not run(lambda: C.rw.acquire('read', timeout = 0.1))
+    with pytest.raises(RuntimeError):
+        C.rw.release('read')
+    assert C.lock_stats()['rw']['failures'] == 2
+
+
+# Connection pooling.
+
+def pooled_server(serverdatafilename, directory, ready, stop):
+    RS = rsm.RemoteSyncManager(serverdatafilename, AUTHKEY, (('vi', mpm.Value(int, 0)), ('di', {})), persist = directory)
+    ready.set()
+    stop.wait()
+    # As if the host went down.
+    for manager in RS.servers:
+        os.kill(manager._process.pid, signal.SIGKILL)
+
+
+def test_pool_reconnects_after_a_server_restart(tmp_path):
+    context = mp.get_context('fork')
+    serverdatafilename = str(tmp_path / 'serverdata.pkl')
+    ready, stop = context.Event(), context.Event()
+
+    def start():
+        ready.clear()
+        stop.clear()
+        process = context.Process(target=pooled_server, args=(serverdatafilename, str(tmp_path / 'persist'), ready, stop))
+        process.start()
+        assert ready.wait(10)
+        return process
+
+    process = start()
+    try:
+        C = rsm.RemoteSyncManager(serverdatafilename, AUTHKEY, pool = 2, reconnect = 10)
+        assert C.vi.incr() == 1
+        C.di['a'] = 1
+        stop.set()
+        process.join()
+        process = start()
+        # The same proxies, through new connections to the new server.
+        assert C.vi.incr() == 2
+        assert C.di['a'] == 1
+        assert max(pool.epoch for pool in C.pools) >= 1
+    finally:
+        stop.set()
+        process.join()
+
+
+# Snapshots.
+
+def test_snapshot_on_the_connections_of_the_proxies(server, monkeypatch):
+    # Another server of this process, of use only by its object in the
+    # registry of the next ones (see test_persisted_objects_restored...).
+    other = rsm.RemoteSyncManager(None, AUTHKEY, (('other', {}),))
+    try:
+        RS, C = server((('q', queue.Queue()), ('di', {'a': 1}), ('lo', threading.Lock())), shards = 2)
+    finally:
+        other.server.shutdown()
+    # Only the objects of the server itself, not all those of its registry.
+    names = [rsm.server_call(address, AUTHKEY, 'snapshot') for address in C.addresses]
+    assert sorted(name for shardnames in names for name in shardnames) == ['di', 'lo', 'q']
+    C.q.put(1)
+    # No connection of its own.
+    monkeypatch.setattr(rsm, 'server_call', None)
+    snapshot = C.snapshot()
+    assert snapshot['q']['qsize'] == 1 and snapshot['di']['len'] == 1
+    assert snapshot['lo']['locked'] is False
+    assert 'q: <queue.Queue object at ' in str(C)
+
+
+# Persistence.
+
+def test_persisted_objects_restored_after_sigkill(server, tmp_path):
+    directory = str(tmp_path / 'persist')
+    namedobjects = (('di', {}), ('vi', mpm.Value(int, 0)))
+    # Another server of this process: its object is in the registry of the
+    # servers started next, unless a client registers it again, without it.
+    other = rsm.RemoteSyncManager(str(tmp_path / 'other.pkl'), AUTHKEY, (('other', {'x': 1}),))
+    try:
+        RS, C = server(namedobjects, persist = directory)
+        C.di['a'] = 1
+        C.vi.incr(5)
+        process = RS.servers[0]._process
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
+        RS, C = server(namedobjects, persist = directory)
+        # On the same port: the connections of this thread to it are those
+        # of the server killed.
+        assert run(lambda: (C.di['a'], C.vi.value)) == (1, 5)
+        with open(os.path.join(directory, 'shard0.snapshot'), 'rb') as f:
+            generation, states = pickle.load(f)
+        assert sorted(states) == ['di', 'vi']
+    finally:
+        other.server.shutdown()
+
+
+# Publish/subscribe.
+
+def test_channel_evicts_idle_subscribers(server):
+    RS, C = server((('ch', rsm.Channel(maxsize = 2, policy = 'block', idle = 0.3)),))
+    gone = C.ch.subscribe()
+    live = C.ch.subscribe()
+    received = []
+
+    def receive():
+        while len(received) < 5:
+            received.extend(live.receive(timeout = 0.05))
+        return received
+
+    receiver = threading.Thread(target=receive, daemon=True)
+    receiver.start()
+    start = time.monotonic()
+    assert run(lambda: C.ch.publish_many(range(5))) == 5
+    assert time.monotonic() - start >= 0.3
+    receiver.join(5)
+    assert received == [0, 1, 2, 3, 4]
+    stats = C.ch.stats()
+    assert stats['evicted'] == 1 and list(stats['subscribers']) == [live.sid]
+    with pytest.raises(ValueError):
+        gone.receive(block = False)
+
+
+def test_channel_publish_counts_the_subscribers(server):
+    RS, C = server((('ch', rsm.Channel(maxsize = 1, policy = 'block')),))
+    subscriptions = [C.ch.subscribe(), C.ch.subscribe()]
+    assert C.ch.publish('x') == 2
+    with pytest.raises(queue.Full):
+        C.ch.publish('y', block = False)
+    assert [subscription.receive() for subscription in subscriptions] == [['x'], ['x']]
+
+
+# Task queues.
+
+def remaining(tasks):
+    with tasks.worker(prefetch = 10) as worker:
+        return [task for tid, task in iter(lambda: worker.get(block = False), None)]
+
+
+def test_taskworker_break_acknowledges_the_last_task(server):
+    RS, C = server((('tasks', rsm.TaskQueue()),))
+    C.tasks.put_many(['a', 'b', 'c'])
+    ran = []
+    with C.tasks.worker(prefetch = 2) as worker:
+        for task in worker:
+            ran.append(task)
+            if task == 'b':
+                break
+    assert ran == ['a', 'b']
+    assert remaining(C.tasks) == ['c']
+
+
+def test_taskworker_failure_gives_the_task_back(server):
+    RS, C = server((('tasks', rsm.TaskQueue()),))
+    C.tasks.put_many(['a', 'b', 'c'])
+    with pytest.raises(RuntimeError):
+        with C.tasks.worker(prefetch = 2) as worker:
+            for task in worker:
+                if task == 'b':
+                    raise RuntimeError(task)
+    assert remaining(C.tasks) == ['b', 'c']
+
+
+# Bounded caches.
+
+def test_cachedict_ttl(server):
+    RS, C = server((('cd', rsm.CacheDict(maxsize = 2, ttl = 0.1)),))
+    C.cd['x'] = 1
+    assert 'x' in C.cd and C.cd['x'] == 1
+    time.sleep(0.15)
+    assert 'x' not in C.cd
+    C.cd['y'] = 2
+    time.sleep(0.15)
+    assert C.cd.pop('y', 'gone') == 'gone'
+    with pytest.raises(KeyError):
+        del C.cd['y']
+    stats = C.cd.stats()
+    assert (stats['hits'], stats['misses'], stats['expirations']) == (2, 1, 2)
+
+
+def test_cachedict_lru(server):
+    RS, C = server((('cd', rsm.CacheDict(maxsize = 2)),))
+    C.cd.set_many({'a': 1, 'b': 2})
+    C.cd['a']
+    C.cd['c'] = 3
+    assert sorted(C.cd.keys()) == ['a', 'c']
+    assert C.cd.stats()['evictions'] == 1
+
+
+# Accumulators.
+
+# Those of `accumulate`, alive until the process exits.
+accumulators = []
+
+
+def accumulate(C):
+    totals = C.accumulator('di', interval = 0)
+    totals.add('a', 3)
+    hits = C.accumulator('vi', interval = 0)
+    hits.add()
+    hits.add(4)
+    accumulators.extend([totals, hits])
+
+
+def test_accumulators_flush_on_close(server):
+    RS, C = server((('di', {}), ('vi', mpm.Value(int, 0))))
+    with C.accumulator('di', interval = 0) as totals:
+        totals.add('a')
+        totals.add('a', 2)
+        assert C.di.get('a') is None
+    assert C.di['a'] == 3
+    hits = C.accumulator('vi', interval = 0)
+    hits.add()
+    hits.add(4)
+    assert C.vi.value == 0
+    hits.close()
+    assert C.vi.value == 5
+
+
+def test_accumulators_flush_at_exit(server):
+    RS, C = server((('di', {}), ('vi', mpm.Value(int, 0))))
+    child = mp.get_context('fork').Process(target=accumulate, args=(C,))
+    child.start()
+    child.join(10)
+    assert child.exitcode == 0
+    assert C.di['a'] == 3 and C.vi.value == 5
+
+
+def test_accumulator_flushes_once_collected(server):
+    RS, C = server((('di', {}),))
+    totals = C.accumulator('di', interval = 60)
+    totals.add('a')
+    totals = None
+    assert C.di['a'] == 1